@@ -1,17 +1,73 @@
 import os
-import json
+import sys
+import atexit
 import argparse
 import time
 import traceback
 import datetime
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
 import fitbit
-import gather_keys_oauth2 as Oauth2
+import numpy as np
 import pandas as pd
+from fitbit_api import TOKEN_FILE, SECRET_VARIABLE, RateLimiter, TokenFile, watch_rate_limit, serialize_token_refresh, \
+    retry_unauthorized, configure_session, group_ranges, fetch_bodyweight_range, fetch_training_range
+from fitbit_cache import BACKENDS, FileCache, MemoryCache, open_cache, content_hash
+from fitbit_frames import dataset_to_frame, combine_minutes
+from fitbit_db import upsert_df, present_dates, present_minute_dates, delete_day, TableBatches, Manifest, \
+    StorageSession
+from fitbit_schema import SCHEMA_VERSION, MANIFEST_VERSION, AGGREGATES_VERSION
+from fitbit_sinks import CSVSink, ParquetSink, RecordBuffer, pyarrow
+from fitbit_aggregates import Aggregates
+from fitbit_profile import profiler, profiled
+from fitbit_accounts import run_accounts, without_option
+
+try:
+    # Only needed to authorize in the browser, not when a token is stored
+    import gather_keys_oauth2 as Oauth2
+except ImportError:
+    Oauth2 = None
 
 # Switch for debug messages from the cache
 DEBUG_CACHE = False
 
+# Use results cached in earlier runs, set from the application arguments
+cache_enabled = True
+
+# Storage of the cached Fitbit API responses, set from the application arguments.
+# Recently used entries are kept in memory, e.g. for create_daily_summary.
+cache = MemoryCache(FileCache("Cache"))
+
+# Cache entries (name, date) downloaded during this run, valid even if the cache is disabled
+downloaded_entries = set()
+
+# Request budget shared by all download workers
+rate_limiter = RateLimiter()
+
+# Stored OAuth2 token of the Fitbit user, set from the application arguments
+tokens = TokenFile(TOKEN_FILE)
+
+# Store all 1 minute values in the wide Minute table too, set from the application arguments
+minute_table_enabled = False
+
+# Columns of the Minute table
+MINUTE_COLUMNS = ['Steps', 'Heart Rate', 'Calories', 'Distance', 'Floors', 'Elevation']
+
+# Maximum number of retries of a request refused because of the rate limit
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Record of the endpoints fetched and stored per day, set when the database is opened
+manifest = None
+
+# Outputs of the saved data besides the database, set from the application arguments
+sinks = [CSVSink()]
+
+# Single rows of tables, written with the other rows of their table when the days are committed
+records = RecordBuffer(sinks)
+
+# Replace the values of rows already stored, set for a sync, which saves changed days again
+update_stored = False
+
 
 def create_directories():
     """
@@ -19,7 +75,7 @@ def create_directories():
     :return:
     """
     data_directories = ["Sleep", "Steps", "Floors", "Calories", "Distance", "Heart", "Activities",
-                        "Elevation", "Body", "Daily", "Data", "Training"]
+                        "Elevation", "Body", "Daily", "Data", "Training", "data"]
     for dir_name in data_directories:
         create_directory_if_not_exist(dir_name)
 
@@ -67,163 +123,542 @@ def get_dict_element(dictionary, key1, key2=None, key3=None):
         return None
 
 
-def check_df_field_value(dataframe, column, row, value):
+def read_from_cache(name, date):
+    """
+    Read dictionary from cache
+    :param name: type of data
+    :param date: date of data to retrieve
+    :return: dict with data or None
+    """
+    if cache_enabled or (name, date) in downloaded_entries:
+        if DEBUG_CACHE:
+            print("Reading from cache : " + name + " " + date)
+        data, size = profiler.call('cache read', cache.load, name, date)
+        profiler.add_bytes('cache read', size)
+        return data
+    return None
+
+
+def in_cache(name, date):
+    """
+    Check if data is present in the cache, without reading it
+    :param name: type of data
+    :param date: date of data to check
+    :return: True, if present
+    """
+    if cache_enabled or (name, date) in downloaded_entries:
+        return cache.contains(name, date)
+    return False
+
+
+def save_to_cache(name, date, data):
     """
-    Check if the data stored in the dataframe, column key, row rownumber equals
-    the target date. Value is compared using the '==' operator
-    :param dataframe: The dataframe
-    :param column: Name of the column
-    :param row: Row number
-    :param value: target date
+    Save data to the cache
+    :param name: type of data
+    :param date: date of the data
+    :param data: the dict to store
     :return:
     """
-    try:
-        field_value = str(dataframe[column].iloc[row])
-        if field_value == value:
-            return True
-        else:
-            return False
-    except:
-        return False
+    if DEBUG_CACHE:
+        print("Storing to cache : " + name + " " + date)
+    profiler.add_bytes('cache write', profiler.call('cache write', cache.write, name, date, data))
+    downloaded_entries.add((name, date))
 
 
-def day_present(conn, day):
+def fetch_intraday(fb_client, day, resource):
     """
-    Check if specified data is present in the database
-    :param conn: Database connection
-    :param day: date to check
-    :return: True, if date is present
+    Download the intraday time series (granularity 1 min) of a resource
+    :param fb_client: Fitbit Client
+    :param day: day to retrieve
+    :param resource: Fitbit resource, e.g. 'activities/steps'
+    :return: dict with data
     """
-    try:
+    day_str = str(day.strftime("%Y-%m-%d"))
+    return fb_client.intraday_time_series(resource, base_date=day_str, detail_level='1min')
+
+
+def fetch_bodyweight(fb_client, day):
+    """
+    Download the weight logs of a day
+    :param fb_client: Fitbit Client
+    :param day: day to retrieve
+    :return: dict with data
+    """
+    return fb_client.get_bodyweight(day, period='1d')
+
+
+def fetch_sleep(fb_client, day):
+    """
+    Download the sleep logs of a day
+    :param fb_client: Fitbit Client
+    :param day: day to retrieve
+    :return: dict with data
+    """
+    return fb_client.get_sleep(day)
+
+
+def fetch_activities(fb_client, day):
+    """
+    Download the activity summary of a day
+    :param fb_client: Fitbit Client
+    :param day: day to retrieve
+    :return: dict with data
+    """
+    url = "https://api.fitbit.com/1/user/-/activities/date/{year}-{month}-{day}.json".format(
+        year=day.year,
+        month=day.month,
+        day=day.day
+    )
+    return fb_client.make_request(url)
+
+
+def fetch_training(fb_client, day):
+    """
+    Download the last ten logged activities up to and including a day
+    :param fb_client: Fitbit Client
+    :param day: day to retrieve
+    :return: dict with data
+    """
+    day_after = day + datetime.timedelta(days=1)
+    day_after_str = str(day_after.strftime("%Y-%m-%d"))
+    url = "https://api.fitbit.com/1/user/-/activities/list.json?beforeDate=" + \
+          day_after_str + "&sort=desc&offset=0&limit=10"
+    return fb_client.make_request(url)
+
+
+# Cache name and download function of every Fitbit endpoint used per day
+ENDPOINTS = {
+    "activities_calories": partial(fetch_intraday, resource='activities/calories'),
+    "activities_steps": partial(fetch_intraday, resource='activities/steps'),
+    "activities_distance": partial(fetch_intraday, resource='activities/distance'),
+    "activities_floors": partial(fetch_intraday, resource='activities/floors'),
+    "activities_elevation": partial(fetch_intraday, resource='activities/elevation'),
+    "activities_activityCalories": partial(fetch_intraday, resource='activities/activityCalories'),
+    "weight": fetch_bodyweight,
+    "sleep": fetch_sleep,
+    "activities": fetch_activities,
+    "steps_1m": partial(fetch_intraday, resource='activities/steps'),
+    "training": fetch_training,
+    "heart_1m": partial(fetch_intraday, resource='activities/heart'),
+}
+
+# Endpoints with the same request as another endpoint, the data is copied from the cache of the other
+SAME_REQUEST = {
+    "steps_1m": "activities_steps",
+}
+
+# Endpoints that can be downloaded for a range of days: maximum number of days
+# per request and download function. Intraday data is only available per day.
+RANGE_ENDPOINTS = {
+    "weight": (31, fetch_bodyweight_range),
+    "training": (30, fetch_training_range),
+}
+
+
+def call_api(description, function, *args):
+    """
+    Call the Fitbit API within the request budget.
+    When the rate limit is reached, the request is retried after the reset.
+    :param description: description of the request for messages, e.g. 'sleep 2019-01-01'
+    :param function: function performing the request
+    :param args: arguments of the function
+    :return: result of the function
+    """
+    retries = 0
+    while True:
+        profiler.call('api rate limit wait', rate_limiter.acquire)
+        try:
+            return profiler.call('api ' + description.split(' ')[0], function, *args)
+        except fitbit.exceptions.HTTPTooManyRequests as e:
+            retries += 1
+            if retries > MAX_RATE_LIMIT_RETRIES:
+                raise
+            retry_after = getattr(e, 'retry_after_secs', None)
+            rate_limiter.exhausted(retry_after)
+            print("Too many requests, retrying {} after the rate limit reset ({} seconds, attempt {} of {})".format(
+                description, retry_after if retry_after is not None else "unknown", retries, MAX_RATE_LIMIT_RETRIES))
+        finally:
+            rate_limiter.release()
+
+
+def get_data(fb_client, name, day):
+    """
+    Return the data of an endpoint for a day. Read from cache if present,
+    otherwise download from the Fitbit API and store in the cache.
+    :param fb_client: Fitbit Client
+    :param name: type of data, key of ENDPOINTS
+    :param day: day to retrieve
+    :return: dict with data
+    """
+    day_str = str(day.strftime("%Y-%m-%d"))
+    data = read_from_cache(name, day_str)
+    if not data and name in SAME_REQUEST:
+        data = read_from_cache(SAME_REQUEST[name], day_str)
+        if data:
+            save_to_cache(name, day_str, data)
+    if not data:
+        data = call_api(name + " " + day_str, ENDPOINTS[name], fb_client, day)
+        save_to_cache(name, day_str, data)
+    if manifest:
+        manifest.mark_fetched([(name, day_str)])
+    return data
+
+
+def cached_entries():
+    """
+    All entries present in the cache, read at once
+    :return: set of (name, date)
+    """
+    if cache_enabled:
+        return set(cache.entries())
+    return set(downloaded_entries)
+
+
+def plan_days(days):
+    """
+    Determine the processing steps (see SAVE_STEPS) still to do per day, using
+    the manifest read once. A day is skipped only when all steps are stored.
+    :param days: days to check
+    :return: dict with the set of step names per day, for the days with work, in the order of days
+    """
+    stored = manifest.stored()
+    plan = {}
+    for day in days:
         day_str = str(day.strftime("%Y-%m-%d"))
-        query = "select * from Daily_Summary where Date == '" + day_str + "'"
-        df = pd.read_sql(query, conn)
-        return not df.empty
-    except:
-        return False
+        steps = set(name for name, _, endpoints in SAVE_STEPS
+                    if any((endpoint, day_str) not in stored for endpoint in endpoints))
+        if minute_table_enabled and ("minute", day_str) not in stored:
+            # The Minute table is combined from the intraday data of these steps
+            steps.update(["minute"] + MINUTE_INPUT_STEPS)
+        if ("daily_summary", day_str) not in stored:
+            steps.add("daily_summary")
+        if steps:
+            plan[day] = steps
+    return plan
+
+
+def step_endpoints(steps):
+    """
+    Endpoints read by processing steps
+    :param steps: names of steps, see SAVE_STEPS
+    :return: list of endpoint names, keys of ENDPOINTS
+    """
+    endpoints = []
+    for name, _, endpoints_of_step in SAVE_STEPS:
+        if name in steps:
+            endpoints += endpoints_of_step
+    if "daily_summary" in steps:
+        endpoints += DAILY_SUMMARY_ENDPOINTS
+    return endpoints
+
+
+def plan_downloads(plan, cached):
+    """
+    Determine the endpoints to download per day
+    :param plan: steps per day, see plan_days
+    :param cached: entries present in the cache, see cached_entries
+    :return: dict with the list of endpoint names to download per day
+    """
+    missing = {}
+    for day, steps in plan.items():
+        day_str = str(day.strftime("%Y-%m-%d"))
+        names = []
+        for name in step_endpoints(steps):
+            name = SAME_REQUEST.get(name, name)
+            if name not in names and (name, day_str) not in cached:
+                names.append(name)
+        missing[day] = names
+    return missing
 
 
-def get_cache_filename(name, date):
+def plan_range_downloads(missing):
     """
-    Determine the filename for caching, including subdirs
-    Generic function for the store and retrieve methods to assure
-    same filename convention is used.
-    Path = Cache/<year>/<date>_<name>.json
-    :param name: Filename
-    :param date: Date of the data (string, format YYYY-MM-DD)
+    Group consecutive days that miss a range endpoint into the largest ranges
+    the range endpoints allow
+    :param missing: endpoints to download per day, see plan_downloads
+    :return: list of (name, first day, last day)
+    """
+    plan = []
+    for name, (max_days, _) in RANGE_ENDPOINTS.items():
+        days = [day for day, names in missing.items() if name in names]
+        for first_day, last_day in group_ranges(days, max_days):
+            plan.append((name, first_day, last_day))
+    return plan
+
+
+def download_ranges(fb_client, missing):
+    """
+    Download the range endpoints for multiple days per request and
+    store the result per day in the cache
+    :param fb_client: Fitbit Client
+    :param missing: endpoints to download per day, see plan_downloads
     :return:
     """
-    year_subdir = date[:4]
-    fn = os.path.join("Cache", year_subdir, date + "_" + name + ".json")
-    return fn
+    for name, first_day, last_day in plan_range_downloads(missing):
+        if DEBUG_CACHE:
+            print("Downloading {} from {} to {}".format(name, first_day, last_day))
+        description = "{} {} to {}".format(name, first_day, last_day)
+        make_request = partial(call_api, description, fb_client.make_request)
+        data = RANGE_ENDPOINTS[name][1](make_request, first_day, last_day)
+        for day_str, day_data in data.items():
+            save_to_cache(name, day_str, day_data)
 
 
-def read_from_cache(name, date):
+def sync_endpoints():
     """
-    Read dictionary from cache
-    :param name: type of data
-    :param date: date of data to retrieve
-    :return: dict with data or None
+    Endpoints with a watermark: the endpoints of all steps and the derived data
+    :return: list of endpoint names, as recorded in the manifest
     """
-    if cache_enabled:
-        fn = get_cache_filename(name, date)
-        if os.path.isfile(fn):
-            if DEBUG_CACHE:
-                print("Reading from cache : " + fn)
-            with open(fn, 'r') as fp:
-                data = json.load(fp)
-            return data
-    return None
+    endpoints = step_endpoints(set(name for name, _, _ in SAVE_STEPS)) + ["daily_summary"]
+    if minute_table_enabled:
+        endpoints.append("minute")
+    return endpoints
 
 
-def save_to_cache(name, date, data):
+def plan_sync(today, first_day, refetch_days):
     """
-    Save data to cache directory
-    :param name: type of data
-    :param date: date of the data
-    :param data: the dict to store
+    Determine the days of a sync: per endpoint the days after its watermark, the
+    last day synced completely, up to today. The last refetch_days days up to
+    the watermark and up to today may have been incomplete when they were
+    downloaded, e.g. because the device synced late; their stored responses are
+    fetched again. Without a watermark the last stored day of the endpoint is
+    used, and without stored days the sync starts at the first day.
+    :param today: last day to sync
+    :param first_day: oldest day Fitbit data is available
+    :param refetch_days: number of recent days fetched again
+    :return: (list of days in ascending order, dict with the endpoints to fetch again per day)
+    """
+    stored = manifest.stored()
+    watermarks = manifest.watermarks()
+    last_stored = {}
+    for endpoint, day_str in stored:
+        if day_str > last_stored.get(endpoint, ''):
+            last_stored[endpoint] = day_str
+    first = today + datetime.timedelta(days=1)
+    refetch = {}
+    for endpoint in sync_endpoints():
+        watermark = watermarks.get(endpoint) or last_stored.get(endpoint)
+        if watermark is None:
+            first = min(first, first_day)
+            continue
+        watermark = datetime.datetime.strptime(watermark, "%Y-%m-%d").date()
+        first = min(first, watermark + datetime.timedelta(days=1 - refetch_days))
+        if endpoint not in ENDPOINTS:
+            # Derived data is saved again when one of its endpoints changed
+            continue
+        windows = [watermark, today]
+        for last in windows:
+            for j in range(refetch_days):
+                day = last - datetime.timedelta(days=j)
+                if day >= first_day and (endpoint, day.strftime("%Y-%m-%d")) in stored:
+                    refetch.setdefault(day, set()).add(SAME_REQUEST.get(endpoint, endpoint))
+    first = max(first, first_day)
+    days = [first + datetime.timedelta(days=j) for j in range((today - first).days + 1)]
+    return days, dict(sorted(refetch.items()))
+
+
+def outdated_entries(names, day_str):
+    """
+    Entries of the manifest to save again after responses of a day changed:
+    the endpoints and the data derived from them
+    :param names: endpoint names
+    :param day_str: date (string, format YYYY-MM-DD)
+    :return: list of (endpoint, date)
+    """
+    entries = [(name, day_str) for name in names]
+    if any(name in DAILY_SUMMARY_ENDPOINTS for name in names):
+        entries.append(("daily_summary", day_str))
+    if any(name in step_endpoints(MINUTE_INPUT_STEPS) for name in names):
+        entries.append(("minute", day_str))
+    return entries
+
+
+def refetch_responses(fb_client, refetch):
+    """
+    Download stored responses again and compare them by their hash with the
+    responses saved before. Only changed responses are written to the cache and
+    their data saved again, responses that did not change are skipped.
+    :param fb_client: Fitbit Client
+    :param refetch: endpoints to fetch again per day, see plan_sync
+    :return: (number of responses fetched, number of responses changed)
+    """
+    if not refetch:
+        return 0, 0
+    days_of_name = {}
+    for day, names in refetch.items():
+        for name in names:
+            days_of_name.setdefault(name, []).append(day)
+    responses = {}
+    for name, days in sorted(days_of_name.items()):
+        if name in RANGE_ENDPOINTS:
+            max_days, fetch_range = RANGE_ENDPOINTS[name]
+            for first_day, last_day in group_ranges(days, max_days):
+                description = "{} {} to {}".format(name, first_day, last_day)
+                data = fetch_range(partial(call_api, description, fb_client.make_request), first_day, last_day)
+                for day_str, day_data in data.items():
+                    responses[(name, day_str)] = day_data
+        else:
+            for day in days:
+                day_str = str(day.strftime("%Y-%m-%d"))
+                responses[(name, day_str)] = call_api(name + " " + day_str, ENDPOINTS[name], fb_client, day)
+    dates = [day_str for _, day_str in responses]
+    hashes = manifest.hashes(min(dates), max(dates))
+    changed = 0
+    entries = []
+    outdated = []
+    for (name, day_str), data in responses.items():
+        names = [name] + [alias for alias, source in SAME_REQUEST.items() if source == name]
+        new_hash = content_hash(data)
+        old_hash = hashes.get((name, day_str))
+        if old_hash is None and in_cache(name, day_str):
+            old_hash = content_hash(read_from_cache(name, day_str))
+        if new_hash != old_hash:
+            for alias in names:
+                save_to_cache(alias, day_str, data)
+            outdated += outdated_entries(names, day_str)
+            changed += 1
+        entries += [(alias, day_str, new_hash) for alias in names]
+    manifest.mark_hashes(entries)
+    manifest.mark_outdated(outdated)
+    return len(responses), changed
+
+
+def update_watermarks(days):
+    """
+    Advance the watermark of every endpoint to the last day up to which all days of the sync are stored
+    :param days: days of the sync, in ascending order
     :return:
     """
-    fn = get_cache_filename(name, date)
-    if DEBUG_CACHE:
-        print("Storing to cache : " + fn)
-    with open(fn, 'w') as fp:
-        json.dump(data, fp)
-
-
-def clean_df_from_db_duplicates(df, tablename, engine, dup_cols=[],
-                                filter_continuous_col=None, filter_categorical_col=None):
-    """
-    Remove rows from a dataframe that already exist in a database
-    Thank you Ryan Baumann:
-    https://www.ryanbaumann.com/blog/2016/4/30/python-pandas-tosql-only-insert-new-rows
-    Required:
-        df : dataframe to remove duplicate rows from
-        engine: SQLAlchemy engine object
-        tablename: tablename to check duplicates in
-        dup_cols: list or tuple of column names to check for duplicate row values
-    Optional:
-        filter_continuous_col: the name of the continuous data column for BETWEEEN min/max filter
-                               can be either a datetime, int, or float data type
-                               useful for restricting the database table size to check
-        filter_categorical_col : the name of the categorical data column for Where = value check
-                                 Creates an "IN ()" check on the unique values in this column
-    Returns
-        Unique list of values from dataframe compared to database table
-    """
-    args = 'SELECT %s FROM %s' % (', '.join(['"{0}"'.format(col) for col in dup_cols]), tablename)
-    args_contin_filter, args_cat_filter = None, None
-    if filter_continuous_col is not None:
-        if df[filter_continuous_col].dtype == 'datetime64[ns]':
-            args_contin_filter = """ "%s" BETWEEN Convert(datetime, '%s')
-                                          AND Convert(datetime, '%s')""" % (filter_continuous_col,
-                                                                            df[filter_continuous_col].min(),
-                                                                            df[filter_continuous_col].max())
-
-    if filter_categorical_col is not None:
-        args_cat_filter = ' "%s" in(%s)' % (filter_categorical_col,
-                                            ', '.join(["'{0}'".format(value) for value in
-                                                       df[filter_categorical_col].unique()]))
-
-    if args_contin_filter and args_cat_filter:
-        args += ' Where ' + args_contin_filter + ' AND' + args_cat_filter
-    elif args_contin_filter:
-        args += ' Where ' + args_contin_filter
-    elif args_cat_filter:
-        args += ' Where ' + args_cat_filter
-
-    df.drop_duplicates(dup_cols, keep='last', inplace=True)
+    stored = manifest.stored()
+    watermarks = manifest.watermarks()
+    advanced = {}
+    for endpoint in sync_endpoints():
+        last = None
+        for day in days:
+            day_str = str(day.strftime("%Y-%m-%d"))
+            if (endpoint, day_str) not in stored:
+                break
+            last = day_str
+        if last and last > watermarks.get(endpoint, ''):
+            advanced[endpoint] = last
+    manifest.set_watermarks(advanced)
+
+
+def download_data(fb_client, name, day):
+    """
+    Download the data of an endpoint for a day to the cache, if not present
+    :param fb_client: Fitbit Client
+    :param name: type of data, key of ENDPOINTS
+    :param day: day to retrieve
+    :return:
+    """
+    day_str = str(day.strftime("%Y-%m-%d"))
+    if not in_cache(name, day_str):
+        save_to_cache(name, day_str, call_api(name + " " + day_str, ENDPOINTS[name], fb_client, day))
 
-    try:
-        df = pd.merge(df, pd.read_sql(args, engine), how='left', on=dup_cols, indicator=True)
-        df = df[df['_merge'] == 'left_only']
-        df.drop(['_merge'], axis=1, inplace=True)
-        return df
-    except:
-        return df
+
+class DayDownloader(object):
+    """
+    Download all endpoints of the days to process using a pool of workers.
+    Only a window of days ahead of the processing is downloaded, the results
+    are stored in the cache where the processing of a day picks them up.
+    """
+
+    def __init__(self, fb_client, missing, workers, window=None):
+        """
+        Start downloading the first days
+        :param fb_client: Fitbit Client
+        :param missing: endpoints to download per day, in order of processing, see plan_downloads
+        :param workers: number of parallel downloads
+        :param window: number of days downloaded ahead of processing (default twice the workers)
+        """
+        self.fb_client = fb_client
+        self.days = [(day, names) for day, names in missing.items() if names]
+        self.window = window or 2 * workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.schedule()
+
+    def schedule(self):
+        """
+        Start downloading days until the window is filled
+        :return:
+        """
+        while self.days and len(self.futures) < self.window:
+            day, names = self.days.pop(0)
+            self.futures[day] = [self.executor.submit(download_data, self.fb_client, name, day)
+                                 for name in names]
+
+    def wait(self, day):
+        """
+        Wait until the downloads of a day are finished. Errors of a download are raised.
+        :param day: day to wait for
+        :return:
+        """
+        for future in self.futures.pop(day, []):
+            future.result()
+        self.schedule()
+
+    def shutdown(self, cancel=False):
+        """
+        Stop the workers
+        :param cancel: cancel pending downloads and stop workers waiting for the request budget
+        :return:
+        """
+        if cancel:
+            rate_limiter.stop()
+        self.executor.shutdown(wait=not cancel, cancel_futures=cancel)
 
 
 def save_df(dataframe, logdate, filename, tablename, cnx, dup_cols, save_csv=True, save_sql=True):
     """
-    Save a datafram to CSV and SQL
+    Save a datafram to SQL and the output sinks (CSV, Parquet)
     :param dataframe: Dataframe to save
     :param logdate: Day of logging
     :param filename: Filename (path and prefix) for storage, will be appende with date and ".csv"
     :param tablename: Tablename in the SQLite database
-    :param cnx: Connection to the SQLite database
-    :param dup_cols: Column names functioning as primary key for duplicate prevetion, e.g. ["Date", "Log"]
+    :param cnx: Connection to the SQLite database, or TableBatches
+    :param dup_cols: Column names functioning as primary key for duplicate prevention, e.g. ["Date", "Log"]
     :param save_csv: Specifies if data should be stored in CSV (default TRUE)
-    :param save_sql: Specifies if data should be stored in CSV (default FALSE)
+    :param save_sql: Specifies if data should be stored in SQL (default TRUE)
     :return:
     """
     if not dataframe is None:
-        if save_csv:
-            dataframe.to_csv(filename + logdate.replace('-', '') + '.csv', header=True, index=False)
+        for sink in sinks:
+            sink.write(dataframe, logdate, filename if save_csv else None, tablename, dup_cols)
         if save_sql:
-            dataframe_new = clean_df_from_db_duplicates(dataframe, tablename, cnx, dup_cols=dup_cols)
-            dataframe_new.to_sql(name=tablename, con=cnx, if_exists='append', index=False)
+            if isinstance(cnx, TableBatches):
+                cnx.add(dataframe, tablename, dup_cols)
+            else:
+                upsert_df(dataframe, tablename, cnx, dup_cols, update=update_stored)
+
+
+def save_record(record, logdate, filename, tablename, dup_cols, columns=None):
+    """
+    Save a single row of a table to SQL and the output sinks. The row is buffered
+    and written with the other rows of the table when the days are committed.
+    :param record: dict with a value per column, or tuple with the values of columns
+    :param logdate: Day of logging
+    :param filename: Filename (path and prefix) for storage, will be appende with date and ".csv"
+    :param tablename: Tablename in the SQLite database
+    :param dup_cols: Column names functioning as primary key for duplicate prevention, e.g. ["Date", "Log"]
+    :param columns: column names of a tuple record
+    :return:
+    """
+    records.append(tablename, record, logdate, filename, dup_cols, columns)
 
 
+# Intraday activities stored by save_detailed_activities: activity, value column,
+# value type, CSV filename prefix and table
+INTRADAY_ACTIVITIES = [
+    ("floors", 'Floors', np.int32, 'Floors/floors_intraday_', 'Floors_1m'),
+    ("elevation", 'Elevation', np.float64, 'Elevation/elevation_intraday_', 'Elevation_1m'),
+    ("distance", 'Distance', np.float64, 'Distance/distance_intraday_', 'Distance_1m'),
+    ("calories", 'Calories', np.float64, 'Calories/calories_intraday_', 'Calories_1m'),
+]
+
+
+@profiled('save_detailed_activities')
 def save_detailed_activities(fb_client, db_conn, day):
     """
     Download and save detailed activity information from Fitbit API
@@ -231,61 +666,23 @@ def save_detailed_activities(fb_client, db_conn, day):
     :param fb_client: Fitbit Client
     :param db_conn: DB connection
     :param day: day to retrieve
-    :return:
+    :return: dict with the intraday dataframe per value column
     """
     day_str = str(day.strftime("%Y-%m-%d"))
 
     for act in ["calories", "steps", "distance", "floors", "elevation", "activityCalories"]:
+        get_data(fb_client, "activities_" + act, day)
+
+    intraday = {}
+    for act, column, dtype, filename, tablename in INTRADAY_ACTIVITIES:
         act_stats = read_from_cache("activities_" + act, day_str)
-        if not act_stats:
-            act_stats = fb_client.intraday_time_series('activities/' + act, base_date=day_str, detail_level='1min')
-            save_to_cache("activities_" + act, day_str, act_stats, )
-
-    floor_stats = read_from_cache("activities_floors", day_str)
-    date_list = []
-    time_list = []
-    val_list = []
-    for i in floor_stats['activities-floors-intraday']['dataset']:
-        date_list.append(day_str)
-        val_list.append(i['value'])
-        time_list.append(i['time'])
-    floorsdf = pd.DataFrame({'Date': date_list, 'Time': time_list, 'Floors': val_list})
-    save_df(floorsdf, day_str, 'Floors/floors_intraday_', 'Floors_1m', db_conn, ['Date', 'Time'])
-
-    elev_stats = read_from_cache("activities_elevation", day_str)
-    date_list = []
-    time_list = []
-    val_list = []
-    for i in elev_stats['activities-elevation-intraday']['dataset']:
-        date_list.append(day_str)
-        val_list.append(i['value'])
-        time_list.append(i['time'])
-    elevsdf = pd.DataFrame({'Date': date_list, 'Time': time_list, 'Elevation': val_list})
-    save_df(elevsdf, day_str, 'Elevation/elevation_intraday_', 'Elevation_1m', db_conn, ['Date', 'Time'])
-
-    dist_stats = read_from_cache("activities_distance", day_str)
-    date_list = []
-    time_list = []
-    val_list = []
-    for i in dist_stats['activities-distance-intraday']['dataset']:
-        date_list.append(day_str)
-        val_list.append(i['value'])
-        time_list.append(i['time'])
-    distdf = pd.DataFrame({'Date': date_list, 'Time': time_list, 'Distance': val_list})
-    save_df(distdf, day_str, 'Distance/distance_intraday_', 'Distance_1m', db_conn, ['Date', 'Time'])
-
-    cal_stats = read_from_cache("activities_calories", day_str)
-    date_list = []
-    time_list = []
-    val_list = []
-    for i in cal_stats['activities-calories-intraday']['dataset']:
-        date_list.append(day_str)
-        val_list.append(i['value'])
-        time_list.append(i['time'])
-    caldf = pd.DataFrame({'Date': date_list, 'Time': time_list, 'Calories': val_list})
-    save_df(caldf, day_str, 'Calories/calories_intraday_', 'Calories_1m', db_conn, ['Date', 'Time'])
+        act_df = dataset_to_frame(act_stats['activities-' + act + '-intraday']['dataset'], day_str, column, dtype)
+        save_df(act_df, day_str, filename, tablename, db_conn, ['Date', 'Time'])
+        intraday[column] = act_df
+    return intraday
 
 
+@profiled('save_body')
 def save_body(fb_client, db_conn, day):
     """
     Download and save body information from Fitbit API
@@ -297,21 +694,19 @@ def save_body(fb_client, db_conn, day):
     """
     day_str = str(day.strftime("%Y-%m-%d"))
 
-    weight_stats = read_from_cache("weight", day_str)
-    if not weight_stats:
-        weight_stats = fb_client.get_bodyweight(day, period='1d')
-        save_to_cache("weight", day_str, weight_stats)
+    weight_stats = get_data(fb_client, "weight", day)
 
-    body_df = pd.DataFrame({
+    body = {
         'Date': get_dict_element(weight_stats, 'weight', 0, 'date'),
         'Weight': get_dict_element(weight_stats, 'weight', 0, 'weight'),
         'Bodyfat': get_dict_element(weight_stats, 'weight', 0, 'fat'),
         'BMI': get_dict_element(weight_stats, 'weight', 0, 'bmi')
-    }, index=[0])
-    if check_df_field_value(body_df, 'Date', 0, day_str):
-        save_df(body_df, day_str, 'Body/body__', 'Body', db_conn, ['Date'])
+    }
+    if body['Date'] == day_str:
+        save_record(body, day_str, 'Body/body__', 'Body', ['Date'])
 
 
+@profiled('save_activities')
 def save_activities(fb_client, db_conn, day):
     """
     Download and save activity information from Fitbit API
@@ -322,18 +717,10 @@ def save_activities(fb_client, db_conn, day):
     :return:
     """
     day_str = str(day.strftime("%Y-%m-%d"))
-    url = "https://api.fitbit.com/1/user/-/activities/date/{year}-{month}-{day}.json".format(
-        year=day.year,
-        month=day.month,
-        day=day.day
-    )
 
-    act_stats = read_from_cache("activities", day_str)
-    if not act_stats:
-        act_stats = fb_client.make_request(url)  # dict
-        save_to_cache("activities", day_str, act_stats)
+    act_stats = get_data(fb_client, "activities", day)
 
-    log_activities = pd.DataFrame({
+    log_activities = {
         'Date': day_str,
         'Goal Active Minutes': get_dict_element(act_stats, 'goals', 'activeMinutes'),
         'Goal Calories Out': get_dict_element(act_stats, 'goals', 'caloriesOut'),
@@ -354,43 +741,22 @@ def save_activities(fb_client, db_conn, day):
         'Lightly Active Minutes': act_stats['summary']['lightlyActiveMinutes'],
         'Fairly Active Minutes': act_stats['summary']['fairlyActiveMinutes'],
         'Very Active Minutes': act_stats['summary']['veryActiveMinutes']
-    }, index=[0])
+    }
 
-    save_df(log_activities, day_str, 'Activities/activities_summary_', 'Activities_Summary', db_conn, ['Date'])
+    save_record(log_activities, day_str, 'Activities/activities_summary_', 'Activities_Summary', ['Date'])
 
-    desc_list = []
-    val_list = []
-    date_list = []
     for rec in act_stats['summary']['distances']:
-        date_list.append(day_str)
-        desc_list.append(rec['activity'])
-        val_list.append(rec['distance'])
-    dist_df = pd.DataFrame({'Date': date_list, 'Activity': desc_list, 'Distance': val_list})
-    save_df(dist_df, day_str, 'Activities/distance_', 'Distance', db_conn, ['Date', 'Activity'])
-
-    desc_list = []
-    val_list = []
-    date_list = []
-    id_list = []
-    min_list = []
-    max_list = []
-    cal_list = []
-    i = 0
-    for rec in act_stats['summary']['heartRateZones']:
-        date_list.append(day_str)
-        id_list.append(i)
-        desc_list.append(rec['name'])
-        val_list.append(rec['minutes'])
-        min_list.append(rec['min'])
-        max_list.append(rec['max'])
-        cal_list.append(rec['caloriesOut'])
-        i = i + 1
-    hr_df = pd.DataFrame({'Date': date_list, 'Name': desc_list, 'ID': id_list, 'Minutes': min_list,
-                          'Calories': cal_list, 'Min': min_list, 'Max': max_list})
-
-    save_df(hr_df, day_str, 'Activities/hr_zones_', 'HeartRate_Zones', db_conn, ['Date', 'Name'])
+        save_record((day_str, rec['activity'], rec['distance']),
+                    day_str, 'Activities/distance_', 'Distance', ['Date', 'Activity'],
+                    columns=['Date', 'Activity', 'Distance'])
+
+    for i, rec in enumerate(act_stats['summary']['heartRateZones']):
+        save_record((day_str, rec['name'], i, rec['minutes'], rec['caloriesOut'], rec['min'], rec['max']),
+                    day_str, 'Activities/hr_zones_', 'HeartRate_Zones', ['Date', 'Name'],
+                    columns=['Date', 'Name', 'ID', 'Minutes', 'Calories', 'Min', 'Max'])
 
 
+@profiled('save_training')
 def save_training(fb_client, db_conn, day):
     """
     Download and save training activitites from Fitbit API
@@ -401,20 +767,13 @@ def save_training(fb_client, db_conn, day):
     :return:
     """
     day_str = str(day.strftime("%Y-%m-%d"))
-    day_after = day + datetime.timedelta(days=1)
-    day_after_str = str(day_after.strftime("%Y-%m-%d"))
 
-    training_stats = read_from_cache("training", day_str)
-    if not training_stats:
-        url = "https://api.fitbit.com/1/user/-/activities/list.json?beforeDate=" + \
-              day_after_str + "&sort=desc&offset=0&limit=10"
-        training_stats = fb_client.make_request(url)  # dict
-        save_to_cache("training", day_str, training_stats)
+    training_stats = get_data(fb_client, "training", day)
 
     for act in training_stats['activities']:
         start_time = act['startTime'][:26] + act['startTime'][27:]  # Remove : from timezone
         if start_time[:10] == day_str:
-            train_df = pd.DataFrame({
+            training = {
                 'Date': day_str,
                 'ID': get_dict_element(act, 'logId'),
                 'Start': start_time,
@@ -433,10 +792,11 @@ def save_training(fb_client, db_conn, day):
                 'ActivityLevel1': get_dict_element(act, 'activityLevel', 1, 'minutes'),
                 'ActivityLevel2': get_dict_element(act, 'activityLevel', 2, 'minutes'),
                 'ActivityLevel3': get_dict_element(act, 'activityLevel', 3, 'minutes'),
-            }, index=[0])
-            save_df(train_df, day_str, 'Training/training_', 'Training', db_conn, ['ID'])
+            }
+            save_record(training, day_str, 'Training/training_', 'Training', ['ID'])
 
 
+@profiled('save_sleep')
 def save_sleep(fb_client, db_conn, day):
     """
     Download and save sleep from Fitbit API
@@ -448,15 +808,10 @@ def save_sleep(fb_client, db_conn, day):
     """
     day_str = str(day.strftime("%Y-%m-%d"))
 
-    sleep_stats = read_from_cache("sleep", day_str)
-    if not sleep_stats:
-        sleep_stats = fb_client.get_sleep(day)
-        save_to_cache("sleep", day_str, sleep_stats)
-
-    log_stats = None
-    i = 0
-    for rec in sleep_stats['sleep']:
-        log_stats2 = pd.DataFrame({
+    sleep_stats = get_data(fb_client, "sleep", day)
+
+    for i, rec in enumerate(sleep_stats['sleep']):
+        save_record({
             'Date': rec['dateOfSleep'],
             'Log Count': i,
             'Start Time': rec['startTime'],
@@ -475,16 +830,10 @@ def save_sleep(fb_client, db_conn, day):
             'Minutes To Fall Asleep': rec['minutesToFallAsleep'],
             'Restless Count': rec['restlessCount'],
             'Restless Duration': rec['restlessDuration']
-        }, index=[0])
-        if i > 0:
-            log_stats.append(log_stats2)
-        else:
-            log_stats = log_stats2.copy()
-        i = i + 1
-    save_df(log_stats, day_str, 'Sleep/sleep_statistics_', 'Sleep', db_conn, ['Date', 'Log Count'])
+        }, day_str, 'Sleep/sleep_statistics_', 'Sleep', ['Date', 'Log Count'])
 
     # check if stages are present
-    summary = pd.DataFrame({
+    summary = {
         'Date': get_dict_element(sleep_stats, 'sleep', 0, 'dateOfSleep'),
         'Minutes Asleep': get_dict_element(sleep_stats, 'summary', 'totalMinutesAsleep'),
         'Sleep Records': get_dict_element(sleep_stats, 'summary', 'totalSleepRecords'),
@@ -493,25 +842,24 @@ def save_sleep(fb_client, db_conn, day):
         'Stage Light': get_dict_element(sleep_stats, 'summary', 'stages', 'light'),
         'Stage REM': get_dict_element(sleep_stats, 'summary', 'stages', 'rem'),
         'Stage Wake': get_dict_element(sleep_stats, 'summary', 'stages', 'wake')
-    }, index=[0])
-    save_df(summary, day_str, 'Sleep/sleep_summary_', 'Sleep_Summary', db_conn, ['Date'])
+    }
+    save_record(summary, day_str, 'Sleep/sleep_summary_', 'Sleep_Summary', ['Date'])
 
-    time_list = []
-    val_list = []
-    date_list = []
-    logid_list = []
+    sleepmin_dfs = []
     for sleep_log in sleep_stats['sleep']:
-        logid = sleep_log['logId']
-        for i in sleep_log['minuteData']:
-            date_list.append(day_str)
-            logid_list.append(logid)
-            val_list.append(i['value'])
-            time_list.append(i['dateTime'])
-    sleepmin_df = pd.DataFrame({'Date': date_list, 'LogID': logid_list, 'Time': time_list, 'Value': val_list})
+        log_df = dataset_to_frame(sleep_log['minuteData'], day_str, 'Value', time_key='dateTime')
+        log_df.insert(1, 'LogID', np.int64(sleep_log['logId']))
+        sleepmin_dfs.append(log_df)
+    if sleepmin_dfs:
+        sleepmin_df = pd.concat(sleepmin_dfs)
+    else:
+        sleepmin_df = dataset_to_frame([], day_str, 'Value', time_key='dateTime')
+        sleepmin_df.insert(1, 'LogID', np.int64(0))
     sleepmin_df['interpreted'] = sleepmin_df['Value'].map({'2': 'Restless', '3': 'Awake', '1': 'Asleep'})
     save_df(sleepmin_df, day_str, 'Sleep/sleep_minlog_', 'Sleep_1m', db_conn, ['Date', 'LogID', 'Time'])
 
 
+@profiled('save_steps')
 def save_steps(fb_client, db_conn, day):
     """
     Download and save steps from Fitbit API
@@ -519,51 +867,41 @@ def save_steps(fb_client, db_conn, day):
     :param fb_client: Fitbit Client
     :param db_conn: DB connection
     :param day: day to retrieve
-    :return:
+    :return: dict with the intraday dataframe per value column
     """
     day_str = str(day.strftime("%Y-%m-%d"))
 
-    step_stats = read_from_cache("steps_1m", day_str)
-    if not step_stats:
-        step_stats = fb_client.intraday_time_series('activities/steps', base_date=day_str, detail_level='1min')
-        save_to_cache("steps_1m", day_str, step_stats)
-
-    date_list = []
-    time_list = []
-    val_list = []
-    for i in step_stats['activities-steps-intraday']['dataset']:
-        date_list.append(day_str)
-        val_list.append(i['value'])
-        time_list.append(i['time'])
-    stepsdf = pd.DataFrame({'Date': date_list, 'Time': time_list, 'Steps': val_list})
+    step_stats = get_data(fb_client, "steps_1m", day)
+
+    stepsdf = dataset_to_frame(step_stats['activities-steps-intraday']['dataset'], day_str, 'Steps', np.int32)
     save_df(stepsdf, day_str, 'Steps/steps_intraday_', 'Steps_1m', db_conn, ['Date', 'Time'])
 
-    summary = pd.DataFrame({
+    summary = {
         'Date': step_stats['activities-steps'][0]['dateTime'],
         'Steps': step_stats['activities-steps'][0]['value']
-        }, index=[0])
-    save_df(summary, day_str, 'Steps/steps_daysummary_', 'Steps_Summary', db_conn, ['Date'])
+        }
+    save_record(summary, day_str, 'Steps/steps_daysummary_', 'Steps_Summary', ['Date'])
+    return {'Steps': stepsdf}
 
 
+@profiled('save_heart')
 def save_heart(fb_client, db_conn, day):
+    """
+    Download and save heart rate from Fitbit API
+    Stores intraday heart rate, granularity 1 min and day summary
+    :param fb_client: Fitbit Client
+    :param db_conn: DB connection
+    :param day: day to retrieve
+    :return: dict with the intraday dataframe per value column
+    """
     day_str = str(day.strftime("%Y-%m-%d"))
 
-    hr_stats = read_from_cache("heart_1m", day_str)
-    if not hr_stats:
-        hr_stats = fb_client.intraday_time_series('activities/heart', base_date=day_str, detail_level='1min')
-        save_to_cache("heart_1m", day_str, hr_stats)
-
-    time_list = []
-    val_list = []
-    date_list = []
-    for i in hr_stats['activities-heart-intraday']['dataset']:
-        date_list.append(day_str)
-        val_list.append(i['value'])
-        time_list.append(i['time'])
-    heartdf = pd.DataFrame({'Date': date_list, 'Time': time_list, 'Heart Rate': val_list})
+    hr_stats = get_data(fb_client, "heart_1m", day)
+
+    heartdf = dataset_to_frame(hr_stats['activities-heart-intraday']['dataset'], day_str, 'Heart Rate', np.int32)
     save_df(heartdf, day_str, 'Heart/heart_intraday_', 'Heartrate', db_conn, ['Date', 'Time'])
 
-    summary = pd.DataFrame({
+    summary = {
         'Date': hr_stats['activities-heart'][0]['dateTime'],
         'Resting Heart Rate': get_dict_element(hr_stats['activities-heart'][0]['value'], ['restingHeartRate']),
 
@@ -590,11 +928,13 @@ def save_heart(fb_client, db_conn, day):
         'Zone3 Min': hr_stats['activities-heart'][0]['value']['heartRateZones'][3]['min'],
         'Zone3 Minutes': hr_stats['activities-heart'][0]['value']['heartRateZones'][3]['minutes'],
         'Zone3 Name': hr_stats['activities-heart'][0]['value']['heartRateZones'][3]['name']
-    }, index=[0])
+    }
 
-    save_df(summary, day_str, 'Heart/heart_daysummary_', 'Heartrate_Summary', db_conn, ['Date'])
+    save_record(summary, day_str, 'Heart/heart_daysummary_', 'Heartrate_Summary', ['Date'])
+    return {'Heart Rate': heartdf}
 
 
+@profiled('create_daily_summary')
 def create_daily_summary(day, db_conn):
     """
     Create a daily summary in the corresponding table
@@ -621,7 +961,7 @@ def create_daily_summary(day, db_conn):
             mainsleep_stats = rec2
 
     # Create summary dataframe
-    summary = pd.DataFrame({
+    summary = {
         'Date': day_str,
 
         'Goal Active Minutes': get_dict_element(act_stats, 'goals', 'activeMinutes'),
@@ -694,40 +1034,268 @@ def create_daily_summary(day, db_conn):
         'Sleep Restless Count': get_dict_element(mainsleep_stats, 'restlessCount'),
         'Sleep Restless Duration': get_dict_element(mainsleep_stats, 'restlessDuration')
 
-    }, index=[0])
+    }
     #
     # Add main sleep
     #
-    save_df(summary, day_str, 'Daily/daily_summary_', 'Daily_Summary', db_conn, ['Date'])
+    save_record(summary, day_str, 'Daily/daily_summary_', 'Daily_Summary', ['Date'])
+
+
+def update_token(token):
+    """
+    Called by the Fitbit client after the access token is refreshed, stores the new token
+    :param token: the new token
+    :return:
+    """
+    if tokens.save(token):
+        print("Access token refreshed")
 
 
-def get_fitbit_client(fb_id, fb_secret):
+def authorize_in_browser(fb_id, fb_secret):
+    """
+    Let the user authorize the application in the browser
+    :param fb_id: Fitbit client ID
+    :param fb_secret: Fitbit client secret
+    :return: token (dict)
+    """
+    if Oauth2 is None:
+        raise RuntimeError("Authorization in the browser needs gather_keys_oauth2 (python-fitbit) and cherrypy")
     server = Oauth2.OAuth2Server(fb_id, fb_secret)
     server.browser_authorize()
-    access_token = str(server.fitbit.client.session.token['access_token'])
-    refresh_token = str(server.fitbit.client.session.token['refresh_token'])
-    client = fitbit.Fitbit(fb_id, fb_secret, oauth2=True, access_token=access_token,
-                           refresh_token=refresh_token, system="en_UK")
     # Keep cherry webserver log and app log seperated
     time.sleep(1)
+    return dict(server.fitbit.client.session.token)
+
+
+def get_fitbit_client(fb_id, fb_secret, workers=1, authorize=False):
+    """
+    Create a Fitbit client with the stored token. Only without a stored token,
+    or if asked, the user authorizes the application in the browser first.
+    Expired tokens are refreshed and stored again while downloading.
+    :param fb_id: Fitbit client ID
+    :param fb_secret: Fitbit client secret
+    :param workers: number of parallel downloads, the size of the connection pool
+    :param authorize: authorize in the browser, also if a token is stored
+    :return: Fitbit Client
+    """
+    token = None if authorize else tokens.load()
+    if token is None:
+        token = authorize_in_browser(fb_id, fb_secret)
+        tokens.save(token)
+    client = fitbit.Fitbit(fb_id, fb_secret, oauth2=True, access_token=token['access_token'],
+                           refresh_token=token['refresh_token'], expires_at=token.get('expires_at'),
+                           refresh_cb=update_token, system="en_UK")
+    configure_session(client, workers)
+    watch_rate_limit(client, rate_limiter)
+    serialize_token_refresh(client)
+    retry_unauthorized(client, tokens.load)
     return client
 
 
-def save_fitbit_data(fitbit_client, database_connection, day):
+# Processing steps of a day: name, save function and the endpoints it stores, which
+# are recorded in the manifest. The steps minute (save_minute_table) and daily_summary
+# (create_daily_summary) are derived from these and recorded under their own name.
+SAVE_STEPS = [
+    ("intraday_activities", save_detailed_activities,
+     ["activities_calories", "activities_steps", "activities_distance", "activities_floors",
+      "activities_elevation", "activities_activityCalories"]),
+    ("body", save_body, ["weight"]),
+    ("sleep", save_sleep, ["sleep"]),
+    ("activities", save_activities, ["activities"]),
+    ("steps", save_steps, ["steps_1m"]),
+    ("training", save_training, ["training"]),
+    ("heart", save_heart, ["heart_1m"]),
+]
+
+# Steps returning the intraday dataframes combined in the Minute table
+MINUTE_INPUT_STEPS = ["intraday_activities", "steps", "heart"]
+
+# Endpoints read by create_daily_summary
+DAILY_SUMMARY_ENDPOINTS = ["activities", "sleep", "heart_1m"]
+
+# Tables written per step, and by the Minute table and the daily summary
+STEP_TABLES = {
+    "intraday_activities": [tablename for _, _, _, _, tablename in INTRADAY_ACTIVITIES],
+    "body": ["Body"],
+    "sleep": ["Sleep", "Sleep_Summary", "Sleep_1m"],
+    "activities": ["Activities_Summary", "Distance", "HeartRate_Zones"],
+    "steps": ["Steps_1m", "Steps_Summary"],
+    "training": ["Training"],
+    "heart": ["Heartrate", "Heartrate_Summary"],
+    "minute": ["Minute"],
+    "daily_summary": ["Daily_Summary"],
+}
+
+
+def delete_step_rows(db_conn, step, day):
+    """
+    Delete the rows a step saved for a day, before the step saves the day again
+    :param db_conn: DB connection
+    :param step: name of the step, see STEP_TABLES
+    :param day: the day (datetime.date)
+    :return:
+    """
+    for tablename in STEP_TABLES[step]:
+        delete_day(db_conn, tablename, day)
+
+
+def save_fitbit_data(fitbit_client, database_connection, day, steps=None):
     """
-    Download and save the fitbit data for a specific day
+    Download and save the fitbit data for a specific day, and record the
+    stored endpoints in the manifest
     :param fitbit_client: Fitbit API Client
     :param database_connection: Connection to the database
     :param day: day to retrieve (type: Datetime object)
+    :param steps: names of the steps to do, see plan_days (default all)
     :return:
     """
-    save_detailed_activities(fitbit_client, database_connection, day)
-    save_body(fitbit_client, database_connection, day)
-    save_sleep(fitbit_client, database_connection, day)
-    save_activities(fitbit_client, database_connection, day)
-    save_steps(fitbit_client, database_connection, day)
-    save_training(fitbit_client, database_connection, day)
-    save_heart(fitbit_client, database_connection, day)
+    day_str = str(day.strftime("%Y-%m-%d"))
+    # The data of changed responses is saved again, rows no longer in the new response are removed
+    outdated = set() if isinstance(database_connection, TableBatches) else manifest.outdated(day_str)
+    intraday = {}
+    for name, function, endpoints in SAVE_STEPS:
+        if steps is None or name in steps:
+            if outdated.intersection(endpoints):
+                delete_step_rows(database_connection, name, day)
+            frames = function(fitbit_client, database_connection, day)
+            if frames:
+                intraday.update(frames)
+            manifest.mark_stored([(endpoint, day_str) for endpoint in endpoints])
+    if minute_table_enabled and (steps is None or "minute" in steps):
+        if "minute" in outdated:
+            delete_step_rows(database_connection, "minute", day)
+        save_minute_table(intraday, database_connection, day)
+        manifest.mark_stored([("minute", day_str)])
+    if steps is None or "daily_summary" in steps:
+        # The summary reads the responses from the cache
+        for name in DAILY_SUMMARY_ENDPOINTS:
+            get_data(fitbit_client, name, day)
+        if "daily_summary" in outdated:
+            delete_step_rows(database_connection, "daily_summary", day)
+        create_daily_summary(day, database_connection)
+        manifest.mark_stored([("daily_summary", day_str)])
+
+
+def adopt_stored_days(db_conn):
+    """
+    Record the days stored by a version without manifest: all steps of the days
+    with a daily summary, and the Minute table of the days present in it
+    :param db_conn: DB connection
+    :return:
+    """
+    endpoints = step_endpoints(set(name for name, _, _ in SAVE_STEPS)) + ["daily_summary"]
+    entries = [(endpoint, day_str) for day_str in present_dates(db_conn, 'Daily_Summary') for endpoint in endpoints]
+    entries += [("minute", day_str) for day_str in present_minute_dates(db_conn)]
+    manifest.mark_stored(entries)
+
+
+@profiled('save_minute_table')
+def save_minute_table(intraday, db_conn, day):
+    """
+    Save all 1 minute values of a day in a single row per minute,
+    keyed by the number of minutes since 1970-01-01 (local time)
+    :param intraday: dict with the intraday dataframe per value column
+    :param db_conn: DB connection
+    :param day: day of the data
+    :return:
+    """
+    day_str = str(day.strftime("%Y-%m-%d"))
+    minute_df = combine_minutes(intraday, day, MINUTE_COLUMNS)
+    save_df(minute_df, day_str, None, 'Minute', db_conn, ['Minute'], save_csv=False)
+
+
+def init_rebuild_worker(cache_backend, compress_cache, minute_table, csv_enabled, profile=False, trace=False):
+    """
+    Configure a worker process of a rebuild
+    :param cache_backend: name of the cache backend
+    :param compress_cache: write compressed cache entries
+    :param minute_table: store the Minute table
+    :param csv_enabled: write the CSV files, the other sinks are written by the main process
+    :param profile: count the stages, see fitbit_profile
+    :param trace: record the trace events of the stages
+    :return:
+    """
+    global cache, minute_table_enabled, sinks, records
+    cache = MemoryCache(open_cache(cache_backend, compress=compress_cache))
+    minute_table_enabled = minute_table
+    sinks = [CSVSink()] if csv_enabled else []
+    records = RecordBuffer(sinks)
+    if profile:
+        profiler.enable(trace)
+
+
+def rebuild_days(days):
+    """
+    Parse the cached data of days into table batches, runs in a worker process of a rebuild
+    :param days: days to parse
+    :return: TableBatches, and the profile of the worker (see Profiler.take)
+    """
+    global manifest
+    batches = TableBatches()
+    manifest = batches
+    for day in days:
+        save_fitbit_data(None, batches, day)
+    records.flush(batches)
+    batches.combine()
+    return batches, profiler.take()
+
+
+def rebuild_database(storage, workers, cache_backend, compress_cache, chunk_days=30):
+    """
+    Store all days with complete data in the cache again, e.g. after a change of the
+    schema. Days are parsed in parallel by a pool of worker processes, the batches
+    of tables they return are written by this process only.
+    :param storage: StorageSession of the database
+    :param workers: number of worker processes
+    :param cache_backend: name of the cache backend
+    :param compress_cache: write compressed cache entries
+    :param chunk_days: number of days parsed per task
+    :return:
+    """
+    cached = cached_entries()
+    endpoints = [SAME_REQUEST.get(name, name) for name in step_endpoints(set(
+        [name for name, _, _ in SAVE_STEPS] + ["daily_summary"]))]
+    dates = sorted(set(date for _, date in cached))
+    days = [datetime.datetime.strptime(date, "%Y-%m-%d").date() for date in dates
+            if all((name, date) in cached for name in endpoints)]
+    print("Rebuilding {} days ({} days with incomplete cache skipped)".format(len(days), len(dates) - len(days)))
+    chunks = [days[j:j + chunk_days] for j in range(0, len(days), chunk_days)]
+    csv_enabled = any(isinstance(sink, CSVSink) for sink in sinks)
+    writer_sinks = [sink for sink in sinks if not isinstance(sink, CSVSink)]
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_rebuild_worker,
+                                   initargs=(cache_backend, compress_cache, minute_table_enabled, csv_enabled,
+                                             profiler.enabled, profiler.trace))
+    pending = set()
+    done_days = 0
+    try:
+        while chunks or pending:
+            # Parse at most two chunks per worker ahead of the writer
+            while chunks and len(pending) < 2 * workers:
+                pending.add(executor.submit(rebuild_days, chunks.pop(0)))
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                batches, profile = future.result()
+                profiler.merge(profile)
+                batches.write(storage.connection, manifest, update=True, sinks=writer_sinks)
+                dates = set(date for _, date in batches.stored_entries)
+                storage.aggregates.add_days(dates)
+                storage.commit()
+                done_days += len(dates)
+                print("Rebuilt {} of {} days".format(done_days, len(days)))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def report_profile(trace_file=None):
+    """
+    Print the profile of the run, and write the trace file
+    :param trace_file: name of the trace file, or None
+    :return:
+    """
+    profiler.report()
+    if trace_file:
+        profiler.write_trace(trace_file)
+        print("Trace written to " + trace_file)
 
 
 def get_arguments():
@@ -737,103 +1305,218 @@ def get_arguments():
     """
     yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
     parser = argparse.ArgumentParser(description='Fitbit Scraper')
-    parser.add_argument('--id', metavar='clientId', dest='clientId', required=True,
-                        help="client-id of your Fitbit app")
-    parser.add_argument('--secret', metavar='clientSecret', dest='clientSecret', required=True,
-                        help="client-secret of your Fitbit app")
+    parser.add_argument('command', nargs='?', choices=['download', 'sync', 'rebuild'], default='download',
+                        help="download data (default), sync the days since the last sync, "
+                             "or rebuild the database from the cache")
+    parser.add_argument('--id', metavar='clientId', dest='clientId',
+                        help="client-id of your Fitbit app (required to download)")
+    parser.add_argument('--secret', metavar='clientSecret', dest='clientSecret',
+                        default=os.environ.get(SECRET_VARIABLE),
+                        help="client-secret of your Fitbit app (required to download), "
+                             "default the environment variable " + SECRET_VARIABLE)
     parser.add_argument('--first', dest='firstDate', default="2017-09-24",
                         help="Date (YYYY-MM-DD) of oldest Fitbit data")
     parser.add_argument('--start', dest='startDate', default=yesterday,
                         help="Date (YYYY-MM-DD) from which to start the backward scraping. Default is today")
     parser.add_argument('--limit', type=int, dest='limit', default=7,
                         help="maximum number of days to download. Default is 7")
+    parser.add_argument('--refetch-days', type=int, dest='refetch_days', default=3,
+                        help="number of most recent days a sync downloads again, to pick up late synced data. "
+                             "Default is 3")
     parser.add_argument('--online', dest='online', action='store_true')
     parser.add_argument('--offline', dest='online', action='store_false')
     parser.set_defaults(online=True)
     parser.add_argument('--no-cache', dest='cache', action='store_false',
                         help='Do not use cached results but always download all data (cache is still updated')
     parser.set_defaults(cache=True)
-    return parser.parse_args()
+    parser.add_argument('--cache-backend', dest='cache_backend', choices=BACKENDS, default="files",
+                        help="storage of the cache: a JSON file per response or a single SQLite file. "
+                             "Default is files")
+    parser.add_argument('--compress-cache', dest='compress_cache', action='store_true',
+                        help="store new cache files compressed (files backend, sqlite is always compressed)")
+    parser.add_argument('--cache-entries', type=int, dest='cache_entries', default=256,
+                        help="number of recently used cache entries kept in memory. Default is 256")
+    parser.add_argument('--minute-table', dest='minute_table', action='store_true',
+                        help="also store all 1 minute values in a single table Minute")
+    parser.add_argument('--workers', type=int, dest='workers',
+                        help="number of parallel downloads (default 1), or processes of a rebuild "
+                             "(default the number of CPUs)")
+    parser.add_argument('--commit-days', type=int, dest='commit_days', default=1,
+                        help="number of days stored per database commit. Default is 1")
+    parser.add_argument('--no-csv', dest='csv', action='store_false',
+                        help="do not write a CSV file per table per day")
+    parser.add_argument('--parquet', dest='parquet', action='store_true',
+                        help="write a Parquet dataset per table, partitioned by year and month (needs pyarrow)")
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help="print the time, calls and bytes per stage of the processing at the end")
+    parser.add_argument('--profile-trace', metavar='FILE', dest='profile_trace',
+                        help="also write every call of a stage to a trace file (Chrome trace format)")
+    parser.add_argument('--token-file', metavar='FILE', dest='token_file', default=TOKEN_FILE,
+                        help="file storing the Fitbit token, so a download starts without authorization in the browser")
+    parser.add_argument('--authorize', dest='authorize', action='store_true',
+                        help="authorize in the browser, also if a token is stored")
+    parser.add_argument('--accounts', metavar='FILE', dest='accounts',
+                        help="download all accounts of a configuration file, every account in its own directory "
+                             "and process, see fitbit_accounts.py")
+    args = parser.parse_args()
+    if args.accounts is None and args.command != 'rebuild' and args.online and \
+            (args.clientId is None or args.clientSecret is None):
+        parser.error("--id and --secret are required to download")
+    if args.parquet and pyarrow is None:
+        parser.error("--parquet needs the pyarrow package")
+    return args
 
 
 if __name__ == "__main__":
 
     # Parse and handle application arguments
     arguments = get_arguments()
+    if arguments.accounts:
+        # Every account is downloaded by a process of this application, with the other arguments
+        results = run_accounts(arguments.accounts, without_option(sys.argv[1:], '--accounts'))
+        for name, code in results.items():
+            print("Account {:<16} : {}".format(name, "ok" if code == 0 else "failed (exit code {})".format(code)))
+        sys.exit(0 if all(code == 0 for code in results.values()) else 1)
     FB_ID = arguments.clientId
     FB_SECRET = arguments.clientSecret
     start_date = datetime.datetime.strptime(arguments.startDate, "%Y-%m-%d").date()
     first_date_of_data = datetime.datetime.strptime(arguments.firstDate, "%Y-%m-%d").date()
     limit = arguments.limit
-    online = arguments.online
-    cache_enabled = arguments.cache
+    rebuild = arguments.command == 'rebuild'
+    sync = arguments.command == 'sync'
+    update_stored = sync
+    # A rebuild only uses the cache
+    online = arguments.online and not rebuild
+    cache_enabled = arguments.cache or rebuild
+    workers = arguments.workers or (os.cpu_count() if rebuild else 1)
+    minute_table_enabled = arguments.minute_table
+    tokens = TokenFile(arguments.token_file)
+    if arguments.profile or arguments.profile_trace:
+        profiler.enable(trace=arguments.profile_trace is not None)
+        # Reported at every exit, also after an error
+        atexit.register(report_profile, arguments.profile_trace)
+    sinks = ([CSVSink()] if arguments.csv else []) + ([ParquetSink()] if arguments.parquet else [])
+    records = RecordBuffer(sinks, update=update_stored)
+    cache = MemoryCache(open_cache(arguments.cache_backend, compress=arguments.compress_cache),
+                        max_entries=arguments.cache_entries)
 
     # Assure directories are present to store the data
     create_directories()
 
     # Get a Fitbit client, but only if onlie is enabled
     if online:
-        auth2_client = get_fitbit_client(FB_ID, FB_SECRET)
+        auth2_client = get_fitbit_client(FB_ID, FB_SECRET, workers, arguments.authorize)
     else:
         auth2_client = None
 
     # Shoe download configuration
     print("Configuration")
     print("------------------------------------------------")
-    print("Fitbit ID        : " + FB_ID)
-    print("Fitbit Secret    : " + FB_SECRET)
+    print("Command          : " + arguments.command)
+    print("Fitbit ID        : " + str(FB_ID))
+    print("Fitbit Secret    : " + str(FB_SECRET))
     print("Oldest available : " + first_date_of_data.strftime("%Y-%m-%d"))
     print("Online           : " + str(online))
     print("Cache            : " + str(cache_enabled))
+    print("Cache backend    : " + arguments.cache_backend)
     print("Start date       : " + start_date.strftime("%Y-%m-%d"))
     print("Day limit        : " + str(limit))
+    print("Workers          : " + str(workers))
+    print("Commit per days  : " + str(arguments.commit_days))
+    print("Output files     : " + (', '.join(sink.__class__.__name__[:-4] for sink in sinks) or "None"))
+    print("Profile          : " + str(profiler.enabled))
     print("------------------------------------------------")
 
-    for j in range(0, limit):
-        # Open database connection per data
-        # Prevents accidental data loss
-        db_connection = sqlite3.connect('data/fitbit.db')
-        day_to_retrieve = start_date - datetime.timedelta(days=j)
-
-        # Retry a date if the fitbit max request error occurs
-        day_handled = False
-        while not day_handled:
-            try:
-                # Only retrieve if there is data for this date
-                # Prevents reading before the data Fitbit data is available
-                # If summary record ia available, do not read
-                # if True:
-                if day_to_retrieve >= first_date_of_data and not day_present(db_connection, day_to_retrieve):
-                    print("Downloading day {} : {}".format(j, day_to_retrieve.strftime("%Y-%m-%d")))
-                    save_fitbit_data(auth2_client, db_connection, day_to_retrieve)
-                    create_daily_summary(day_to_retrieve, db_connection)
-                else:
-                    print("Skipping day {} : {}".format(j, day_to_retrieve.strftime("%Y-%m-%d")))
-                # Retrievel is succesfull so continu to next day
-                day_handled = True
-
-            except fitbit.exceptions.HTTPTooManyRequests:
-                # Too many request to the Fitbit API, sleep and retry
-                print("Too many request, time to sleep")
-                time.sleep(300)
-
-            # except ???:
-            #     # access token no longer valid. Retrieve new token
-            #     # and retry download
-            #     auth2_client = get_fitbit_client(FB_ID, FB_SECRET)
-
-            except Exception as e:
-                # Unexpected error. Print the error and exit the application
-                # Detailed error information is printed to ease problem solving
-                print("Exception : " + str(e))
-                traceback.print_exc()
-                print("")
-                error = traceback.format_exc()
-                print(error.upper())
-                print("Goodbye!")
-                exit()
-            finally:
-                # Close database connection and commit changes
-                db_connection.commit()
-
-    db_connection.close()
\ No newline at end of file
+    # One connection for the whole download, a database created by an older
+    # version is converted to the current schema
+    storage = StorageSession('data/fitbit.db', commit_days=arguments.commit_days, records=records,
+                             aggregates=Aggregates(), sinks=sinks)
+    if storage.version < SCHEMA_VERSION:
+        print("Database converted to schema version " + str(SCHEMA_VERSION))
+    db_connection = storage.connection
+    manifest = Manifest(db_connection)
+    if storage.version < MANIFEST_VERSION:
+        adopt_stored_days(db_connection)
+    if storage.version < AGGREGATES_VERSION:
+        # Aggregates of the days stored by an older version, computed with the first commit
+        storage.aggregates.add_days(present_dates(db_connection, 'Daily_Summary'))
+
+    if rebuild:
+        rebuild_database(storage, workers, arguments.cache_backend, arguments.compress_cache)
+        storage.close()
+        for sink in sinks:
+            sink.close()
+        cache.close()
+        exit()
+
+    # Process only the steps of a day not stored yet, and only for days for which
+    # Fitbit data is available. Endpoints that accept a range of days are downloaded
+    # first, the other endpoints are downloaded in parallel if multiple workers are
+    # used. Days are processed below in order, using the downloaded data from the cache.
+    if sync:
+        # Days since the last sync up to today, and the most recent days fetched again
+        days, refetch = plan_sync(datetime.date.today(), first_date_of_data, arguments.refetch_days)
+        print("Days to sync     : {} ({} to fetch again)".format(len(days), len(refetch)))
+        if online:
+            fetched, changed = refetch_responses(auth2_client, refetch)
+            print("Fetched again    : {} responses, {} changed".format(fetched, changed))
+    else:
+        days = [start_date - datetime.timedelta(days=j) for j in range(0, limit)]
+    days_to_process = plan_days([day for day in days if day >= first_date_of_data])
+    missing_downloads = plan_downloads(days_to_process, cached_entries())
+    all_steps = len(SAVE_STEPS) + (2 if minute_table_enabled else 1)
+    partial_days = [day for day, steps in days_to_process.items() if len(steps) < all_steps]
+    print("Days to process  : {} ({} partially stored)".format(len(days_to_process), len(partial_days)))
+    downloader = None
+    if online:
+        download_ranges(auth2_client, missing_downloads)
+        if workers > 1:
+            downloader = DayDownloader(auth2_client, missing_downloads, workers)
+
+    for j, day_to_retrieve in enumerate(days):
+        try:
+            # Only retrieve if there is data for this date
+            # Prevents reading before the data Fitbit data is available
+            # If all steps of the day are stored, do not read
+            # Requests refused by the rate limit are retried in get_data,
+            # expired or invalid access tokens are refreshed by the client
+            if day_to_retrieve in days_to_process:
+                print("Downloading day {} : {}".format(j, day_to_retrieve.strftime("%Y-%m-%d")))
+                if downloader:
+                    downloader.wait(day_to_retrieve)
+                # All data of a day is stored, or nothing
+                storage.begin_day()
+                save_fitbit_data(auth2_client, db_connection, day_to_retrieve, days_to_process[day_to_retrieve])
+                storage.aggregates.add_days([day_to_retrieve.strftime("%Y-%m-%d")])
+                storage.end_day()
+            else:
+                print("Skipping day {} : {}".format(j, day_to_retrieve.strftime("%Y-%m-%d")))
+
+        except Exception as e:
+            # Unexpected error. Print the error and exit the application
+            # Detailed error information is printed to ease problem solving
+            print("Exception : " + str(e))
+            traceback.print_exc()
+            print("")
+            error = traceback.format_exc()
+            print(error.upper())
+            print("Goodbye!")
+            if downloader:
+                downloader.shutdown(cancel=True)
+            # Keep the days stored before the error
+            if sync:
+                storage.abort_day()
+                update_watermarks(days)
+            storage.close()
+            for sink in sinks:
+                sink.close()
+            exit(1)
+
+    if sync:
+        update_watermarks(days)
+    storage.close()
+    for sink in sinks:
+        sink.close()
+    if downloader:
+        downloader.shutdown()
+    cache.close()
\ No newline at end of file
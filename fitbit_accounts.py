@@ -0,0 +1,191 @@
+"""
+Download the data of several Fitbit accounts, e.g. of a household or a study.
+
+The accounts are listed in a JSON file:
+{
+    "id": "<client ID>", "secret": "<client secret>",
+    "directory": "Accounts",
+    "accounts": [
+        {"name": "alice", "first": "2018-03-01"},
+        {"name": "bob", "id": "<client ID>", "secret": "<client secret>", "arguments": ["--workers", "2"]}
+    ]
+}
+The client ID and secret can be set per account, or once for all accounts.
+The secret is passed to the processes in the environment variable
+FITBIT_CLIENT_SECRET, not on their command line, which other users can see.
+
+Every account is downloaded by its own process of download.py, which runs in
+the directory of the account, <directory>/<name>. The cache, the database, the
+CSV files and the token of an account are stored there, separated from the
+other accounts. Fitbit limits the number of requests per user, so every
+process has its own request budget and the accounts are downloaded in
+parallel. The output of a process is printed with the name of its account.
+
+Accounts without a stored token are authorized in the browser one at a time.
+"""
+import os
+import re
+import sys
+import json
+import threading
+import subprocess
+from fitbit_api import TOKEN_FILE, SECRET_VARIABLE
+
+# Directory of download.py
+APPLICATION_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Allowed names of accounts, the name is used as the name of a directory
+ACCOUNT_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def read_accounts(filename):
+    """
+    Read the accounts of a configuration file
+    :param filename: name of the JSON file
+    :return: list of dicts with the name, directory, client secret and download.py arguments of every account
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    directory = config.get('directory', 'Accounts')
+    if not os.path.isabs(directory):
+        directory = os.path.join(os.path.dirname(os.path.abspath(filename)), directory)
+    accounts = []
+    names = set()
+    for account in config.get('accounts', []):
+        name = str(account.get('name', ''))
+        if not ACCOUNT_NAME.match(name) or name in ('.', '..'):
+            raise ValueError("Invalid account name: '{}'".format(name))
+        if name in names:
+            raise ValueError("Account '{}' is listed twice".format(name))
+        names.add(name)
+        arguments = []
+        for key, option in [('id', '--id'), ('first', '--first')]:
+            value = account.get(key, config.get(key))
+            if value is not None:
+                arguments += [option, str(value)]
+        arguments += [str(argument) for argument in account.get('arguments', [])]
+        secret = account.get('secret', config.get('secret'))
+        accounts.append({'name': name, 'directory': os.path.join(directory, name),
+                         'secret': str(secret) if secret is not None else None, 'arguments': arguments})
+    return accounts
+
+
+def needs_authorization(account, arguments):
+    """
+    Check if a download of an account starts with an authorization in the browser
+    :param account: account, see read_accounts
+    :param arguments: download.py arguments of all accounts
+    :return: True if no token is stored and the download is online
+    """
+    all_arguments = arguments + account['arguments']
+    if '--authorize' in all_arguments:
+        return True
+    if 'rebuild' in all_arguments or '--offline' in all_arguments:
+        return False
+    # Relative to the directory of the account, the working directory of its process
+    token_file = option_value(all_arguments, '--token-file') or TOKEN_FILE
+    return not os.path.exists(os.path.join(account['directory'], token_file))
+
+
+def option_value(arguments, option):
+    """
+    Value of an option in command line arguments, the last one if given more than once
+    :param arguments: command line arguments
+    :param option: the option, e.g. '--token-file'
+    :return: the value, or None if the option is not given
+    """
+    value = None
+    for j, argument in enumerate(arguments):
+        if argument == option and j + 1 < len(arguments):
+            value = arguments[j + 1]
+        elif argument.startswith(option + '='):
+            value = argument[len(option) + 1:]
+    return value
+
+
+def without_option(arguments, option):
+    """
+    Remove an option and its value from command line arguments
+    :param arguments: command line arguments
+    :param option: the option, e.g. '--accounts'
+    :return: list of the other arguments
+    """
+    result = []
+    skip = False
+    for argument in arguments:
+        if skip:
+            skip = False
+        elif argument == option:
+            skip = True
+        elif not argument.startswith(option + '='):
+            result.append(argument)
+    return result
+
+
+def print_output(name, stream):
+    """
+    Print the output of a process, every line preceded by the name of its account
+    :param name: name of the account
+    :param stream: output of the process
+    :return:
+    """
+    for line in iter(stream.readline, ''):
+        sys.stdout.write("[{}] {}".format(name, line))
+        sys.stdout.flush()
+    stream.close()
+
+
+def start_download(account, arguments, script):
+    """
+    Start the download of an account in its directory
+    :param account: account, see read_accounts
+    :param arguments: download.py arguments of all accounts, e.g. ['sync']
+    :param script: path of download.py
+    :return: (process, thread printing its output)
+    """
+    os.makedirs(account['directory'], exist_ok=True)
+    environment = dict(os.environ)
+    if account['secret'] is not None:
+        environment[SECRET_VARIABLE] = account['secret']
+    process = subprocess.Popen([sys.executable, '-u', script] + arguments + account['arguments'],
+                               cwd=account['directory'], env=environment, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, universal_newlines=True)
+    thread = threading.Thread(target=print_output, args=(account['name'], process.stdout))
+    thread.start()
+    return process, thread
+
+
+def run_accounts(filename, arguments, script=os.path.join(APPLICATION_DIRECTORY, 'download.py')):
+    """
+    Download all accounts of a configuration file, in parallel. Accounts that
+    are authorized in the browser are started one at a time, since the
+    authorization uses a local web server on a fixed port.
+    :param filename: name of the JSON file with the accounts, see read_accounts
+    :param arguments: download.py arguments of all accounts, e.g. ['sync', '--workers', '2']
+    :param script: path of download.py
+    :return: dict with the exit code per account
+    """
+    accounts = read_accounts(filename)
+    # A secret of the command line is passed in the environment, like the secrets of the file
+    secret = option_value(arguments, '--secret')
+    arguments = without_option(arguments, '--secret')
+    for account in accounts:
+        if account['secret'] is None:
+            account['secret'] = secret
+    running = {}
+    authorize = []
+    for account in accounts:
+        if needs_authorization(account, arguments):
+            authorize.append(account)
+        else:
+            running[account['name']] = start_download(account, arguments, script)
+    for account in authorize:
+        process, thread = start_download(account, arguments, script)
+        process.wait()
+        thread.join()
+        running[account['name']] = (process, thread)
+    results = {}
+    for name, (process, thread) in running.items():
+        results[name] = process.wait()
+        thread.join()
+    return results
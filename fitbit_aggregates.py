@@ -0,0 +1,212 @@
+"""
+Aggregates of the stored data, maintained while downloading, so analyses read
+small tables instead of the tables with a row per minute.
+
+Tables:
+- Aggregate_Hour  : per day and hour, sums of the intraday activities and the heart rate
+- Aggregate_Day   : per day, the main figures of the daily summary, with week, month and weekday
+- Aggregate_Week  : per week (date of the Monday), sums and means of the days
+- Aggregate_Month : per month (YYYY-MM), sums and means of the days
+
+After days are stored only their hours, the days and the weeks and months they
+are part of are computed again.
+"""
+from fitbit_schema import AGGREGATE_TABLES, PERIOD_COLUMNS, quote, table_exists, prepare_table
+from fitbit_profile import profiled
+
+# Maximum number of dates in a single query
+MAX_DATES = 500
+
+# Hour of a row of an intraday table
+HOUR = "CAST(substr(Time, 1, 2) AS INTEGER)"
+
+# Sums per hour of the intraday tables: table and column, the column in Aggregate_Hour has the same name
+HOURLY_SUMS = [
+    ('Steps_1m', 'Steps'),
+    ('Distance_1m', 'Distance'),
+    ('Floors_1m', 'Floors'),
+    ('Calories_1m', 'Calories'),
+]
+
+# Heart rate per hour, from the table Heartrate
+HOURLY_HEART_RATE = [
+    ('Heart Rate', 'avg("Heart Rate")'),
+    ('Heart Rate Min', 'min("Heart Rate")'),
+    ('Heart Rate Max', 'max("Heart Rate")'),
+    ('Heart Rate Minutes', 'count("Heart Rate")'),
+]
+
+# Columns of Aggregate_Day computed from Daily_Summary
+DAILY_COLUMNS = [
+    ('Week', "date(Date, '-6 days', 'weekday 1')"),
+    ('Month', "substr(Date, 1, 7)"),
+    # 0 is Monday, as in pandas
+    ('Weekday', "(CAST(strftime('%w', Date) AS INTEGER) + 6) % 7"),
+    ('Steps', '"Steps"'),
+    ('Distance', '"Distance"'),
+    ('Floors', '"Floors"'),
+    ('Calories Out', '"Calories Out"'),
+    ('Active Minutes', '"Fairly Active Minutes" + "Very Active Minutes"'),
+    ('Minutes Asleep', '"Minutes Asleep"'),
+    ('Time in Bed', '"Time in Bed"'),
+    ('Resting Heart Rate', '"Resting Heart Rate"'),
+]
+
+# Heart rate per day, from Aggregate_Hour
+DAILY_HEART_RATE = [
+    ('Heart Rate', 'sum("Heart Rate" * "Heart Rate Minutes") / sum("Heart Rate Minutes")'),
+    ('Heart Rate Minutes', 'sum("Heart Rate Minutes")'),
+]
+
+# Columns of Aggregate_Week and Aggregate_Month computed from Aggregate_Day
+PERIOD_EXPRESSIONS = {
+    'Days': 'count(*)',
+    'Steps': 'sum("Steps")',
+    'Steps Mean': 'avg("Steps")',
+    'Distance': 'sum("Distance")',
+    'Floors': 'sum("Floors")',
+    'Calories Out': 'sum("Calories Out")',
+    'Active Minutes': 'sum("Active Minutes")',
+    'Minutes Asleep': 'sum("Minutes Asleep")',
+    'Minutes Asleep Mean': 'avg("Minutes Asleep")',
+    'Time in Bed': 'sum("Time in Bed")',
+    'Resting Heart Rate': 'avg("Resting Heart Rate")',
+    'Heart Rate': 'sum("Heart Rate" * "Heart Rate Minutes") / sum("Heart Rate Minutes")',
+    'Heart Rate Minutes': 'sum("Heart Rate Minutes")',
+}
+
+
+def upsert_select(cnx, tablename, key, columns, select, params):
+    """
+    Insert the rows of a query in a table, replacing the values of rows with the same key
+    :param cnx: Connection to the SQLite database
+    :param tablename: name of the table
+    :param key: key columns, the first columns of the query
+    :param columns: value columns, the other columns of the query
+    :param select: query, must have a WHERE clause
+    :param params: parameters of the query
+    :return:
+    """
+    cnx.execute("INSERT INTO {table} ({columns}) {select} ON CONFLICT ({key}) DO UPDATE SET {update}".format(
+        table=quote(tablename),
+        columns=', '.join(quote(column) for column in key + columns),
+        select=select,
+        key=', '.join(quote(column) for column in key),
+        update=', '.join('{0} = excluded.{0}'.format(quote(column)) for column in columns)), params)
+
+
+def in_list(values):
+    """
+    Placeholders of the values of an IN clause
+    :param values: list of values
+    :return: string, e.g. "(?, ?)"
+    """
+    return '(' + ', '.join('?' * len(values)) + ')'
+
+
+def refresh_hours(cnx, dates):
+    """
+    Compute the hours of days again
+    :param cnx: Connection to the SQLite database
+    :param dates: list of dates (string, format YYYY-MM-DD)
+    :return:
+    """
+    cnx.execute("DELETE FROM Aggregate_Hour WHERE Date IN " + in_list(dates), dates)
+    for tablename, column in HOURLY_SUMS:
+        if table_exists(cnx, tablename):
+            upsert_select(cnx, 'Aggregate_Hour', ['Date', 'Hour'], [column],
+                          "SELECT Date, {hour}, sum({column}) FROM {table} WHERE Date IN {dates} "
+                          "GROUP BY Date, {hour}".format(hour=HOUR, column=quote(column), table=quote(tablename),
+                                                         dates=in_list(dates)), dates)
+    if table_exists(cnx, 'Heartrate'):
+        upsert_select(cnx, 'Aggregate_Hour', ['Date', 'Hour'], [column for column, _ in HOURLY_HEART_RATE],
+                      "SELECT Date, {hour}, {values} FROM Heartrate WHERE Date IN {dates} "
+                      "GROUP BY Date, {hour}".format(hour=HOUR, dates=in_list(dates),
+                                                     values=', '.join(value for _, value in HOURLY_HEART_RATE)),
+                      dates)
+
+
+def refresh_days(cnx, dates):
+    """
+    Compute days again, from the daily summary and the hours
+    :param cnx: Connection to the SQLite database
+    :param dates: list of dates (string, format YYYY-MM-DD)
+    :return:
+    """
+    if table_exists(cnx, 'Daily_Summary'):
+        upsert_select(cnx, 'Aggregate_Day', ['Date'], [column for column, _ in DAILY_COLUMNS],
+                      "SELECT Date, {values} FROM Daily_Summary WHERE Date IN {dates}".format(
+                          values=', '.join(value for _, value in DAILY_COLUMNS), dates=in_list(dates)), dates)
+    upsert_select(cnx, 'Aggregate_Day', ['Date'], [column for column, _ in DAILY_HEART_RATE],
+                  "SELECT Date, {values} FROM Aggregate_Hour WHERE Date IN {dates} "
+                  "AND Date IN (SELECT Date FROM Aggregate_Day) GROUP BY Date".format(
+                      values=', '.join(value for _, value in DAILY_HEART_RATE), dates=in_list(dates)), dates)
+
+
+def refresh_periods(cnx, dates, period):
+    """
+    Compute the weeks or months of days again
+    :param cnx: Connection to the SQLite database
+    :param dates: list of dates (string, format YYYY-MM-DD)
+    :param period: 'Week' or 'Month'
+    :return:
+    """
+    periods = [row[0] for row in cnx.execute("SELECT DISTINCT {period} FROM Aggregate_Day WHERE Date IN {dates}".format(
+        period=quote(period), dates=in_list(dates)), dates)]
+    if periods:
+        columns = [column for column, _ in PERIOD_COLUMNS]
+        upsert_select(cnx, 'Aggregate_' + period, [period], columns,
+                      "SELECT {period}, {values} FROM Aggregate_Day WHERE {period} IN {periods} "
+                      "GROUP BY {period}".format(period=quote(period), periods=in_list(periods),
+                                                 values=', '.join(PERIOD_EXPRESSIONS[c] for c in columns)),
+                      periods)
+
+
+@profiled('aggregates')
+def refresh(cnx, dates):
+    """
+    Compute the aggregates of days again, and of the weeks and months they are part of
+    :param cnx: Connection to the SQLite database
+    :param dates: dates (string, format YYYY-MM-DD)
+    :return:
+    """
+    for tablename in AGGREGATE_TABLES:
+        prepare_table(cnx, tablename)
+    dates = sorted(dates)
+    for j in range(0, len(dates), MAX_DATES):
+        chunk = dates[j:j + MAX_DATES]
+        refresh_hours(cnx, chunk)
+        refresh_days(cnx, chunk)
+        refresh_periods(cnx, chunk, 'Week')
+        refresh_periods(cnx, chunk, 'Month')
+
+
+class Aggregates(object):
+    """
+    Days stored since the last commit, whose aggregates are computed again
+    before the next commit, see StorageSession
+    """
+
+    def __init__(self):
+        """
+        Create without days
+        """
+        self.dates = set()
+
+    def add_days(self, dates):
+        """
+        Add stored days
+        :param dates: dates (string, format YYYY-MM-DD)
+        :return:
+        """
+        self.dates.update(dates)
+
+    def flush(self, cnx):
+        """
+        Compute the aggregates of the days added
+        :param cnx: Connection to the SQLite database
+        :return:
+        """
+        if self.dates:
+            refresh(cnx, self.dates)
+        self.dates = set()
@@ -0,0 +1,411 @@
+import os
+import json
+import datetime
+import random
+import threading
+import time
+
+from fitbit.exceptions import HTTPUnauthorized
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Maximum number of Fitbit API requests per user per hour
+FITBIT_HOURLY_QUOTA = 150
+
+# Maximum number of activities returned by a request of the activity log list
+ACTIVITY_LIST_LIMIT = 100
+
+# Seconds in which a token refresh of another worker is reused instead of refreshing again
+TOKEN_REFRESH_GRACE = 60
+
+# File storing the OAuth2 token of the Fitbit user
+TOKEN_FILE = "token.json"
+
+# Environment variable with the client secret, the default of --secret
+SECRET_VARIABLE = "FITBIT_CLIENT_SECRET"
+
+# Seconds to wait for a connection to, and for data from the Fitbit API
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+
+# Retries of a request after a connection error or a server error (5xx)
+HTTP_RETRIES = 5
+
+# Backoff of the retries: at most 1, 2, 4, ... seconds, and at most HTTP_BACKOFF_MAX seconds
+HTTP_BACKOFF = 1.0
+HTTP_BACKOFF_MAX = 60
+
+# Server errors that are retried. Too many requests (429) is handled by the RateLimiter
+HTTP_RETRY_STATUS = [500, 502, 503, 504]
+
+
+class DownloadStopped(Exception):
+    """
+    Raised in workers waiting for the request budget when the download is stopped
+    """
+    pass
+
+
+class RateLimiter(object):
+    """
+    Request budget shared by all download workers.
+    Until Fitbit reports its rate limit, the budget is a token bucket that holds
+    at most quota tokens and is refilled evenly over period seconds. Once the
+    rate limit headers of a response are seen, the budget follows the actual
+    number of remaining requests and waits until the reported reset of the
+    Fitbit rate limit window when it runs out.
+    """
+
+    def __init__(self, quota=FITBIT_HOURLY_QUOTA, period=3600):
+        """
+        Create a full bucket
+        :param quota: Number of requests allowed per period
+        :param period: Length of the period in seconds
+        """
+        self.quota = quota
+        self.period = period
+        self.tokens = float(quota)
+        self.updated = time.monotonic()
+        self.reset_at = None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def _refill(self):
+        """
+        Add the tokens earned since the last update (caller holds the lock)
+        :return:
+        """
+        now = time.monotonic()
+        self.tokens = min(float(self.quota), self.tokens + (now - self.updated) * self.quota / self.period)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take a token from the budget, wait until one is available
+        :return:
+        """
+        while True:
+            if self.stopped.is_set():
+                raise DownloadStopped()
+            with self.lock:
+                now = time.monotonic()
+                if self.reset_at is None:
+                    self._refill()
+                elif now >= self.reset_at:
+                    # New window, the next response reports the exact budget
+                    self.tokens = float(self.quota)
+                    self.reset_at = now + self.period
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                if self.reset_at is None:
+                    wait = (1 - self.tokens) * self.period / self.quota
+                else:
+                    wait = self.reset_at - now
+            self.stopped.wait(wait)
+
+    def release(self):
+        """
+        Register that a request taken from the budget is finished
+        :return:
+        """
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+    def stop(self):
+        """
+        Stop the budget, waiting and future calls of acquire raise DownloadStopped
+        :return:
+        """
+        self.stopped.set()
+
+    def update(self, quota, remaining, reset):
+        """
+        Synchronise the budget with the rate limit reported by Fitbit.
+        Other requests in flight are not yet counted by Fitbit and are
+        subtracted. Responses of parallel requests can arrive out of order,
+        so the remaining number of requests is never raised within a window.
+        :param quota: Number of requests allowed per window
+        :param remaining: Number of requests left in the current window
+        :param reset: Seconds until the window resets
+        :return:
+        """
+        with self.lock:
+            now = time.monotonic()
+            # The request of this response is still in flight itself
+            available = max(0.0, float(remaining - max(0, self.in_flight - 1)))
+            if self.reset_at is None or now >= self.reset_at:
+                self.tokens = available
+            else:
+                self.tokens = min(self.tokens, available)
+            self.quota = quota
+            self.reset_at = now + reset
+
+    def exhausted(self, retry_after=None):
+        """
+        Register that Fitbit refused a request because the rate limit is reached
+        :param retry_after: Seconds until requests are allowed again, if known
+        :return:
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = 0.0
+            if retry_after is not None:
+                self.reset_at = now + retry_after
+            elif self.reset_at is None or now >= self.reset_at:
+                self.reset_at = now + self.period
+
+
+def watch_rate_limit(fb_client, limiter):
+    """
+    Update the request budget with the rate limit headers of every Fitbit response
+    :param fb_client: Fitbit Client
+    :param limiter: RateLimiter to update
+    :return:
+    """
+    def update_limiter(response, *args, **kwargs):
+        try:
+            limiter.update(int(response.headers['Fitbit-Rate-Limit-Limit']),
+                           int(response.headers['Fitbit-Rate-Limit-Remaining']),
+                           int(response.headers['Fitbit-Rate-Limit-Reset']))
+        except (KeyError, ValueError):
+            # Not an API response, e.g. a token refresh
+            pass
+
+    fb_client.client.session.hooks['response'].append(update_limiter)
+
+
+def serialize_token_refresh(fb_client):
+    """
+    Make the token refresh of a Fitbit client safe for parallel workers.
+    A refresh token can only be used once, so when several workers find the
+    access token expired at the same time, only the first one refreshes it.
+    The others reuse the new token. The token is refreshed by the Fitbit client
+    after a response with an expired token, and by its session before a request
+    when the token is past its expiry time; both are serialized.
+    :param fb_client: Fitbit Client, created with a refresh_cb
+    :return:
+    """
+    oauth_client = fb_client.client
+    session = oauth_client.session
+    # Reentrant: the refresh of the Fitbit client calls the refresh of its session
+    lock = threading.RLock()
+    last_refresh = [None]
+
+    def once(refresh):
+        def refresh_once(*args, **kwargs):
+            with lock:
+                if last_refresh[0] is not None and time.monotonic() - last_refresh[0] < TOKEN_REFRESH_GRACE:
+                    return session.token
+                token = refresh(*args, **kwargs)
+                last_refresh[0] = time.monotonic()
+                return token
+        return refresh_once
+
+    oauth_client.refresh_token = once(oauth_client.refresh_token)
+    if hasattr(session, 'refresh_token'):
+        session.refresh_token = once(session.refresh_token)
+
+
+def retry_unauthorized(fb_client, load_token=None):
+    """
+    Retry a request refused with an invalid access token once, with a new token.
+    That is the token stored by another run of the application, if it differs
+    from the token of the client (the refresh token of the client is then no
+    longer valid), otherwise a refreshed token.
+    :param fb_client: Fitbit Client, see serialize_token_refresh
+    :param load_token: function returning the stored token (dict) or None
+    :return:
+    """
+    oauth_client = fb_client.client
+    make_request = oauth_client.make_request
+
+    def make_request_authorized(*args, **kwargs):
+        try:
+            return make_request(*args, **kwargs)
+        except HTTPUnauthorized:
+            stored = load_token() if load_token else None
+            if stored and stored.get('access_token') != oauth_client.session.token.get('access_token'):
+                oauth_client.session.token = stored
+            else:
+                oauth_client.refresh_token()
+            return make_request(*args, **kwargs)
+
+    oauth_client.make_request = make_request_authorized
+
+
+class TokenFile(object):
+    """
+    OAuth2 token of a Fitbit user, stored in a JSON file only readable by the
+    user. Its save method is used as refresh_cb of the Fitbit client, so every
+    refreshed token is stored and the next run starts without authorization.
+    """
+
+    def __init__(self, filename):
+        """
+        Token file
+        :param filename: name of the JSON file
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.access_token = None
+
+    def load(self):
+        """
+        Read the stored token
+        :return: dict with at least access_token and refresh_token, or None if not stored
+        """
+        try:
+            with open(self.filename) as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(token, dict) or 'access_token' not in token or 'refresh_token' not in token:
+            return None
+        return token
+
+    def save(self, token):
+        """
+        Store a token, the file is replaced at once
+        :param token: dict with the token
+        :return: True if the token was not stored yet
+        """
+        with self.lock:
+            if token.get('access_token') == self.access_token:
+                return False
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.filename + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(token), f)
+            os.replace(self.filename + '.tmp', self.filename)
+            self.access_token = token.get('access_token')
+            return True
+
+
+class JitteredRetry(Retry):
+    """
+    Retry with an exponential backoff with full jitter: a random time between
+    zero and the exponential backoff, so parallel workers hitting the same
+    error do not retry at the same moment
+    """
+
+    # Status codes retried after the time of a Retry-After header. Too many
+    # requests (429) is not retried here, it is handled by the RateLimiter
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+    def get_backoff_time(self):
+        """
+        Seconds to wait before the next retry
+        :return: float
+        """
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, super().get_backoff_time()))
+
+
+def configure_session(fb_client, workers=1, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), retries=HTTP_RETRIES):
+    """
+    Tune the HTTP session of a Fitbit client: a pool of keep-alive connections
+    sized to the number of workers, compressed responses, timeouts, and retries
+    with a jittered backoff of requests failing with a connection error or a
+    server error. Only GET requests are retried, never a token refresh (POST),
+    since a refresh token can only be used once.
+    :param fb_client: Fitbit Client
+    :param workers: number of parallel downloads
+    :param timeout: seconds to wait for a connection and for data (connect, read)
+    :param retries: maximum number of retries of a request
+    :return:
+    """
+    retry = JitteredRetry(total=retries, connect=retries, read=retries, status=retries,
+                          status_forcelist=HTTP_RETRY_STATUS, allowed_methods=['GET'],
+                          backoff_factor=HTTP_BACKOFF, respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers), max_retries=retry)
+    session = fb_client.client.session
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.headers['Connection'] = 'keep-alive'
+    fb_client.client.timeout = timeout
+
+
+def group_ranges(days, max_days):
+    """
+    Group days into ranges of consecutive days of at most max_days days
+    :param days: days (datetime.date objects)
+    :param max_days: maximum number of days in a range
+    :return: list of (first day, last day)
+    """
+    ranges = []
+    first_day = None
+    missing = sorted(days)
+    for j, day in enumerate(missing):
+        if first_day is None:
+            first_day = day
+        last_of_range = j + 1 == len(missing) or \
+            missing[j + 1] != day + datetime.timedelta(days=1) or \
+            (day - first_day).days + 1 == max_days
+        if last_of_range:
+            ranges.append((first_day, day))
+            first_day = None
+    return ranges
+
+
+def empty_days(first_day, last_day, key):
+    """
+    Create the data per day of a range of days without records
+    :param first_day: first day of the range
+    :param last_day: last day of the range
+    :param key: key of the list of records, e.g. 'weight'
+    :return: dict with the data per day (string, format YYYY-MM-DD)
+    """
+    result = {}
+    for j in range((last_day - first_day).days + 1):
+        day = first_day + datetime.timedelta(days=j)
+        result[str(day.strftime("%Y-%m-%d"))] = {key: []}
+    return result
+
+
+def fetch_bodyweight_range(make_request, first_day, last_day):
+    """
+    Download the weight logs of a range of days (at most 31 days)
+    :param make_request: function requesting an URL from the Fitbit API
+    :param first_day: first day to retrieve
+    :param last_day: last day to retrieve
+    :return: dict with the data per day (string, format YYYY-MM-DD)
+    """
+    url = "https://api.fitbit.com/1/user/-/body/log/weight/date/{}/{}.json".format(
+        first_day.strftime("%Y-%m-%d"), last_day.strftime("%Y-%m-%d"))
+    weight_stats = make_request(url)
+    result = empty_days(first_day, last_day, 'weight')
+    for rec in weight_stats['weight']:
+        if rec['date'] in result:
+            result[rec['date']]['weight'].append(rec)
+    return result
+
+
+def fetch_training_range(make_request, first_day, last_day):
+    """
+    Download the logged activities of a range of days. The activity log list
+    is requested page by page, going back in time, until the first day is passed.
+    Contrary to a download of a single day, which holds the last ten activities
+    up to and including that day, the data of a day only holds its own activities.
+    :param make_request: function requesting an URL from the Fitbit API
+    :param first_day: first day to retrieve
+    :param last_day: last day to retrieve
+    :return: dict with the data per day (string, format YYYY-MM-DD)
+    """
+    first_day_str = str(first_day.strftime("%Y-%m-%d"))
+    before = str((last_day + datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
+    result = empty_days(first_day, last_day, 'activities')
+    while True:
+        url = "https://api.fitbit.com/1/user/-/activities/list.json?beforeDate=" + \
+              before + "&sort=desc&offset=0&limit=" + str(ACTIVITY_LIST_LIMIT)
+        activities = make_request(url)['activities']
+        for act in activities:
+            if act['startTime'][:10] in result:
+                result[act['startTime'][:10]]['activities'].append(act)
+        if len(activities) < ACTIVITY_LIST_LIMIT or activities[-1]['startTime'][:10] < first_day_str:
+            return result
+        # Next page: activities started before the oldest activity received
+        before = activities[-1]['startTime'][:19]
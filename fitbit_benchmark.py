@@ -0,0 +1,423 @@
+"""
+Benchmark of the processing of downloaded data, on a synthetic cache.
+
+For every number of days a cache is generated with a response of every endpoint
+read by download.py, and the stages are timed:
+- generate   : writing the synthetic cache
+- cache_read : reading all cache entries
+- ingest     : download.py download --offline, storing all days from the cache
+- rebuild    : download.py rebuild, parsing the cache in worker processes
+- upsert     : upsert_df of the intraday steps of all days, into an empty table and again (all rows present)
+- query      : fitbit_store queries of the stored days
+
+The results are written as JSON, with the time per day of every stage, e.g.
+python fitbit_benchmark.py --days 30 365 --output benchmark.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from fitbit_cache import BACKENDS, open_cache
+from fitbit_db import upsert_df
+from fitbit_frames import dataset_to_frame
+from fitbit_store import FitbitStore, StreamingAggregate
+
+# Last day of the synthetic data
+LAST_DAY = datetime.date(2019, 12, 31)
+
+# Intraday endpoints: value of a minute (from a random generator and the minute of the day) and the summary value
+INTRADAY_ENDPOINTS = {
+    "activities_calories": lambda rng, minute: round(1.2 + rng.exponential(0.8), 2),
+    "activities_steps": lambda rng, minute: int(rng.poisson(25)) if 420 <= minute < 1320 else 0,
+    "activities_distance": lambda rng, minute: round(rng.exponential(0.01), 4),
+    "activities_floors": lambda rng, minute: int(rng.random() < 0.01),
+    "activities_elevation": lambda rng, minute: round(3.0 * (rng.random() < 0.01), 1),
+    "activities_activityCalories": lambda rng, minute: int(rng.poisson(1)),
+}
+
+# Cache names of the intraday endpoints in the Fitbit responses
+RESOURCES = {
+    "activities_calories": "activities-calories",
+    "activities_steps": "activities-steps",
+    "activities_distance": "activities-distance",
+    "activities_floors": "activities-floors",
+    "activities_elevation": "activities-elevation",
+    "activities_activityCalories": "activities-activityCalories",
+}
+
+# Directory of the application
+APPLICATION_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def clock_time(minute):
+    """
+    Time of a minute of the day
+    :param minute: minute of the day
+    :return: string, format HH:MM:SS
+    """
+    return "{:02d}:{:02d}:00".format(minute // 60, minute % 60)
+
+
+def heart_zones(rng):
+    """
+    Heart rate zones as in the heart rate and activity responses
+    :param rng: numpy random generator
+    :return: list of dicts
+    """
+    bounds = [30, 94, 131, 159, 220]
+    names = ["Out of Range", "Fat Burn", "Cardio", "Peak"]
+    return [{'caloriesOut': round(float(rng.uniform(10, 1500)), 4), 'min': bounds[j], 'max': bounds[j + 1],
+             'minutes': int(rng.integers(0, 600)), 'name': names[j]} for j in range(4)]
+
+
+def intraday_response(name, day, rng):
+    """
+    Response of an intraday time series
+    :param name: endpoint, key of INTRADAY_ENDPOINTS
+    :param day: day of the data
+    :param rng: numpy random generator
+    :return: dict
+    """
+    value = INTRADAY_ENDPOINTS[name]
+    dataset = [{'time': clock_time(minute), 'value': value(rng, minute)} for minute in range(1440)]
+    total = sum(row['value'] for row in dataset)
+    return {RESOURCES[name]: [{'dateTime': str(day), 'value': str(total)}],
+            RESOURCES[name] + '-intraday': {'dataset': dataset, 'datasetInterval': 1, 'datasetType': 'minute'}}
+
+
+def heart_response(day, rng):
+    """
+    Response of the heart rate time series, minutes without a heart rate are left out
+    :param day: day of the data
+    :param rng: numpy random generator
+    :return: dict
+    """
+    worn = rng.random(1440) < 0.9
+    rates = np.clip(62 + 18 * np.sin(np.arange(1440) / 229.0) + rng.normal(0, 6, 1440), 40, 190).astype(int)
+    dataset = [{'time': clock_time(minute), 'value': int(rates[minute])} for minute in range(1440) if worn[minute]]
+    return {'activities-heart': [{'dateTime': str(day),
+                                  'value': {'customHeartRateZones': [], 'heartRateZones': heart_zones(rng),
+                                            'restingHeartRate': int(rng.integers(52, 68))}}],
+            'activities-heart-intraday': {'dataset': dataset, 'datasetInterval': 1, 'datasetType': 'minute'}}
+
+
+def sleep_response(day, rng):
+    """
+    Response of the sleep logs, a main sleep with minute data and sometimes a nap
+    :param day: day of the data
+    :param rng: numpy random generator
+    :return: dict
+    """
+    logs = []
+    for main, (start_minute, length) in [(True, (int(rng.integers(1320, 1440)) - 1440, int(rng.integers(360, 540)))),
+                                         (False, (int(rng.integers(780, 900)), int(rng.integers(20, 60))))]:
+        if not main and rng.random() > 0.1:
+            continue
+        start = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(minutes=start_minute)
+        states = rng.choice(['1', '2', '3'], size=length, p=[0.9, 0.07, 0.03])
+        minutes = [{'dateTime': (start + datetime.timedelta(minutes=j)).strftime("%H:%M:%S"), 'value': str(states[j])}
+                   for j in range(length)]
+        asleep = int((states == '1').sum())
+        logs.append({
+            'dateOfSleep': str(day), 'isMainSleep': main, 'logId': day.toordinal() * 10 + len(logs),
+            'startTime': start.strftime("%Y-%m-%dT%H:%M:%S.000"),
+            'endTime': (start + datetime.timedelta(minutes=length)).strftime("%Y-%m-%dT%H:%M:%S.000"),
+            'timeInBed': length, 'duration': length * 60000, 'efficiency': int(100 * asleep / length),
+            'awakeCount': int((states == '3').sum()), 'awakeDuration': int((states == '3').sum()),
+            'awakeningsCount': int(rng.integers(0, 20)), 'minutesAfterWakeup': 0, 'minutesAsleep': asleep,
+            'minutesAwake': length - asleep, 'minutesToFallAsleep': 0,
+            'restlessCount': int((states == '2').sum()), 'restlessDuration': int((states == '2').sum()),
+            'minuteData': minutes})
+    return {'sleep': logs,
+            'summary': {'totalMinutesAsleep': sum(log['minutesAsleep'] for log in logs),
+                        'totalSleepRecords': len(logs),
+                        'totalTimeInBed': sum(log['timeInBed'] for log in logs),
+                        'stages': {'deep': int(rng.integers(40, 100)), 'light': int(rng.integers(180, 260)),
+                                   'rem': int(rng.integers(60, 120)), 'wake': int(rng.integers(30, 70))}}}
+
+
+def activities_response(day, rng):
+    """
+    Response of the activity summary of a day
+    :param day: day of the data
+    :param rng: numpy random generator
+    :return: dict
+    """
+    distance = round(float(rng.uniform(2, 15)), 2)
+    return {'activities': [],
+            'goals': {'activeMinutes': 30, 'caloriesOut': 2500, 'distance': 8.05, 'floors': 10, 'steps': 10000},
+            'summary': {'activeScore': -1, 'activityCalories': int(rng.integers(500, 1500)),
+                        'caloriesBMR': 1700, 'caloriesOut': int(rng.integers(2000, 3500)),
+                        'distances': [{'activity': name, 'distance': distance if name in ('total', 'tracker') else 0}
+                                      for name in ['total', 'tracker', 'loggedActivities', 'veryActive',
+                                                   'moderatelyActive', 'lightlyActive', 'sedentaryActive']],
+                        'elevation': round(float(rng.uniform(0, 60)), 1), 'floors': int(rng.integers(0, 20)),
+                        'fairlyActiveMinutes': int(rng.integers(0, 60)), 'heartRateZones': heart_zones(rng),
+                        'lightlyActiveMinutes': int(rng.integers(100, 300)),
+                        'marginalCalories': int(rng.integers(300, 900)),
+                        'restingHeartRate': int(rng.integers(52, 68)), 'sedentaryMinutes': int(rng.integers(500, 900)),
+                        'steps': int(rng.integers(2000, 20000)), 'veryActiveMinutes': int(rng.integers(0, 60))}}
+
+
+def training_activity(day):
+    """
+    Logged activity of a day, on every third day
+    :param day: day of the activity
+    :return: dict, or None if there is no activity
+    """
+    if day.toordinal() % 3:
+        return None
+    rng = np.random.default_rng(day.toordinal())
+    duration = int(rng.integers(20, 90))
+    return {'logId': day.toordinal(), 'activityName': str(rng.choice(['Walk', 'Run', 'Bike'])),
+            'startTime': str(day) + 'T18:00:00.000+01:00', 'duration': duration * 60000,
+            'activeDuration': duration * 60000, 'steps': int(rng.integers(1000, 10000)),
+            'averageHeartRate': int(rng.integers(90, 160)), 'calories': int(rng.integers(100, 800)),
+            'elevationGain': round(float(rng.uniform(0, 50)), 1),
+            'heartRateZones': [{'minutes': int(rng.integers(0, duration)), 'name': name}
+                               for name in ["Out of Range", "Fat Burn", "Cardio", "Peak"]],
+            'activityLevel': [{'minutes': int(rng.integers(0, duration)), 'name': name}
+                              for name in ['sedentary', 'lightly', 'fairly', 'very']]}
+
+
+def training_response(day):
+    """
+    Response of the activity log list: the last ten activities up to and including a day
+    :param day: day of the data
+    :return: dict
+    """
+    activities = []
+    for j in range(60):
+        activity = training_activity(day - datetime.timedelta(days=j))
+        if activity:
+            activities.append(activity)
+        if len(activities) == 10:
+            break
+    return {'activities': activities, 'pagination': {'limit': 10, 'offset': 0, 'sort': 'desc'}}
+
+
+def weight_response(day, rng):
+    """
+    Response of the weight logs of a day, a weight is logged on some days
+    :param day: day of the data
+    :param rng: numpy random generator
+    :return: dict
+    """
+    if rng.random() > 0.3:
+        return {'weight': []}
+    weight = round(float(rng.normal(80, 1)), 1)
+    return {'weight': [{'bmi': round(weight / 1.8 ** 2, 2), 'date': str(day), 'fat': round(float(rng.normal(20, 1)), 2),
+                        'logId': day.toordinal(), 'source': 'Aria', 'time': '07:30:00', 'weight': weight}]}
+
+
+def synthetic_day(day):
+    """
+    Responses of all endpoints of a day, the same for every call with the same day
+    :param day: day of the data
+    :return: dict with the response per endpoint
+    """
+    rng = np.random.default_rng(day.toordinal())
+    responses = dict((name, intraday_response(name, day, rng)) for name in INTRADAY_ENDPOINTS)
+    responses["steps_1m"] = responses["activities_steps"]
+    responses["heart_1m"] = heart_response(day, rng)
+    responses["sleep"] = sleep_response(day, rng)
+    responses["activities"] = activities_response(day, rng)
+    responses["weight"] = weight_response(day, rng)
+    responses["training"] = training_response(day)
+    return responses
+
+
+def generate_cache(directory, days, backend="files", compress=False):
+    """
+    Write a synthetic cache of days up to LAST_DAY
+    :param directory: cache directory
+    :param days: number of days
+    :param backend: cache backend, see fitbit_cache.BACKENDS
+    :param compress: write compressed entries (files backend)
+    :return: number of entries written
+    """
+    cache = open_cache(backend, directory, compress)
+    entries = 0
+    for j in range(days):
+        day = LAST_DAY - datetime.timedelta(days=j)
+        for name, data in synthetic_day(day).items():
+            cache.write(name, str(day), data)
+            entries += 1
+    cache.close()
+    return entries
+
+
+def timed(function, *args, **kwargs):
+    """
+    Call a function and measure the time
+    :return: (seconds, result of the function)
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def read_cache(directory, backend):
+    """
+    Read all entries of a cache
+    :param directory: cache directory
+    :param backend: cache backend
+    :return: number of entries read
+    """
+    cache = open_cache(backend, directory)
+    entries = 0
+    for name, date in cache.entries():
+        if cache.read(name, date):
+            entries += 1
+    cache.close()
+    return entries
+
+
+def run_application(directory, arguments):
+    """
+    Run download.py in a directory
+    :param directory: working directory, with the cache
+    :param arguments: command line arguments
+    :return:
+    """
+    subprocess.run([sys.executable, os.path.join(APPLICATION_DIRECTORY, 'download.py')] + arguments,
+                   cwd=directory, check=True, stdout=subprocess.DEVNULL)
+
+
+def upsert_steps(directory, backend, days):
+    """
+    Time upsert_df of the steps per minute of all days, into an empty table and again
+    :param directory: cache directory
+    :param backend: cache backend
+    :param days: number of days
+    :return: (seconds of the insert, seconds with all rows present)
+    """
+    cache = open_cache(backend, directory)
+    frames = []
+    for j in range(days):
+        day_str = str(LAST_DAY - datetime.timedelta(days=j))
+        dataset = cache.read("activities_steps", day_str)['activities-steps-intraday']['dataset']
+        frames.append(dataset_to_frame(dataset, day_str, 'Steps', np.int32))
+    cache.close()
+    cnx = sqlite3.connect(':memory:')
+    times = []
+    for _ in range(2):
+        start = time.perf_counter()
+        for frame in frames:
+            upsert_df(frame, 'Steps_1m', cnx, ['Date', 'Time'])
+        cnx.commit()
+        times.append(time.perf_counter() - start)
+    cnx.close()
+    return times[0], times[1]
+
+
+def query_store(filename, memo_directory):
+    """
+    Time the queries of fitbit_store on a database
+    :param filename: database file
+    :param memo_directory: directory of the kept results
+    :return: dict with the seconds per query
+    """
+    store = FitbitStore(filename, memo_directory=memo_directory)
+    last_month = (LAST_DAY - datetime.timedelta(days=29), LAST_DAY)
+    results = {
+        'daily': timed(store.daily)[0],
+        'daily_kept': timed(store.daily)[0],
+        'steps_hour': timed(store.intraday, 'steps', resolution='hour')[0],
+        'heart_minute_month': timed(store.intraday, 'heart', last_month)[0],
+        'sleep_sessions': timed(store.sleep_sessions)[0],
+    }
+    per_hour = StreamingAggregate('hour_of_day')
+    start = time.perf_counter()
+    for block in store.intraday_blocks('heart'):
+        per_hour.add(block, 'Heart Rate')
+    results['heart_blocks'] = time.perf_counter() - start
+    store.close()
+    return results
+
+
+def stage(seconds, days):
+    """
+    Result of a stage
+    :param seconds: time of the stage
+    :param days: number of days processed
+    :return: dict
+    """
+    return {'seconds': round(seconds, 4), 'ms_per_day': round(1000 * seconds / days, 3)}
+
+
+def benchmark(days, backend="files", workers=None, csv=False):
+    """
+    Run all stages for a number of days, in a temporary directory
+    :param days: number of days
+    :param backend: cache backend
+    :param workers: number of processes of the rebuild, default the number of CPUs
+    :param csv: write the CSV files while storing
+    :return: dict with the results per stage
+    """
+    directory = tempfile.mkdtemp(prefix='fitbit_benchmark_')
+    try:
+        cache_directory = os.path.join(directory, 'Cache')
+        options = ['--cache-backend', backend] + ([] if csv else ['--no-csv'])
+        stages = {}
+        stages['generate'] = stage(timed(generate_cache, cache_directory, days, backend)[0], days)
+        stages['cache_read'] = stage(timed(read_cache, cache_directory, backend)[0], days)
+        stages['ingest'] = stage(timed(run_application, directory, [
+            'download', '--offline', '--start', str(LAST_DAY), '--limit', str(days), '--first', '2000-01-01',
+            '--commit-days', '30'] + options)[0], days)
+        filename = os.path.join(directory, 'data', 'fitbit.db')
+        shutil.copy(filename, filename + '.ingest')
+        stages['rebuild'] = stage(timed(run_application, directory, ['rebuild'] + options + (
+            ['--workers', str(workers)] if workers else []))[0], days)
+        insert, duplicates = upsert_steps(cache_directory, backend, days)
+        stages['upsert'] = stage(insert, days)
+        stages['upsert_present'] = stage(duplicates, days)
+        queries = query_store(filename + '.ingest', os.path.join(directory, 'query_cache'))
+        for name, seconds in queries.items():
+            stages['query_' + name] = stage(seconds, days)
+        return {'days': days, 'stages': stages}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def environment():
+    """
+    Versions of the software used
+    :return: dict
+    """
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'sqlite': sqlite3.sqlite_version}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the processing of Fitbit data on a synthetic cache')
+    parser.add_argument('--days', type=int, nargs='+', default=[30, 365, 3000],
+                        help="numbers of days to benchmark. Default is 30 365 3000")
+    parser.add_argument('--cache-backend', dest='cache_backend', choices=BACKENDS, default="files",
+                        help="storage of the cache. Default is files")
+    parser.add_argument('--workers', type=int, dest='workers',
+                        help="processes of the rebuild. Default is the number of CPUs")
+    parser.add_argument('--csv', dest='csv', action='store_true',
+                        help="also write the CSV files while storing")
+    parser.add_argument('--output', dest='output',
+                        help="file to write the results to. Default is the standard output")
+    arguments = parser.parse_args()
+    results = {'environment': environment(), 'cache_backend': arguments.cache_backend, 'runs': []}
+    for number in arguments.days:
+        print("Benchmark of {} days".format(number), file=sys.stderr)
+        results['runs'].append(benchmark(number, arguments.cache_backend, arguments.workers, arguments.csv))
+    text = json.dumps(results, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,525 @@
+"""
+Storage of cached Fitbit API responses. An entry is identified by the type
+of data (name) and the date of the data (string, format YYYY-MM-DD).
+
+Backends:
+- files  : one JSON file per entry, Cache/<year>/<date>_<name>.json,
+           or Cache/<year>/<date>_<name>.fbz when compressed
+- sqlite : one SQLite file, Cache/cache.db, with compressed entries
+
+Compressed entries are packed per top-level key of the response, every key
+is compressed separately and only decoded when it is used. Compression uses
+zstandard and JSON parsing orjson, when these packages are installed.
+
+Convert an existing cache with:
+    python fitbit_cache.py --from files --to sqlite
+or compress the files of an existing cache with:
+    python fitbit_cache.py --from files --to files --compress --overwrite
+"""
+import os
+import json
+import zlib
+import struct
+import hashlib
+import sqlite3
+import argparse
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from fitbit_profile import profiled
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ["files", "sqlite"]
+
+# Start of a packed entry: magic, codec and length of the header
+PACKED_MAGIC = b"FBZ1"
+PACKED_PREFIX = struct.Struct("<4scI")
+
+
+def json_dumps(data):
+    """
+    Serialize data to JSON
+    :param data: data to serialize
+    :return: bytes
+    """
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data).encode('utf8')
+
+
+@profiled('cache json parse')
+def json_loads(text):
+    """
+    Parse JSON
+    :param text: bytes or string
+    :return: parsed data
+    """
+    if orjson:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def compress(raw, codec):
+    """
+    Compress bytes
+    :param raw: bytes to compress
+    :param codec: b"s" for zstandard, b"z" for zlib
+    :return: compressed bytes
+    """
+    if codec == b"s":
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    return zlib.compress(raw, 6)
+
+
+def decompress(payload, codec):
+    """
+    Decompress bytes
+    :param payload: compressed bytes
+    :param codec: b"s" for zstandard, b"z" for zlib
+    :return: bytes
+    """
+    if codec == b"s":
+        if zstandard is None:
+            raise RuntimeError("Cache entry is compressed with zstandard, install the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+
+class LazyEntry(Mapping):
+    """
+    Read-only dict of a packed cache entry. The value of a key is
+    decompressed and parsed the first time it is used.
+    """
+
+    def __init__(self, payload, codec, index, start):
+        """
+        :param payload: the packed entry
+        :param codec: codec of the parts
+        :param index: dict with key -> (offset, length) of the parts
+        :param start: offset of the first part in the payload
+        """
+        self.payload = payload
+        self.codec = codec
+        self.index = index
+        self.start = start
+        self.values = {}
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            offset, length = self.index[key]
+            begin = self.start + offset
+            self.values[key] = json_loads(decompress(self.payload[begin:begin + length], self.codec))
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def pack(data):
+    """
+    Pack a cache entry, every top-level key is compressed separately
+    :param data: the dict to store
+    :return: bytes
+    """
+    codec = b"s" if zstandard else b"z"
+    index = {}
+    parts = []
+    offset = 0
+    for key, value in data.items():
+        part = compress(json_dumps(value), codec)
+        index[key] = (offset, len(part))
+        parts.append(part)
+        offset += len(part)
+    header = json_dumps(index)
+    return PACKED_PREFIX.pack(PACKED_MAGIC, codec, len(header)) + header + b"".join(parts)
+
+
+def unpack(payload):
+    """
+    Unpack a cache entry, see pack
+    :param payload: the packed entry
+    :return: LazyEntry with the data
+    """
+    magic, codec, header_length = PACKED_PREFIX.unpack_from(payload)
+    if magic != PACKED_MAGIC:
+        raise ValueError("Not a packed cache entry")
+    start = PACKED_PREFIX.size + header_length
+    index = json_loads(payload[PACKED_PREFIX.size:start])
+    return LazyEntry(payload, codec, index, start)
+
+
+def materialize(data):
+    """
+    Convert a cache entry to a plain dict, e.g. for storing as JSON
+    :param data: dict or LazyEntry
+    :return: dict
+    """
+    if isinstance(data, LazyEntry):
+        return dict(data.items())
+    return data
+
+
+def content_hash(data):
+    """
+    Hash of the content of a response, independent of the order of keys and of
+    the JSON package used, e.g. to compare a downloaded response with the cached one
+    :param data: dict or LazyEntry
+    :return: hex string
+    """
+    text = json.dumps(materialize(data), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+class FileCache(object):
+    """
+    Cache with one file per entry, Cache/<year>/<date>_<name>.json
+    or Cache/<year>/<date>_<name>.fbz for compressed entries. Both
+    formats are read, the compress option selects the format written.
+    """
+
+    def __init__(self, directory="Cache", compress=False):
+        """
+        :param directory: root directory of the cache
+        :param compress: write compressed entries
+        """
+        self.directory = directory
+        self.compress = compress
+
+    def filename(self, name, date, extension=".json"):
+        """
+        Determine the filename of an entry, including subdirs
+        :param name: type of data
+        :param date: date of the data (string, format YYYY-MM-DD)
+        :param extension: ".json" or ".fbz"
+        :return: path of the file
+        """
+        return os.path.join(self.directory, date[:4], date + "_" + name + extension)
+
+    def contains(self, name, date):
+        """
+        Check if an entry is present, without reading it
+        :param name: type of data
+        :param date: date of the data
+        :return: True, if present
+        """
+        return os.path.isfile(self.filename(name, date, ".fbz")) or os.path.isfile(self.filename(name, date))
+
+    def read(self, name, date):
+        """
+        Read an entry
+        :param name: type of data
+        :param date: date of the data
+        :return: dict (or LazyEntry) with data or None
+        """
+        return self.load(name, date)[0]
+
+    def load(self, name, date):
+        """
+        Read an entry and the size of its stored form
+        :param name: type of data
+        :param date: date of the data
+        :return: (dict or LazyEntry with data or None, number of bytes)
+        """
+        fn = self.filename(name, date, ".fbz")
+        if os.path.isfile(fn):
+            with open(fn, 'rb') as fp:
+                payload = fp.read()
+            return unpack(payload), len(payload)
+        fn = self.filename(name, date)
+        if os.path.isfile(fn):
+            with open(fn, 'rb') as fp:
+                payload = fp.read()
+            return json_loads(payload), len(payload)
+        return None, 0
+
+    def write(self, name, date, data):
+        """
+        Store an entry, replaces an existing entry
+        :param name: type of data
+        :param date: date of the data
+        :param data: the dict to store
+        :return: number of bytes stored
+        """
+        compressed_fn = self.filename(name, date, ".fbz")
+        plain_fn = self.filename(name, date)
+        os.makedirs(os.path.dirname(plain_fn), exist_ok=True)
+        if self.compress:
+            fn, obsolete_fn, payload = compressed_fn, plain_fn, pack(data)
+        else:
+            fn, obsolete_fn, payload = plain_fn, compressed_fn, json_dumps(materialize(data))
+        with open(fn, 'wb') as fp:
+            fp.write(payload)
+        if os.path.isfile(obsolete_fn):
+            os.remove(obsolete_fn)
+        return len(payload)
+
+    def entries(self):
+        """
+        List all entries
+        :return: list of (name, date)
+        """
+        result = []
+        if not os.path.isdir(self.directory):
+            return result
+        for year in sorted(os.listdir(self.directory)):
+            year_dir = os.path.join(self.directory, year)
+            if not os.path.isdir(year_dir):
+                continue
+            names = set()
+            for fn in os.listdir(year_dir):
+                if (fn.endswith(".json") or fn.endswith(".fbz")) and fn[10:11] == "_":
+                    names.add((fn[11:-4 if fn.endswith(".fbz") else -5], fn[:10]))
+            result.extend(sorted(names, key=lambda entry: (entry[1], entry[0])))
+        return result
+
+    def close(self):
+        pass
+
+
+class SQLiteCache(object):
+    """
+    Cache stored in a single SQLite file, indexed on (name, date).
+    Entries are stored packed, see pack. Entries written as a single
+    zlib compressed JSON document are still read.
+    """
+
+    def __init__(self, filename=os.path.join("Cache", "cache.db")):
+        """
+        Open or create the cache file
+        :param filename: path of the SQLite file
+        """
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Shared by the download workers, access is serialized by the lock
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                              "name TEXT NOT NULL, date TEXT NOT NULL, data BLOB NOT NULL, "
+                              "PRIMARY KEY (name, date)) WITHOUT ROWID")
+            self.conn.commit()
+
+    def contains(self, name, date):
+        """
+        Check if an entry is present, without reading it
+        :param name: type of data
+        :param date: date of the data
+        :return: True, if present
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM cache WHERE name = ? AND date = ?", (name, date)).fetchone()
+        return row is not None
+
+    def read(self, name, date):
+        """
+        Read an entry
+        :param name: type of data
+        :param date: date of the data
+        :return: dict (or LazyEntry) with data or None
+        """
+        return self.load(name, date)[0]
+
+    def load(self, name, date):
+        """
+        Read an entry and the size of its stored form
+        :param name: type of data
+        :param date: date of the data
+        :return: (dict or LazyEntry with data or None, number of bytes)
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM cache WHERE name = ? AND date = ?", (name, date)).fetchone()
+        if row is None:
+            return None, 0
+        if row[0][:len(PACKED_MAGIC)] == PACKED_MAGIC:
+            return unpack(row[0]), len(row[0])
+        return json_loads(zlib.decompress(row[0])), len(row[0])
+
+    def write(self, name, date, data):
+        """
+        Store an entry, replaces an existing entry
+        :param name: type of data
+        :param date: date of the data
+        :param data: the dict to store
+        :return: number of bytes stored
+        """
+        blob = pack(data)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache (name, date, data) VALUES (?, ?, ?)", (name, date, blob))
+            self.conn.commit()
+        return len(blob)
+
+    def entries(self):
+        """
+        List all entries
+        :return: list of (name, date)
+        """
+        with self.lock:
+            return [tuple(row) for row in self.conn.execute("SELECT name, date FROM cache ORDER BY date, name")]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class MemoryCache(object):
+    """
+    Keeps the most recently used entries of a cache in memory, so an entry
+    read or written again during a run returns the same parsed dict without
+    reading the backend. The number of entries kept is limited, the least
+    recently used entries are evicted first. The size of the stored form of an
+    entry says little about the memory of its parsed dict, so entries are
+    counted instead of bytes.
+    """
+
+    def __init__(self, backend, max_entries=256):
+        """
+        :param backend: cache to keep entries of
+        :param max_entries: maximum number of entries kept
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.entries_in_memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _remember(self, key, data):
+        """
+        Keep an entry as most recently used and evict the oldest entries (caller holds the lock)
+        :return:
+        """
+        self.entries_in_memory.pop(key, None)
+        if self.max_entries <= 0:
+            return
+        self.entries_in_memory[key] = data
+        while len(self.entries_in_memory) > self.max_entries:
+            self.entries_in_memory.popitem(last=False)
+
+    def contains(self, name, date):
+        """
+        Check if an entry is present in memory or in the backend
+        :param name: type of data
+        :param date: date of the data
+        :return: True, if present
+        """
+        with self.lock:
+            if (name, date) in self.entries_in_memory:
+                return True
+        return self.backend.contains(name, date)
+
+    def read(self, name, date):
+        """
+        Read an entry, from memory if present
+        :param name: type of data
+        :param date: date of the data
+        :return: dict (or LazyEntry) with data or None
+        """
+        return self.load(name, date)[0]
+
+    def load(self, name, date):
+        """
+        Read an entry and the size of its stored form, from memory if present
+        :param name: type of data
+        :param date: date of the data
+        :return: (dict or LazyEntry with data or None, number of bytes read from the backend,
+                 0 if the entry is kept in memory)
+        """
+        with self.lock:
+            if (name, date) in self.entries_in_memory:
+                self.entries_in_memory.move_to_end((name, date))
+                return self.entries_in_memory[(name, date)], 0
+        data, size = self.backend.load(name, date)
+        if data is not None:
+            with self.lock:
+                self._remember((name, date), data)
+        return data, size
+
+    def write(self, name, date, data):
+        """
+        Store an entry in the backend and keep it in memory
+        :param name: type of data
+        :param date: date of the data
+        :param data: the dict to store
+        :return: number of bytes stored
+        """
+        size = self.backend.write(name, date, data)
+        with self.lock:
+            self._remember((name, date), data)
+        return size
+
+    def entries(self):
+        """
+        List all entries of the backend
+        :return: list of (name, date)
+        """
+        return self.backend.entries()
+
+    def close(self):
+        with self.lock:
+            self.entries_in_memory.clear()
+        self.backend.close()
+
+
+def open_cache(backend, directory="Cache", compress=False):
+    """
+    Open a cache backend
+    :param backend: name of the backend, one of BACKENDS
+    :param directory: root directory of the cache
+    :param compress: write compressed entries (files backend, sqlite is always compressed)
+    :return: cache object
+    """
+    if backend == "files":
+        return FileCache(directory, compress)
+    elif backend == "sqlite":
+        return SQLiteCache(os.path.join(directory, "cache.db"))
+    raise ValueError("Unknown cache backend: " + str(backend))
+
+
+def migrate_cache(source, target, overwrite=False):
+    """
+    Copy all entries of a cache to another cache
+    :param source: cache to read from
+    :param target: cache to write to
+    :param overwrite: replace entries already present in the target
+    :return: number of entries copied
+    """
+    count = 0
+    for name, date in source.entries():
+        if overwrite or not target.contains(name, date):
+            target.write(name, date, source.read(name, date))
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the Fitbit cache to another backend')
+    parser.add_argument('--from', dest='source', choices=BACKENDS, default="files",
+                        help="backend to read from. Default is files")
+    parser.add_argument('--to', dest='target', choices=BACKENDS, default="sqlite",
+                        help="backend to write to. Default is sqlite")
+    parser.add_argument('--dir', dest='directory', default="Cache",
+                        help="cache directory. Default is Cache")
+    parser.add_argument('--overwrite', dest='overwrite', action='store_true',
+                        help="replace entries already present in the target")
+    parser.add_argument('--compress', dest='compress', action='store_true',
+                        help="write compressed files (files backend)")
+    arguments = parser.parse_args()
+    if arguments.source == arguments.target and not (arguments.target == "files" and arguments.compress):
+        parser.error("source and target backend are the same")
+    source_cache = open_cache(arguments.source, arguments.directory)
+    target_cache = open_cache(arguments.target, arguments.directory, arguments.compress)
+    print("Copied {} entries".format(migrate_cache(source_cache, target_cache, arguments.overwrite)))
+    source_cache.close()
+    target_cache.close()
@@ -0,0 +1,450 @@
+import os
+import datetime
+import sqlite3
+import pandas as pd
+from fitbit_schema import TABLES, quote, table_exists, prepare_table, migrate
+from fitbit_frames import epoch_minute
+from fitbit_profile import profiled
+
+# Settings of the database connection of a download: write ahead log, commits
+# are not synced to disk before the next checkpoint (a committed day survives a
+# crash of the program, a power failure can only undo the last commits),
+# 64 MB page cache, database file memory mapped up to 256 MB
+SQLITE_PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", "-65536"),
+    ("mmap_size", "268435456"),
+    ("temp_store", "MEMORY"),
+]
+
+
+def unique_index_name(tablename):
+    """
+    Name of the unique index on the key columns of a table
+    :param tablename: name of the table
+    :return: index name
+    """
+    return "ux_" + tablename
+
+
+def ensure_table(cnx, dataframe, tablename, dup_cols):
+    """
+    Create a table for the dataframe if it does not exist. Tables of the schema are
+    created with their types and primary key (an existing table of an older version
+    is converted), missing columns are added. Other tables get the columns of the
+    dataframe and a unique index on the key columns. Rows of an existing table with
+    the same key are removed (keeping the last one) before the index is created.
+    :param cnx: Connection to the SQLite database
+    :param dataframe: Dataframe with the columns of the table
+    :param tablename: Tablename in the SQLite database
+    :param dup_cols: Key columns of the table
+    :return:
+    """
+    if tablename in TABLES:
+        prepare_table(cnx, tablename, dataframe.columns)
+        return
+    index_name = unique_index_name(tablename)
+    if cnx.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,)).fetchone():
+        return
+    if not table_exists(cnx, tablename):
+        cnx.execute("CREATE TABLE {} ({})".format(quote(tablename), ', '.join(
+            quote(col) + ' ' + column_type(dataframe[col]) for col in dataframe.columns)))
+    key = ', '.join(quote(col) for col in dup_cols)
+    cnx.execute("DELETE FROM {table} WHERE rowid NOT IN (SELECT max(rowid) FROM {table} GROUP BY {key})".format(
+        table=quote(tablename), key=key))
+    cnx.execute("CREATE UNIQUE INDEX {index} ON {table} ({key})".format(
+        index=quote(index_name), table=quote(tablename), key=key))
+
+
+@profiled('db upsert')
+def upsert_df(dataframe, tablename, cnx, dup_cols, update=False):
+    """
+    Insert the rows of a dataframe in a table. Rows with a key already present in
+    the table are skipped, or replace the stored values if update is set.
+    The cost does not depend on the number of rows already in the table.
+    :param dataframe: Dataframe to save
+    :param tablename: Tablename in the SQLite database
+    :param cnx: Connection to the SQLite database
+    :param dup_cols: Key columns of the table, e.g. ["Date", "Time"]
+    :param update: Replace the values of existing rows
+    :return: number of rows in the dataframe
+    """
+    ensure_table(cnx, dataframe, tablename, dup_cols)
+    dataframe = dataframe.drop_duplicates(dup_cols, keep='last')
+    columns = list(dataframe.columns)
+    if update and len(columns) > len(dup_cols):
+        conflict = "DO UPDATE SET " + ', '.join('{0} = excluded.{0}'.format(quote(col))
+                                                for col in columns if col not in dup_cols)
+    else:
+        conflict = "DO NOTHING"
+    sql = "INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT ({key}) {conflict}".format(
+        table=quote(tablename),
+        columns=', '.join(quote(col) for col in columns),
+        values=', '.join('?' * len(columns)),
+        key=', '.join(quote(col) for col in dup_cols),
+        conflict=conflict)
+    cnx.executemany(sql, zip(*[column_values(dataframe[col]) for col in columns]))
+    return len(dataframe)
+
+
+def column_type(series):
+    """
+    SQLite type of a column of a dataframe
+    :param series: column of a dataframe
+    :return: type name
+    """
+    if series.dtype.kind in 'iub':
+        return 'INTEGER'
+    if series.dtype.kind == 'f':
+        return 'REAL'
+    return 'TEXT'
+
+
+def column_values(series):
+    """
+    Values of a column as Python objects that SQLite can store, missing values as None
+    :param series: column of a dataframe
+    :return: list
+    """
+    values = series.tolist()
+    if series.hasnans:
+        mask = series.isna().tolist()
+        values = [None if missing else value for value, missing in zip(values, mask)]
+    return values
+
+
+def present_dates(cnx, tablename):
+    """
+    Dates present in a table, read in a single query on the index of the table
+    :param cnx: Connection to the SQLite database
+    :param tablename: Tablename in the SQLite database, with a column Date
+    :return: set of dates (string, format YYYY-MM-DD)
+    """
+    if not table_exists(cnx, tablename):
+        return set()
+    return set(row[0] for row in cnx.execute("SELECT DISTINCT Date FROM " + quote(tablename)))
+
+
+def present_minute_dates(cnx):
+    """
+    Dates present in the table Minute, keyed by the number of minutes since 1970-01-01
+    :param cnx: Connection to the SQLite database
+    :return: set of dates (string, format YYYY-MM-DD)
+    """
+    if not table_exists(cnx, 'Minute'):
+        return set()
+    return set(row[0] for row in cnx.execute(
+        "SELECT DISTINCT date(Minute / 1440 * 86400, 'unixepoch') FROM Minute"))
+
+
+def delete_day(cnx, tablename, day):
+    """
+    Delete the rows of a day from a table, e.g. before the data of the day is saved again
+    :param cnx: Connection to the SQLite database
+    :param tablename: Tablename in the SQLite database, with a column Date, or the table Minute
+    :param day: the day (datetime.date)
+    :return:
+    """
+    if not table_exists(cnx, tablename):
+        return
+    if tablename == 'Minute':
+        first = epoch_minute(day)
+        cnx.execute("DELETE FROM Minute WHERE Minute >= ? AND Minute < ?", (first, first + 1440))
+    else:
+        cnx.execute("DELETE FROM {} WHERE Date = ?".format(quote(tablename)), (day.strftime("%Y-%m-%d"),))
+
+
+def read_table(cnx, tablename):
+    """
+    Read a complete table
+    :param cnx: Connection to the SQLite database
+    :param tablename: Tablename in the SQLite database
+    :return: dataframe
+    """
+    return pd.read_sql("SELECT * FROM " + quote(tablename), cnx)
+
+
+def count_commit(cnx):
+    """
+    Increment the number of commits in the table Meta, see FitbitStore.data_version
+    :param cnx: Connection to the SQLite database
+    :return:
+    """
+    cnx.execute("INSERT INTO Meta (Name, Value) VALUES ('Commits', 1) "
+                "ON CONFLICT (Name) DO UPDATE SET Value = Value + 1")
+
+
+class TableBatches(object):
+    """
+    Rows of tables collected instead of written to the database, e.g. in a
+    worker process of a rebuild. It is passed to the save functions as their
+    database connection and used as their manifest, and written to the
+    database later by a single writer.
+    """
+
+    def __init__(self):
+        """
+        Create empty batches
+        """
+        self.frames = {}
+        self.fetched_entries = []
+        self.stored_entries = []
+
+    def add(self, dataframe, tablename, dup_cols):
+        """
+        Add the rows of a dataframe to the batch of a table
+        :param dataframe: Dataframe to save
+        :param tablename: Tablename in the SQLite database
+        :param dup_cols: Key columns of the table
+        :return:
+        """
+        self.frames.setdefault(tablename, (dup_cols, []))[1].append(dataframe)
+
+    def mark_fetched(self, entries):
+        """
+        Collect manifest entries of fetched responses, see Manifest.mark_fetched
+        :param entries: list of (endpoint, date)
+        :return:
+        """
+        self.fetched_entries.extend(entries)
+
+    def mark_stored(self, entries):
+        """
+        Collect manifest entries of stored data, see Manifest.mark_stored
+        :param entries: list of (endpoint, date)
+        :return:
+        """
+        self.stored_entries.extend(entries)
+
+    def combine(self):
+        """
+        Combine the dataframes of each table into a single dataframe
+        :return:
+        """
+        for tablename, (dup_cols, frames) in self.frames.items():
+            if len(frames) > 1:
+                self.frames[tablename] = (dup_cols, [pd.concat(frames, ignore_index=True)])
+
+    def write(self, cnx, manifest, update=False, sinks=()):
+        """
+        Write the batches to the database
+        :param cnx: Connection to the SQLite database
+        :param manifest: Manifest of the database
+        :param update: Replace the values of existing rows
+        :param sinks: output sinks that also receive the rows, see fitbit_sinks
+        :return: number of rows written
+        """
+        rows = 0
+        for tablename, (dup_cols, frames) in self.frames.items():
+            for frame in frames:
+                rows += upsert_df(frame, tablename, cnx, dup_cols, update=update)
+                for sink in sinks:
+                    sink.write(frame, None, None, tablename, dup_cols)
+        manifest.mark_fetched(self.fetched_entries)
+        manifest.mark_stored(self.stored_entries)
+        return rows
+
+
+class Manifest(object):
+    """
+    Record of the data stored per endpoint and day, in the table Manifest.
+    The status of an endpoint of a day is 'fetched' once its response is
+    read, and 'stored' once the data is saved in the database. Derived
+    data, such as the daily summary, is recorded under its own name.
+    The sync command also records the hash of the responses, and per endpoint
+    the last day up to which all days are stored (the watermark, table Sync).
+    """
+
+    def __init__(self, cnx):
+        """
+        Use the manifest of a database
+        :param cnx: Connection to the SQLite database
+        """
+        self.cnx = cnx
+        prepare_table(cnx, 'Manifest', ['Hash'])
+        prepare_table(cnx, 'Sync')
+
+    def stored(self):
+        """
+        All endpoints and days stored, read at once
+        :return: set of (endpoint, date)
+        """
+        return set(self.cnx.execute("SELECT Endpoint, Date FROM Manifest WHERE Status = 'stored'"))
+
+    def outdated(self, date):
+        """
+        Endpoints of a day stored before and marked to be saved again, see mark_outdated
+        :param date: date (string, format YYYY-MM-DD)
+        :return: set of endpoint names
+        """
+        return set(row[0] for row in self.cnx.execute(
+            "SELECT Endpoint FROM Manifest WHERE Date = ? AND Status != 'stored' AND Stored IS NOT NULL", (date,)))
+
+    def mark_fetched(self, entries):
+        """
+        Record that the responses of endpoints are read. Entries already stored keep their status.
+        :param entries: list of (endpoint, date)
+        :return:
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.cnx.executemany("INSERT INTO Manifest (Endpoint, Date, Status, Fetched) VALUES (?, ?, 'fetched', ?) "
+                             "ON CONFLICT (Endpoint, Date) DO UPDATE SET Fetched = excluded.Fetched",
+                             [(endpoint, date, now) for endpoint, date in entries])
+
+    def mark_stored(self, entries):
+        """
+        Record that the data of endpoints is saved in the database
+        :param entries: list of (endpoint, date)
+        :return:
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.cnx.executemany("INSERT INTO Manifest (Endpoint, Date, Status, Stored) VALUES (?, ?, 'stored', ?) "
+                             "ON CONFLICT (Endpoint, Date) DO UPDATE SET Status = 'stored', Stored = excluded.Stored",
+                             [(endpoint, date, now) for endpoint, date in entries])
+
+    def mark_outdated(self, entries):
+        """
+        Record that the data of endpoints must be saved again, e.g. after a changed response
+        :param entries: list of (endpoint, date)
+        :return:
+        """
+        self.cnx.executemany("UPDATE Manifest SET Status = 'fetched' WHERE Endpoint = ? AND Date = ?", entries)
+
+    def hashes(self, first_date, last_date):
+        """
+        Recorded hashes of the responses of a period
+        :param first_date: first date (string, format YYYY-MM-DD)
+        :param last_date: last date (string, format YYYY-MM-DD)
+        :return: dict with the hash per (endpoint, date)
+        """
+        return {(endpoint, date): value for endpoint, date, value in self.cnx.execute(
+            "SELECT Endpoint, Date, Hash FROM Manifest WHERE Date BETWEEN ? AND ? AND Hash IS NOT NULL",
+            (first_date, last_date))}
+
+    def mark_hashes(self, entries):
+        """
+        Record the hash of responses
+        :param entries: list of (endpoint, date, hash)
+        :return:
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.cnx.executemany("INSERT INTO Manifest (Endpoint, Date, Status, Fetched, Hash) "
+                             "VALUES (?, ?, 'fetched', ?, ?) ON CONFLICT (Endpoint, Date) "
+                             "DO UPDATE SET Fetched = excluded.Fetched, Hash = excluded.Hash",
+                             [(endpoint, date, now, value) for endpoint, date, value in entries])
+
+    def watermarks(self):
+        """
+        The last day synced completely per endpoint
+        :return: dict with the date (string, format YYYY-MM-DD) per endpoint
+        """
+        return dict(self.cnx.execute("SELECT Endpoint, Date FROM Sync"))
+
+    def set_watermarks(self, watermarks):
+        """
+        Record the last day synced completely of endpoints
+        :param watermarks: dict with the date (string, format YYYY-MM-DD) per endpoint
+        :return:
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.cnx.executemany("INSERT INTO Sync (Endpoint, Date, Synced) VALUES (?, ?, ?) "
+                             "ON CONFLICT (Endpoint) DO UPDATE SET Date = excluded.Date, Synced = excluded.Synced",
+                             [(endpoint, date, now) for endpoint, date in watermarks.items()])
+
+
+class StorageSession(object):
+    """
+    Database connection used during a download. All tables of a day are written
+    in a single transaction, which is committed after every commit_days days.
+    A day that fails is rolled back, without losing the days before it.
+    """
+
+    def __init__(self, filename=os.path.join('data', 'fitbit.db'), commit_days=1, records=None, aggregates=None,
+                 sinks=()):
+        """
+        Open the database and convert it to the current schema
+        :param filename: path of the SQLite file
+        :param commit_days: number of days per commit
+        :param records: RecordBuffer written before every commit, see fitbit_sinks
+        :param aggregates: Aggregates computed before every commit, see fitbit_aggregates
+        :param sinks: output sinks flushed before every commit, and rolled back with a day, see fitbit_sinks
+        """
+        self.connection = sqlite3.connect(filename)
+        for pragma, value in SQLITE_PRAGMAS:
+            self.connection.execute("PRAGMA {} = {}".format(pragma, value))
+        self.version = migrate(self.connection)
+        self.commit_days = max(1, commit_days)
+        self.pending_days = 0
+        self.in_day = False
+        self.records = records
+        self.aggregates = aggregates
+        self.sinks = sinks
+
+    def begin_day(self):
+        """
+        Start writing the data of a day
+        :return:
+        """
+        # Releasing a savepoint outside a transaction would commit the day
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+        self.connection.execute("SAVEPOINT day")
+        if self.records:
+            self.records.checkpoint()
+        for sink in self.sinks:
+            sink.checkpoint()
+        self.in_day = True
+
+    def end_day(self):
+        """
+        Finish writing the data of a day, commit if commit_days days are written
+        :return:
+        """
+        self.connection.execute("RELEASE day")
+        self.in_day = False
+        self.pending_days += 1
+        if self.pending_days >= self.commit_days:
+            self.commit()
+
+    def abort_day(self):
+        """
+        Undo the data written of the current day
+        :return:
+        """
+        if self.in_day:
+            self.connection.execute("ROLLBACK TO day")
+            self.connection.execute("RELEASE day")
+            if self.records:
+                self.records.rollback()
+            for sink in self.sinks:
+                sink.rollback()
+            self.in_day = False
+
+    @profiled('db commit')
+    def commit(self):
+        """
+        Commit the days written
+        :return:
+        """
+        if self.records:
+            self.records.flush(self.connection)
+        if self.aggregates:
+            self.aggregates.flush(self.connection)
+        # Written before the database, a day stored in the database is also in the sinks
+        for sink in self.sinks:
+            sink.flush()
+        if self.connection.in_transaction:
+            count_commit(self.connection)
+        self.connection.commit()
+        self.pending_days = 0
+
+    def close(self):
+        """
+        Commit the days written and close the database
+        :return:
+        """
+        self.abort_day()
+        self.commit()
+        self.connection.execute("PRAGMA optimize")
+        self.connection.close()
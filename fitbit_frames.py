@@ -0,0 +1,73 @@
+import datetime
+import numpy as np
+import pandas as pd
+from fitbit_profile import profiled
+
+# First day of the minute numbering
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def minute_of_day(times):
+    """
+    Convert times of day to the minute of the day, without parsing every time string
+    :param times: sequence of strings, format HH:MM or HH:MM:SS
+    :return: numpy array (int16)
+    """
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int16)
+    digits = np.asarray(times, dtype='S5').view(np.uint8).reshape(-1, 5).astype(np.int16) - ord('0')
+    return (digits[:, 0] * 10 + digits[:, 1]) * 60 + digits[:, 3] * 10 + digits[:, 4]
+
+
+@profiled('frame build')
+def dataset_to_frame(dataset, day_str, value_column, dtype=None, time_key='time'):
+    """
+    Convert an intraday dataset of the Fitbit API, a list of {time, value}
+    dicts, to a dataframe in a single pass. Columns are Date (categorical,
+    the same for all rows), Time and the value, the index is the minute of
+    the day.
+    :param dataset: list of dicts with time and value
+    :param day_str: date of the data (string, format YYYY-MM-DD)
+    :param value_column: name of the value column, e.g. 'Steps'
+    :param dtype: numpy type of the value, e.g. np.int32, or None to keep the values
+    :param time_key: key of the time in the dataset
+    :return: dataframe
+    """
+    records = pd.DataFrame.from_records(dataset, columns=[time_key, 'value'])
+    times = records[time_key].to_numpy(dtype=object)
+    values = records['value'].to_numpy(dtype=dtype if dtype else object)
+    frame = pd.DataFrame({
+        'Date': pd.Categorical.from_codes(np.zeros(len(records), dtype=np.int8), categories=[day_str]),
+        'Time': times,
+        value_column: values
+    }, index=pd.Index(minute_of_day(times), name='Minute'))
+    return frame
+
+
+def epoch_minute(day):
+    """
+    Number of the first minute of a day, counted from 1970-01-01 00:00 (local time)
+    :param day: the day (datetime.date)
+    :return: int
+    """
+    return (day.toordinal() - EPOCH.toordinal()) * 1440
+
+
+@profiled('frame combine minutes')
+def combine_minutes(intraday, day, columns):
+    """
+    Combine the intraday dataframes of a day into one row per minute, see dataset_to_frame.
+    Minutes without a value of a column are empty (NaN).
+    :param intraday: dict with the intraday dataframe per value column
+    :param day: day of the data (datetime.date)
+    :param columns: value columns, in order
+    :return: dataframe with column Minute (minutes since 1970-01-01) and the value columns
+    """
+    values = [intraday[column][column] for column in columns if column in intraday]
+    if values:
+        combined = pd.concat(values, axis=1).sort_index()
+    else:
+        combined = pd.DataFrame(columns=columns, index=pd.Index([], dtype=np.int16, name='Minute'))
+    combined = combined.reindex(columns=columns)
+    combined.insert(0, 'Minute', combined.index.astype(np.int64) + epoch_minute(day))
+    return combined.reset_index(drop=True)
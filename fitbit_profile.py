@@ -0,0 +1,169 @@
+"""
+Timing of the stages of a download, enabled with --profile.
+
+Every instrumented function (save functions, cache, Fitbit API, dataframes,
+database, sinks) is a stage. Per stage the number of calls, the time and the
+bytes read or written are counted. The time of a stage includes the stages it
+calls, e.g. save_sleep includes the cache read of the sleep data.
+
+With a trace file every call is also recorded as an event of a trace in the
+Chrome trace format, which can be opened in chrome://tracing or https://ui.perfetto.dev
+"""
+import os
+import json
+import time
+import threading
+from functools import wraps
+
+
+class Profiler(object):
+    """
+    Statistics per stage, and the events of a trace
+    """
+
+    def __init__(self):
+        """
+        Create a disabled profiler
+        """
+        self.enabled = False
+        self.trace = False
+        self.stages = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def enable(self, trace=False):
+        """
+        Start counting
+        :param trace: also record every call as a trace event
+        :return:
+        """
+        self.enabled = True
+        self.trace = trace
+
+    def add(self, stage, start, seconds, nbytes=0, calls=1):
+        """
+        Count a call of a stage
+        :param stage: name of the stage
+        :param start: start of the call (time.perf_counter)
+        :param seconds: duration of the call
+        :param nbytes: bytes read or written
+        :param calls: number of calls
+        :return:
+        """
+        with self.lock:
+            stats = self.stages.setdefault(stage, [0, 0.0, 0])
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] += nbytes
+            if self.trace and calls:
+                self.events.append({'name': stage, 'ph': 'X', 'ts': round(start * 1e6, 1),
+                                    'dur': round(seconds * 1e6, 1), 'pid': os.getpid(),
+                                    'tid': threading.get_ident()})
+
+    def add_bytes(self, stage, nbytes):
+        """
+        Count bytes read or written by a stage, without counting a call
+        :param stage: name of the stage
+        :param nbytes: number of bytes
+        :return:
+        """
+        if self.enabled:
+            self.add(stage, 0.0, 0.0, nbytes, calls=0)
+
+    def call(self, stage, function, *args, **kwargs):
+        """
+        Call a function as a stage
+        :param stage: name of the stage
+        :param function: function to call
+        :return: result of the function
+        """
+        if not self.enabled:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.add(stage, start, time.perf_counter() - start)
+
+    def take(self):
+        """
+        Remove the statistics and events counted so far, e.g. to send them from a worker process
+        :return: (stages, events), see merge
+        """
+        with self.lock:
+            taken = (self.stages, self.events)
+            self.stages = {}
+            self.events = []
+        return taken
+
+    def merge(self, taken):
+        """
+        Add the statistics and events of another profiler
+        :param taken: (stages, events), see take
+        :return:
+        """
+        stages, events = taken
+        with self.lock:
+            for stage, (calls, seconds, nbytes) in stages.items():
+                stats = self.stages.setdefault(stage, [0, 0.0, 0])
+                stats[0] += calls
+                stats[1] += seconds
+                stats[2] += nbytes
+            if self.trace:
+                self.events.extend(events)
+
+    def summary(self):
+        """
+        Statistics per stage, the stage with the most time first
+        :return: list of dicts with stage, calls, seconds, ms_per_call and bytes
+        """
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+        return [{'stage': stage, 'calls': calls, 'seconds': round(seconds, 4),
+                 'ms_per_call': round(1000 * seconds / calls, 3) if calls else None, 'bytes': nbytes}
+                for stage, (calls, seconds, nbytes) in stages]
+
+    def report(self):
+        """
+        Print the statistics per stage
+        :return:
+        """
+        print("Profile (time includes the stages called)")
+        print("------------------------------------------------")
+        print("{:<28} {:>8} {:>10} {:>10} {:>10}".format("Stage", "Calls", "Seconds", "ms/call", "MB"))
+        for row in self.summary():
+            print("{:<28} {:>8} {:>10.3f} {:>10} {:>10.2f}".format(
+                row['stage'], row['calls'], row['seconds'],
+                '' if row['ms_per_call'] is None else '{:.3f}'.format(row['ms_per_call']), row['bytes'] / 1e6))
+        print("------------------------------------------------")
+
+    def write_trace(self, filename):
+        """
+        Write the events in the Chrome trace format, with the statistics per stage
+        :param filename: name of the trace file (JSON)
+        :return:
+        """
+        with self.lock:
+            events = list(self.events)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'stages': self.summary()}}, f)
+
+
+# Profiler of the application
+profiler = Profiler()
+
+
+def profiled(stage):
+    """
+    Decorator counting the calls of a function as a stage of the profiler
+    :param stage: name of the stage
+    :return: decorator
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            return profiler.call(stage, function, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,484 @@
+# Version of the database layout, stored in PRAGMA user_version
+SCHEMA_VERSION = 5
+
+# First version with the table Manifest
+MANIFEST_VERSION = 2
+
+# First version with the aggregate tables
+AGGREGATES_VERSION = 3
+
+# First version with the sync watermarks and the hashes of the responses in the manifest
+SYNC_VERSION = 4
+
+# First version with the table Meta, counting the commits of the downloads
+META_VERSION = 5
+
+ACTIVITY_SUMMARY_COLUMNS = [
+    ('Goal Active Minutes', 'INTEGER'),
+    ('Goal Calories Out', 'INTEGER'),
+    ('Goal Distance', 'REAL'),
+    ('Goal Floors', 'INTEGER'),
+    ('Goal Steps', 'INTEGER'),
+    ('Active Score', 'INTEGER'),
+    ('Steps', 'INTEGER'),
+    ('Distance', 'REAL'),
+    ('Elevation', 'REAL'),
+    ('Floors', 'INTEGER'),
+    ('Resting Heart Rate', 'INTEGER'),
+    ('Activity Calories', 'INTEGER'),
+    ('Calories BMR', 'INTEGER'),
+    ('Marginal Calories', 'INTEGER'),
+    ('Calories Out', 'INTEGER'),
+    ('Sedentary Minutes', 'INTEGER'),
+    ('Lightly Active Minutes', 'INTEGER'),
+    ('Fairly Active Minutes', 'INTEGER'),
+    ('Very Active Minutes', 'INTEGER'),
+]
+
+SLEEP_SUMMARY_COLUMNS = [
+    ('Minutes Asleep', 'INTEGER'),
+    ('Sleep Records', 'INTEGER'),
+    ('Time in Bed', 'INTEGER'),
+    ('Stage Deep', 'INTEGER'),
+    ('Stage Light', 'INTEGER'),
+    ('Stage REM', 'INTEGER'),
+    ('Stage Wake', 'INTEGER'),
+]
+
+# Column names as created by save_heart and create_daily_summary
+HEART_ZONE_COLUMNS = [
+    ('Zone0 Calories', 'REAL'), ('Zone0 Mxax', 'INTEGER'), ('Zone0 Min', 'INTEGER'),
+    ('Zone0 Minutes', 'INTEGER'), ('Zone0  Name', 'TEXT'),
+] + [
+    (name.format(j), kind) for j in range(1, 4) for name, kind in [
+        ('Zone{} Calories', 'REAL'), ('Zone{} Max', 'INTEGER'), ('Zone{} Min', 'INTEGER'),
+        ('Zone{} Minutes', 'INTEGER'), ('Zone{} Name', 'TEXT')]
+]
+
+SLEEP_COLUMNS = [
+    ('Start Time', 'TEXT'),
+    ('End Time', 'TEXT'),
+    ('Time In Bed', 'INTEGER'),
+    ('Awake Count', 'INTEGER'),
+    ('Awake Duration', 'INTEGER'),
+    ('Awakenings Count', 'INTEGER'),
+    ('Duration', 'INTEGER'),
+    ('Efficiency', 'INTEGER'),
+]
+
+SLEEP_MINUTE_COLUMNS = [
+    ('Minutes After Wakeup', 'INTEGER'),
+    ('Minutes Asleep', 'INTEGER'),
+    ('Minutes Awake', 'INTEGER'),
+    ('Minutes To Fall Asleep', 'INTEGER'),
+    ('Restless Count', 'INTEGER'),
+    ('Restless Duration', 'INTEGER'),
+]
+
+# Columns of the weekly and monthly aggregates, see fitbit_aggregates
+PERIOD_COLUMNS = [
+    ('Days', 'INTEGER'),
+    ('Steps', 'INTEGER'),
+    ('Steps Mean', 'REAL'),
+    ('Distance', 'REAL'),
+    ('Floors', 'INTEGER'),
+    ('Calories Out', 'INTEGER'),
+    ('Active Minutes', 'INTEGER'),
+    ('Minutes Asleep', 'INTEGER'),
+    ('Minutes Asleep Mean', 'REAL'),
+    ('Time in Bed', 'INTEGER'),
+    ('Resting Heart Rate', 'REAL'),
+    ('Heart Rate', 'REAL'),
+    ('Heart Rate Minutes', 'INTEGER'),
+]
+
+# Tables maintained by fitbit_aggregates instead of the save functions
+AGGREGATE_TABLES = ['Aggregate_Hour', 'Aggregate_Day', 'Aggregate_Week', 'Aggregate_Month']
+
+
+def intraday_table(value_column, kind):
+    """
+    Definition of a table with a value per minute
+    :param value_column: name of the value column
+    :param kind: SQLite type of the value
+    :return: table definition, see TABLES
+    """
+    return {'columns': [('Date', 'TEXT'), ('Time', 'TEXT'), (value_column, kind)],
+            'key': ['Date', 'Time'], 'indexes': [], 'without_rowid': True}
+
+
+# Tables of the database: typed columns, primary key (the key used by save_df to
+# prevent duplicates), additional indexes and whether the rows are stored in key order
+TABLES = {
+    'Steps_1m': intraday_table('Steps', 'INTEGER'),
+    'Floors_1m': intraday_table('Floors', 'INTEGER'),
+    'Elevation_1m': intraday_table('Elevation', 'REAL'),
+    'Distance_1m': intraday_table('Distance', 'REAL'),
+    'Calories_1m': intraday_table('Calories', 'REAL'),
+    'Heartrate': intraday_table('Heart Rate', 'INTEGER'),
+    'Steps_Summary': {
+        'columns': [('Date', 'TEXT'), ('Steps', 'INTEGER')],
+        'key': ['Date'], 'indexes': [], 'without_rowid': False},
+    'Heartrate_Summary': {
+        'columns': [('Date', 'TEXT'), ('Resting Heart Rate', 'INTEGER')] + HEART_ZONE_COLUMNS,
+        'key': ['Date'], 'indexes': [], 'without_rowid': False},
+    'HeartRate_Zones': {
+        'columns': [('Date', 'TEXT'), ('Name', 'TEXT'), ('ID', 'INTEGER'), ('Minutes', 'INTEGER'),
+                    ('Calories', 'REAL'), ('Min', 'INTEGER'), ('Max', 'INTEGER')],
+        'key': ['Date', 'Name'], 'indexes': [], 'without_rowid': False},
+    'Sleep_Summary': {
+        'columns': [('Date', 'TEXT')] + SLEEP_SUMMARY_COLUMNS,
+        'key': ['Date'], 'indexes': [], 'without_rowid': False},
+    'Sleep': {
+        'columns': [('Date', 'TEXT'), ('Log Count', 'INTEGER')] + SLEEP_COLUMNS +
+                   [('Main Sleep', 'INTEGER'), ('Log ID', 'INTEGER')] + SLEEP_MINUTE_COLUMNS,
+        'key': ['Date', 'Log Count'], 'indexes': [], 'without_rowid': False},
+    'Sleep_1m': {
+        'columns': [('Date', 'TEXT'), ('LogID', 'INTEGER'), ('Time', 'TEXT'), ('Value', 'INTEGER')],
+        'key': ['Date', 'LogID', 'Time'], 'indexes': [], 'without_rowid': True},
+    'Distance': {
+        'columns': [('Date', 'TEXT'), ('Activity', 'TEXT'), ('Distance', 'REAL')],
+        'key': ['Date', 'Activity'], 'indexes': [], 'without_rowid': False},
+    'Activities_Summary': {
+        'columns': [('Date', 'TEXT')] + ACTIVITY_SUMMARY_COLUMNS,
+        'key': ['Date'], 'indexes': [], 'without_rowid': False},
+    'Daily_Summary': {
+        'columns': [('Date', 'TEXT')] + ACTIVITY_SUMMARY_COLUMNS + SLEEP_SUMMARY_COLUMNS + HEART_ZONE_COLUMNS +
+                   [('Sleep ' + name, kind) for name, kind in SLEEP_COLUMNS + SLEEP_MINUTE_COLUMNS],
+        'key': ['Date'], 'indexes': [], 'without_rowid': False},
+    'Body': {
+        'columns': [('Date', 'TEXT'), ('Weight', 'REAL'), ('Bodyfat', 'REAL'), ('BMI', 'REAL')],
+        'key': ['Date'], 'indexes': [], 'without_rowid': False},
+    'Training': {
+        'columns': [('Date', 'TEXT'), ('ID', 'INTEGER'), ('Start', 'TEXT'), ('Type', 'TEXT'),
+                    ('Duration', 'INTEGER'), ('Steps', 'INTEGER'), ('AverageHeartRate', 'INTEGER'),
+                    ('Calories', 'INTEGER'), ('ElevationGain', 'REAL'),
+                    ('HeartRateZone0', 'INTEGER'), ('HeartRateZone1', 'INTEGER'),
+                    ('HeartRateZone2', 'INTEGER'), ('HeartRateZone3', 'INTEGER'),
+                    ('ActiveDuration', 'INTEGER'),
+                    ('ActivityLevel0', 'INTEGER'), ('ActivityLevel1', 'INTEGER'),
+                    ('ActivityLevel2', 'INTEGER'), ('ActivityLevel3', 'INTEGER')],
+        'key': ['ID'], 'indexes': [['Date']], 'without_rowid': False},
+    'Minute': {
+        'columns': [('Minute', 'INTEGER'), ('Steps', 'INTEGER'), ('Heart Rate', 'INTEGER'),
+                    ('Calories', 'REAL'), ('Distance', 'REAL'), ('Floors', 'INTEGER'), ('Elevation', 'REAL')],
+        'key': ['Minute'], 'indexes': [], 'without_rowid': True},
+    'Manifest': {
+        'columns': [('Endpoint', 'TEXT'), ('Date', 'TEXT'), ('Status', 'TEXT'),
+                    ('Fetched', 'TEXT'), ('Stored', 'TEXT'), ('Hash', 'TEXT')],
+        'key': ['Endpoint', 'Date'], 'indexes': [['Date']], 'without_rowid': True},
+    'Sync': {
+        'columns': [('Endpoint', 'TEXT'), ('Date', 'TEXT'), ('Synced', 'TEXT')],
+        'key': ['Endpoint'], 'indexes': [], 'without_rowid': True},
+    'Meta': {
+        'columns': [('Name', 'TEXT'), ('Value', 'INTEGER')],
+        'key': ['Name'], 'indexes': [], 'without_rowid': True},
+    'Aggregate_Hour': {
+        'columns': [('Date', 'TEXT'), ('Hour', 'INTEGER'), ('Steps', 'INTEGER'), ('Distance', 'REAL'),
+                    ('Floors', 'INTEGER'), ('Calories', 'REAL'), ('Heart Rate', 'REAL'),
+                    ('Heart Rate Min', 'INTEGER'), ('Heart Rate Max', 'INTEGER'), ('Heart Rate Minutes', 'INTEGER')],
+        'key': ['Date', 'Hour'], 'indexes': [], 'without_rowid': True},
+    'Aggregate_Day': {
+        'columns': [('Date', 'TEXT'), ('Week', 'TEXT'), ('Month', 'TEXT'), ('Weekday', 'INTEGER'),
+                    ('Steps', 'INTEGER'), ('Distance', 'REAL'), ('Floors', 'INTEGER'), ('Calories Out', 'INTEGER'),
+                    ('Active Minutes', 'INTEGER'), ('Minutes Asleep', 'INTEGER'), ('Time in Bed', 'INTEGER'),
+                    ('Resting Heart Rate', 'INTEGER'), ('Heart Rate', 'REAL'), ('Heart Rate Minutes', 'INTEGER')],
+        'key': ['Date'], 'indexes': [['Week'], ['Month']], 'without_rowid': False},
+    'Aggregate_Week': {
+        'columns': [('Week', 'TEXT')] + PERIOD_COLUMNS,
+        'key': ['Week'], 'indexes': [], 'without_rowid': False},
+    'Aggregate_Month': {
+        'columns': [('Month', 'TEXT')] + PERIOD_COLUMNS,
+        'key': ['Month'], 'indexes': [], 'without_rowid': False},
+}
+
+
+def quote(name):
+    """
+    Quote a table or column name for SQLite
+    :param name: name
+    :return: quoted name
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def table_exists(cnx, tablename):
+    """
+    Check if a table exists
+    :param cnx: Connection to the SQLite database
+    :param tablename: name of the table
+    :return: True if the table exists
+    """
+    return cnx.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                       (tablename,)).fetchone() is not None
+
+
+def table_columns(cnx, tablename):
+    """
+    Columns of a table
+    :param cnx: Connection to the SQLite database
+    :param tablename: name of the table
+    :return: list of column names
+    """
+    return [row[1] for row in cnx.execute("PRAGMA table_info({})".format(quote(tablename)))]
+
+
+def create_table(cnx, tablename, name=None, table=None):
+    """
+    Create a table of the schema and its indexes, if it does not exist
+    :param cnx: Connection to the SQLite database
+    :param tablename: name of the table in TABLES
+    :param name: name of the created table, default tablename
+    :param table: definition of the table, default the definition in TABLES
+    :return:
+    """
+    table = table or TABLES[tablename]
+    name = name or tablename
+    cnx.execute("CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({})){}".format(
+        quote(name),
+        ', '.join(quote(column) + ' ' + kind for column, kind in table['columns']),
+        ', '.join(quote(column) for column in table['key']),
+        ' WITHOUT ROWID' if table['without_rowid'] else ''))
+    for columns in table['indexes']:
+        cnx.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+            quote('ix_' + name + '_' + '_'.join(columns)), quote(name),
+            ', '.join(quote(column) for column in columns)))
+
+
+def add_columns(cnx, tablename, columns):
+    """
+    Add columns that are not yet present to a table, e.g. fields added to the Fitbit API
+    :param cnx: Connection to the SQLite database
+    :param tablename: name of the table
+    :param columns: column names
+    :return:
+    """
+    present = set(table_columns(cnx, tablename))
+    for column in columns:
+        if column not in present:
+            cnx.execute("ALTER TABLE {} ADD COLUMN {}".format(quote(tablename), quote(column)))
+
+
+def rebuild_table(cnx, tablename, table=None):
+    """
+    Convert a table created by an older version to the schema. The rows are copied
+    in their original order to a new table, the column types of the schema convert
+    numbers stored as text. Of rows with the same key the last one is kept.
+    Columns that are not part of the schema are kept as untyped columns.
+    :param cnx: Connection to the SQLite database
+    :param tablename: name of the table in TABLES
+    :param table: definition of the table, default the definition in TABLES
+    :return:
+    """
+    table = table or TABLES[tablename]
+    old_name = tablename + '_old'
+    cnx.execute("ALTER TABLE {} RENAME TO {}".format(quote(tablename), quote(old_name)))
+    old_columns = table_columns(cnx, old_name)
+    create_table(cnx, tablename, table=table)
+    add_columns(cnx, tablename, old_columns)
+    key = table['key']
+    if all(column in old_columns for column in key):
+        columns = ', '.join(quote(column) for column in old_columns)
+        cnx.execute("INSERT OR REPLACE INTO {} ({}) SELECT {} FROM {} WHERE {} ORDER BY rowid".format(
+            quote(tablename), columns, columns, quote(old_name),
+            ' AND '.join(quote(column) + ' IS NOT NULL' for column in key)))
+    cnx.execute("DROP TABLE {}".format(quote(old_name)))
+
+
+def prepare_table(cnx, tablename, columns=(), table=None):
+    """
+    Make sure a table of the schema exists with a primary key and the given columns.
+    A table created by an older version is converted, see rebuild_table.
+    :param cnx: Connection to the SQLite database
+    :param tablename: name of the table in TABLES
+    :param columns: column names that must be present
+    :param table: definition of the table, default the definition in TABLES. A migration
+                  passes the definition of its own version, so that later changes of
+                  TABLES do not change what it creates.
+    :return:
+    """
+    info = cnx.execute("PRAGMA table_info({})".format(quote(tablename))).fetchall()
+    if not info:
+        create_table(cnx, tablename, table=table)
+    elif not any(row[5] for row in info):
+        rebuild_table(cnx, tablename, table=table)
+    present = set(row[1] for row in info)
+    if any(column not in present for column in columns):
+        add_columns(cnx, tablename, columns)
+
+
+def migrate_to_1(cnx):
+    """
+    Typed tables with primary keys, replacing the tables created by DataFrame.to_sql
+    :param cnx: Connection to the SQLite database
+    :return:
+    """
+    def table(columns, key, indexes=(), without_rowid=False):
+        return {'columns': columns, 'key': key, 'indexes': list(indexes), 'without_rowid': without_rowid}
+
+    activity_summary = [
+        ('Goal Active Minutes', 'INTEGER'), ('Goal Calories Out', 'INTEGER'), ('Goal Distance', 'REAL'),
+        ('Goal Floors', 'INTEGER'), ('Goal Steps', 'INTEGER'), ('Active Score', 'INTEGER'), ('Steps', 'INTEGER'),
+        ('Distance', 'REAL'), ('Elevation', 'REAL'), ('Floors', 'INTEGER'), ('Resting Heart Rate', 'INTEGER'),
+        ('Activity Calories', 'INTEGER'), ('Calories BMR', 'INTEGER'), ('Marginal Calories', 'INTEGER'),
+        ('Calories Out', 'INTEGER'), ('Sedentary Minutes', 'INTEGER'), ('Lightly Active Minutes', 'INTEGER'),
+        ('Fairly Active Minutes', 'INTEGER'), ('Very Active Minutes', 'INTEGER')]
+    sleep_summary = [
+        ('Minutes Asleep', 'INTEGER'), ('Sleep Records', 'INTEGER'), ('Time in Bed', 'INTEGER'),
+        ('Stage Deep', 'INTEGER'), ('Stage Light', 'INTEGER'), ('Stage REM', 'INTEGER'), ('Stage Wake', 'INTEGER')]
+    heart_zones = [
+        ('Zone0 Calories', 'REAL'), ('Zone0 Mxax', 'INTEGER'), ('Zone0 Min', 'INTEGER'),
+        ('Zone0 Minutes', 'INTEGER'), ('Zone0  Name', 'TEXT')] + [
+        (name.format(j), kind) for j in range(1, 4) for name, kind in [
+            ('Zone{} Calories', 'REAL'), ('Zone{} Max', 'INTEGER'), ('Zone{} Min', 'INTEGER'),
+            ('Zone{} Minutes', 'INTEGER'), ('Zone{} Name', 'TEXT')]]
+    sleep = [
+        ('Start Time', 'TEXT'), ('End Time', 'TEXT'), ('Time In Bed', 'INTEGER'), ('Awake Count', 'INTEGER'),
+        ('Awake Duration', 'INTEGER'), ('Awakenings Count', 'INTEGER'), ('Duration', 'INTEGER'),
+        ('Efficiency', 'INTEGER')]
+    sleep_minutes = [
+        ('Minutes After Wakeup', 'INTEGER'), ('Minutes Asleep', 'INTEGER'), ('Minutes Awake', 'INTEGER'),
+        ('Minutes To Fall Asleep', 'INTEGER'), ('Restless Count', 'INTEGER'), ('Restless Duration', 'INTEGER')]
+    tables = {
+        'Steps_1m': table([('Date', 'TEXT'), ('Time', 'TEXT'), ('Steps', 'INTEGER')], ['Date', 'Time'],
+                          without_rowid=True),
+        'Floors_1m': table([('Date', 'TEXT'), ('Time', 'TEXT'), ('Floors', 'INTEGER')], ['Date', 'Time'],
+                           without_rowid=True),
+        'Elevation_1m': table([('Date', 'TEXT'), ('Time', 'TEXT'), ('Elevation', 'REAL')], ['Date', 'Time'],
+                              without_rowid=True),
+        'Distance_1m': table([('Date', 'TEXT'), ('Time', 'TEXT'), ('Distance', 'REAL')], ['Date', 'Time'],
+                             without_rowid=True),
+        'Calories_1m': table([('Date', 'TEXT'), ('Time', 'TEXT'), ('Calories', 'REAL')], ['Date', 'Time'],
+                             without_rowid=True),
+        'Heartrate': table([('Date', 'TEXT'), ('Time', 'TEXT'), ('Heart Rate', 'INTEGER')], ['Date', 'Time'],
+                           without_rowid=True),
+        'Steps_Summary': table([('Date', 'TEXT'), ('Steps', 'INTEGER')], ['Date']),
+        'Heartrate_Summary': table([('Date', 'TEXT'), ('Resting Heart Rate', 'INTEGER')] + heart_zones, ['Date']),
+        'HeartRate_Zones': table([('Date', 'TEXT'), ('Name', 'TEXT'), ('ID', 'INTEGER'), ('Minutes', 'INTEGER'),
+                                  ('Calories', 'REAL'), ('Min', 'INTEGER'), ('Max', 'INTEGER')], ['Date', 'Name']),
+        'Sleep_Summary': table([('Date', 'TEXT')] + sleep_summary, ['Date']),
+        'Sleep': table([('Date', 'TEXT'), ('Log Count', 'INTEGER')] + sleep +
+                       [('Main Sleep', 'INTEGER'), ('Log ID', 'INTEGER')] + sleep_minutes, ['Date', 'Log Count']),
+        'Sleep_1m': table([('Date', 'TEXT'), ('LogID', 'INTEGER'), ('Time', 'TEXT'), ('Value', 'INTEGER')],
+                          ['Date', 'LogID', 'Time'], without_rowid=True),
+        'Distance': table([('Date', 'TEXT'), ('Activity', 'TEXT'), ('Distance', 'REAL')], ['Date', 'Activity']),
+        'Activities_Summary': table([('Date', 'TEXT')] + activity_summary, ['Date']),
+        'Daily_Summary': table([('Date', 'TEXT')] + activity_summary + sleep_summary + heart_zones +
+                               [('Sleep ' + name, kind) for name, kind in sleep + sleep_minutes], ['Date']),
+        'Body': table([('Date', 'TEXT'), ('Weight', 'REAL'), ('Bodyfat', 'REAL'), ('BMI', 'REAL')], ['Date']),
+        'Training': table([('Date', 'TEXT'), ('ID', 'INTEGER'), ('Start', 'TEXT'), ('Type', 'TEXT'),
+                           ('Duration', 'INTEGER'), ('Steps', 'INTEGER'), ('AverageHeartRate', 'INTEGER'),
+                           ('Calories', 'INTEGER'), ('ElevationGain', 'REAL'),
+                           ('HeartRateZone0', 'INTEGER'), ('HeartRateZone1', 'INTEGER'),
+                           ('HeartRateZone2', 'INTEGER'), ('HeartRateZone3', 'INTEGER'),
+                           ('ActiveDuration', 'INTEGER'),
+                           ('ActivityLevel0', 'INTEGER'), ('ActivityLevel1', 'INTEGER'),
+                           ('ActivityLevel2', 'INTEGER'), ('ActivityLevel3', 'INTEGER')], ['ID'], indexes=[['Date']]),
+        'Minute': table([('Minute', 'INTEGER'), ('Steps', 'INTEGER'), ('Heart Rate', 'INTEGER'),
+                         ('Calories', 'REAL'), ('Distance', 'REAL'), ('Floors', 'INTEGER'), ('Elevation', 'REAL')],
+                        ['Minute'], without_rowid=True),
+    }
+    for tablename, definition in tables.items():
+        prepare_table(cnx, tablename, table=definition)
+
+
+def migrate_to_2(cnx):
+    """
+    Table Manifest, recording per endpoint and day what is fetched and stored
+    :param cnx: Connection to the SQLite database
+    :return:
+    """
+    prepare_table(cnx, 'Manifest', table={
+        'columns': [('Endpoint', 'TEXT'), ('Date', 'TEXT'), ('Status', 'TEXT'), ('Fetched', 'TEXT'),
+                    ('Stored', 'TEXT')],
+        'key': ['Endpoint', 'Date'], 'indexes': [['Date']], 'without_rowid': True})
+
+
+def migrate_to_3(cnx):
+    """
+    Hourly, daily, weekly and monthly aggregate tables, filled by fitbit_aggregates
+    :param cnx: Connection to the SQLite database
+    :return:
+    """
+    period = [
+        ('Days', 'INTEGER'), ('Steps', 'INTEGER'), ('Steps Mean', 'REAL'), ('Distance', 'REAL'),
+        ('Floors', 'INTEGER'), ('Calories Out', 'INTEGER'), ('Active Minutes', 'INTEGER'),
+        ('Minutes Asleep', 'INTEGER'), ('Minutes Asleep Mean', 'REAL'), ('Time in Bed', 'INTEGER'),
+        ('Resting Heart Rate', 'REAL'), ('Heart Rate', 'REAL'), ('Heart Rate Minutes', 'INTEGER')]
+    tables = {
+        'Aggregate_Hour': {
+            'columns': [('Date', 'TEXT'), ('Hour', 'INTEGER'), ('Steps', 'INTEGER'), ('Distance', 'REAL'),
+                        ('Floors', 'INTEGER'), ('Calories', 'REAL'), ('Heart Rate', 'REAL'),
+                        ('Heart Rate Min', 'INTEGER'), ('Heart Rate Max', 'INTEGER'),
+                        ('Heart Rate Minutes', 'INTEGER')],
+            'key': ['Date', 'Hour'], 'indexes': [], 'without_rowid': True},
+        'Aggregate_Day': {
+            'columns': [('Date', 'TEXT'), ('Week', 'TEXT'), ('Month', 'TEXT'), ('Weekday', 'INTEGER'),
+                        ('Steps', 'INTEGER'), ('Distance', 'REAL'), ('Floors', 'INTEGER'),
+                        ('Calories Out', 'INTEGER'), ('Active Minutes', 'INTEGER'), ('Minutes Asleep', 'INTEGER'),
+                        ('Time in Bed', 'INTEGER'), ('Resting Heart Rate', 'INTEGER'), ('Heart Rate', 'REAL'),
+                        ('Heart Rate Minutes', 'INTEGER')],
+            'key': ['Date'], 'indexes': [['Week'], ['Month']], 'without_rowid': False},
+        'Aggregate_Week': {'columns': [('Week', 'TEXT')] + period, 'key': ['Week'], 'indexes': [],
+                           'without_rowid': False},
+        'Aggregate_Month': {'columns': [('Month', 'TEXT')] + period, 'key': ['Month'], 'indexes': [],
+                            'without_rowid': False},
+    }
+    for tablename, definition in tables.items():
+        prepare_table(cnx, tablename, table=definition)
+
+
+def migrate_to_4(cnx):
+    """
+    Table Sync with the watermark per endpoint, and the hash of the responses in the Manifest
+    :param cnx: Connection to the SQLite database
+    :return:
+    """
+    if 'Hash' not in table_columns(cnx, 'Manifest'):
+        cnx.execute('ALTER TABLE Manifest ADD COLUMN "Hash" TEXT')
+    prepare_table(cnx, 'Sync', table={
+        'columns': [('Endpoint', 'TEXT'), ('Date', 'TEXT'), ('Synced', 'TEXT')],
+        'key': ['Endpoint'], 'indexes': [], 'without_rowid': True})
+
+
+def migrate_to_5(cnx):
+    """
+    Table Meta with the number of commits of the downloads, the version of the stored data
+    :param cnx: Connection to the SQLite database
+    :return:
+    """
+    prepare_table(cnx, 'Meta', table={
+        'columns': [('Name', 'TEXT'), ('Value', 'INTEGER')],
+        'key': ['Name'], 'indexes': [], 'without_rowid': True})
+
+
+# Migrations by version they lead to
+MIGRATIONS = {
+    1: migrate_to_1,
+    2: migrate_to_2,
+    3: migrate_to_3,
+    4: migrate_to_4,
+    5: migrate_to_5,
+}
+
+
+def migrate(cnx):
+    """
+    Bring a database to the current schema version. Every migration is committed
+    together with the new version number, an interrupted migration is repeated.
+    :param cnx: Connection to the SQLite database
+    :return: version of the database before the migration
+    """
+    version = cnx.execute("PRAGMA user_version").fetchone()[0]
+    for target in sorted(MIGRATIONS):
+        if target > version:
+            cnx.commit()
+            cnx.execute("BEGIN")
+            try:
+                MIGRATIONS[target](cnx)
+                cnx.execute("PRAGMA user_version = {:d}".format(target))
+            except Exception:
+                cnx.rollback()
+                raise
+            cnx.commit()
+    return version
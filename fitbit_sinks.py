@@ -0,0 +1,285 @@
+"""
+Outputs of the stored data besides the SQLite database. Every sink receives
+the dataframes saved by save_df.
+
+Sinks:
+- csv     : a CSV file per table per day, e.g. Steps/steps_intraday_20190102.csv
+- parquet : a Parquet dataset per table, partitioned by year and month,
+            Parquet/<table>/year=<YYYY>/month=<MM>/data.parquet (needs pyarrow)
+
+Single rows, such as the summary of a day, are collected by a RecordBuffer
+and written to the database and the sinks in bulk.
+"""
+import os
+import numpy as np
+import pandas as pd
+from fitbit_frames import EPOCH
+from fitbit_schema import TABLES
+from fitbit_db import TableBatches, upsert_df
+from fitbit_profile import profiler, profiled
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Pandas types of the SQLite column types, integers can be missing
+COLUMN_DTYPES = {
+    'INTEGER': 'Int64',
+    'REAL': 'float64',
+    'TEXT': 'string',
+}
+
+
+class CSVSink(object):
+    """
+    A CSV file per table per day
+    """
+
+    def write(self, dataframe, logdate, filename, tablename, dup_cols):
+        """
+        Write the rows of a table of a day
+        :param dataframe: Dataframe to save
+        :param logdate: Day of logging
+        :param filename: Filename (path and prefix), appended with date and ".csv", no file if None
+        :param tablename: Tablename in the SQLite database
+        :param dup_cols: Key columns of the table
+        :return:
+        """
+        if filename:
+            filename = filename + logdate.replace('-', '') + '.csv'
+            profiler.call('sink csv', dataframe.to_csv, filename, header=True, index=False)
+            profiler.add_bytes('sink csv', os.path.getsize(filename) if profiler.enabled else 0)
+
+    def write_days(self, dataframe, days, tablename, dup_cols):
+        """
+        Write the rows of a table of multiple days, a file per day
+        :param dataframe: Dataframe to save
+        :param days: (day of logging, filename) of every row
+        :param tablename: Tablename in the SQLite database
+        :param dup_cols: Key columns of the table
+        :return:
+        """
+        rows = {}
+        for j, day in enumerate(days):
+            rows.setdefault(day, []).append(j)
+        for (logdate, filename), day_rows in rows.items():
+            self.write(dataframe.iloc[day_rows], logdate, filename, tablename, dup_cols)
+
+    def checkpoint(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def typed_frame(dataframe, tablename):
+    """
+    Convert the columns of a dataframe to the types of the table in the schema,
+    columns of tables not in the schema are kept
+    :param dataframe: dataframe
+    :param tablename: name of the table
+    :return: dataframe
+    """
+    types = dict(TABLES[tablename]['columns']) if tablename in TABLES else {}
+    columns = {}
+    for column in dataframe.columns:
+        values = dataframe[column]
+        kind = types.get(column)
+        if kind == 'TEXT':
+            values = values.astype('string')
+        elif kind in COLUMN_DTYPES:
+            values = pd.to_numeric(values, errors='coerce').astype(COLUMN_DTYPES[kind])
+        columns[column] = values.reset_index(drop=True)
+    return pd.DataFrame(columns)
+
+
+def frame_months(dataframe):
+    """
+    Month of every row of a dataframe, from the column Date or Minute
+    :param dataframe: dataframe
+    :return: array of strings, format YYYY-MM
+    """
+    if 'Date' in dataframe.columns:
+        return dataframe['Date'].astype(str).str[:7].to_numpy()
+    days = np.datetime64(EPOCH) + (dataframe['Minute'].to_numpy(dtype=np.int64) // 1440).astype('timedelta64[D]')
+    return np.datetime_as_string(days, unit='M')
+
+
+class ParquetSink(object):
+    """
+    A Parquet dataset per table, partitioned by year and month and compressed
+    with zstd. The rows are buffered per partition and merged into the file of
+    the partition when the database commits (see StorageSession) or the sink
+    is closed. Rows with the key of a row already in the file replace that row.
+    """
+
+    def __init__(self, directory="Parquet"):
+        """
+        Create the sink
+        :param directory: root directory of the datasets
+        """
+        if pyarrow is None:
+            raise RuntimeError("Parquet output needs the pyarrow package")
+        self.directory = directory
+        self.buffers = {}
+        self.saved = {}
+
+    def partition(self, tablename, month):
+        """
+        Directory of a partition
+        :param tablename: name of the table
+        :param month: month, format YYYY-MM
+        :return: path
+        """
+        return os.path.join(self.directory, tablename, "year=" + month[:4], "month=" + month[5:7])
+
+    def write(self, dataframe, logdate, filename, tablename, dup_cols):
+        """
+        Add the rows of a table, see CSVSink.write. The rows may be of multiple days.
+        :return:
+        """
+        if dataframe.empty:
+            return
+        months = frame_months(dataframe)
+        for month in np.unique(months):
+            part = dataframe[months == month]
+            self.buffers.setdefault((tablename, month), (dup_cols, []))[1].append(part)
+
+    def write_days(self, dataframe, days, tablename, dup_cols):
+        """
+        Add the rows of a table of multiple days, see CSVSink.write_days
+        :return:
+        """
+        self.write(dataframe, None, None, tablename, dup_cols)
+
+    def checkpoint(self):
+        """
+        Remember the rows buffered so far, see rollback
+        :return:
+        """
+        self.saved = dict((key, len(frames)) for key, (dup_cols, frames) in self.buffers.items())
+
+    def rollback(self):
+        """
+        Remove the rows added since the last checkpoint, e.g. of a day that is rolled back
+        :return:
+        """
+        for key in list(self.buffers):
+            frames = self.saved.get(key, 0)
+            if frames == 0:
+                del self.buffers[key]
+            else:
+                del self.buffers[key][1][frames:]
+
+    def write_partition(self, tablename, month, dup_cols, frame):
+        """
+        Merge rows into the file of a partition
+        :param tablename: name of the table
+        :param month: month, format YYYY-MM
+        :param dup_cols: Key columns of the table
+        :param frame: rows of the month
+        :return:
+        """
+        directory = self.partition(tablename, month)
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, "data.parquet")
+        frame = typed_frame(frame, tablename)
+        if os.path.exists(filename):
+            frame = pd.concat([pd.read_parquet(filename), frame], ignore_index=True)
+        frame = frame.drop_duplicates(dup_cols, keep='last').sort_values(dup_cols)
+        # Replace the file at once, a reader never sees a partially written file
+        frame.to_parquet(filename + ".tmp", engine='pyarrow', compression='zstd', index=False)
+        os.replace(filename + ".tmp", filename)
+        profiler.add_bytes('sink parquet', os.path.getsize(filename) if profiler.enabled else 0)
+
+    @profiled('sink parquet')
+    def flush(self):
+        """
+        Merge the buffered rows into the partition files
+        :return:
+        """
+        for (tablename, month), (dup_cols, frames) in self.buffers.items():
+            self.write_partition(tablename, month, dup_cols, pd.concat(frames, ignore_index=True))
+        self.buffers = {}
+        self.saved = {}
+
+    def close(self):
+        self.flush()
+
+
+class RecordBuffer(object):
+    """
+    Rows of tables appended one at a time, as dicts or tuples, and written to
+    the database and the sinks with a single dataframe per table when flushed.
+    """
+
+    def __init__(self, sinks=(), update=False):
+        """
+        Create an empty buffer
+        :param sinks: sinks receiving the rows besides the database
+        :param update: replace the values of rows already stored, see upsert_df
+        """
+        self.sinks = sinks
+        self.update = update
+        self.tables = {}
+        self.saved = {}
+
+    def append(self, tablename, record, logdate, filename, dup_cols, columns=None):
+        """
+        Add a row of a table
+        :param tablename: Tablename in the SQLite database
+        :param record: dict with a value per column, or tuple with the values of columns
+        :param logdate: Day of logging
+        :param filename: CSV filename (path and prefix), see CSVSink.write
+        :param dup_cols: Key columns of the table
+        :param columns: column names of a tuple record
+        :return:
+        """
+        table = self.tables.setdefault(tablename, {'dup_cols': dup_cols, 'columns': columns, 'records': [], 'days': []})
+        table['records'].append(record)
+        table['days'].append((logdate, filename))
+
+    def checkpoint(self):
+        """
+        Remember the rows buffered so far, see rollback
+        :return:
+        """
+        self.saved = dict((tablename, len(table['records'])) for tablename, table in self.tables.items())
+
+    def rollback(self):
+        """
+        Remove the rows appended since the last checkpoint
+        :return:
+        """
+        for tablename in list(self.tables):
+            rows = self.saved.get(tablename, 0)
+            if rows == 0:
+                del self.tables[tablename]
+            else:
+                del self.tables[tablename]['records'][rows:]
+                del self.tables[tablename]['days'][rows:]
+
+    @profiled('records flush')
+    def flush(self, cnx):
+        """
+        Write the buffered rows
+        :param cnx: Connection to the SQLite database, or TableBatches
+        :return:
+        """
+        for tablename, table in self.tables.items():
+            frame = pd.DataFrame.from_records(table['records'], columns=table['columns'])
+            for sink in self.sinks:
+                sink.write_days(frame, table['days'], tablename, table['dup_cols'])
+            if isinstance(cnx, TableBatches):
+                cnx.add(frame, tablename, table['dup_cols'])
+            else:
+                upsert_df(frame, tablename, cnx, table['dup_cols'], update=self.update)
+        self.tables = {}
+        self.saved = {}
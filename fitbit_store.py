@@ -0,0 +1,304 @@
+"""
+Queries of the stored data for analyses, e.g. in the notebooks:
+
+    store = FitbitStore('../data/fitbit.db')
+    days = store.daily(('2019-01-01', '2019-12-31'))
+    steps = store.intraday('steps', ('2019-06-01', '2019-06-30'), resolution='hour')
+    sleep = store.sleep_sessions(('2019-06-01', None))
+
+Only the rows of the requested days are read, using the primary keys of the
+tables, and returned with the column types of the schema. Results are kept on
+disk, keyed by the query and the version of the data, so a repeated query is
+read from a file until new data is stored by a download.
+
+Years of intraday data are read in blocks of days, with compact columns, and
+aggregated while reading, so the memory used does not depend on the range:
+
+    daily = StreamingAggregate('day')
+    for block in store.intraday_blocks('heart', ('2017-01-01', None)):
+        daily.add(block, 'Heart Rate')
+    heart = daily.result()
+"""
+import os
+import shutil
+import sqlite3
+import hashlib
+import datetime
+import numpy as np
+import pandas as pd
+from fitbit_schema import TABLES, quote, table_exists
+from fitbit_aggregates import HOUR
+from fitbit_sinks import typed_frame
+
+# Intraday metrics: table, value column, how minutes are combined and the type of the values in blocks
+INTRADAY_METRICS = {
+    'steps': ('Steps_1m', 'Steps', 'sum', np.int16),
+    'heart': ('Heartrate', 'Heart Rate', 'avg', np.int16),
+    'calories': ('Calories_1m', 'Calories', 'sum', np.float32),
+    'distance': ('Distance_1m', 'Distance', 'sum', np.float32),
+    'floors': ('Floors_1m', 'Floors', 'sum', np.int16),
+    'elevation': ('Elevation_1m', 'Elevation', 'sum', np.float32),
+}
+
+# Number of the minute of a row of an intraday table, counted from 1970-01-01 00:00, see epoch_minute
+EPOCH_MINUTE = "CAST(julianday(Date) - 2440587.5 AS INTEGER) * 1440 + " \
+               "CAST(substr(Time, 1, 2) AS INTEGER) * 60 + CAST(substr(Time, 4, 2) AS INTEGER)"
+
+# Keys of a StreamingAggregate, computed from the minute numbers. 1970-01-01 is a Thursday.
+STREAM_KEYS = {
+    'hour': lambda minutes: minutes // 60,
+    'day': lambda minutes: minutes // 1440,
+    'hour_of_day': lambda minutes: minutes // 60 % 24,
+    'weekday': lambda minutes: (minutes // 1440 + 3) % 7,
+}
+
+# Resolutions of intraday data
+RESOLUTIONS = ['minute', 'hour', 'day']
+
+# Date bounds of an open range
+FIRST_DATE = '0000-01-01'
+LAST_DATE = '9999-12-31'
+
+# Length of a data version, the name of the directory of its results
+VERSION_LENGTH = 16
+
+
+def date_range(dates):
+    """
+    Bounds of a range of days
+    :param dates: (first, last) day, inclusive, as date or string YYYY-MM-DD, None for no bound,
+                  or None for all days
+    :return: (first, last) as strings
+    """
+    first, last = dates if dates else (None, None)
+    return (str(first) if first else FIRST_DATE), (str(last) if last else LAST_DATE)
+
+
+class FitbitStore(object):
+    """
+    Read access to the database of the downloads, with results kept on disk
+    """
+
+    def __init__(self, filename=os.path.join('data', 'fitbit.db'), memo_directory=None, memo=True):
+        """
+        Open the database, read only
+        :param filename: path of the SQLite file
+        :param memo_directory: directory of the kept results, default query_cache next to the database
+        :param memo: keep results on disk
+        """
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(filename)), uri=True)
+        self.memo_directory = memo_directory or os.path.join(os.path.dirname(filename), 'query_cache')
+        self.memo = memo
+
+    def data_version(self):
+        """
+        Version of the stored data. It changes with every commit of a download,
+        which increments the number of commits in the table Meta. A database of
+        an older version is identified by the days recorded in the table Manifest.
+        :return: string
+        """
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        state = (None, None)
+        if table_exists(self.connection, 'Manifest'):
+            state = self.connection.execute("SELECT count(*), max(Stored) FROM Manifest").fetchone()
+        commits = None
+        if table_exists(self.connection, 'Meta'):
+            commits = self.connection.execute("SELECT max(Value) FROM Meta WHERE Name = 'Commits'").fetchone()[0]
+        return hashlib.sha1(repr((version, state, commits)).encode()).hexdigest()[:VERSION_LENGTH]
+
+    def query(self, sql, params, tablename):
+        """
+        Read the result of a query, from disk if the same query was done on the same data before
+        :param sql: query
+        :param params: parameters of the query
+        :param tablename: table of the schema with the types of the columns
+        :return: dataframe
+        """
+        if not self.memo:
+            return self.read(sql, params, tablename)
+        directory = os.path.join(self.memo_directory, self.data_version())
+        filename = os.path.join(directory, hashlib.sha1(repr((sql, params)).encode()).hexdigest() + '.pkl')
+        if os.path.exists(filename):
+            return pd.read_pickle(filename)
+        if not os.path.isdir(directory):
+            self.remove_old_results()
+            os.makedirs(directory)
+        frame = self.read(sql, params, tablename)
+        frame.to_pickle(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        return frame
+
+    def remove_old_results(self):
+        """
+        Remove the results of older versions of the data, they are not used again
+        :return:
+        """
+        if os.path.isdir(self.memo_directory):
+            for name in os.listdir(self.memo_directory):
+                path = os.path.join(self.memo_directory, name)
+                if len(name) == VERSION_LENGTH and os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def read(self, sql, params, tablename):
+        """
+        Read the result of a query from the database
+        :return: dataframe, see query
+        """
+        frame = typed_frame(pd.read_sql(sql, self.connection, params=params), tablename)
+        if 'Date' in frame.columns:
+            frame['Date'] = pd.to_datetime(frame['Date'])
+        return frame
+
+    def daily(self, dates=None, columns=None):
+        """
+        Daily summaries
+        :param dates: (first, last) day, see date_range
+        :param columns: columns of Daily_Summary, default all
+        :return: dataframe with a row per day
+        """
+        selected = '*' if columns is None else ', '.join(quote(column) for column in ['Date'] + list(columns))
+        return self.query("SELECT {} FROM Daily_Summary WHERE Date BETWEEN ? AND ? ORDER BY Date".format(selected),
+                          date_range(dates), 'Daily_Summary')
+
+    def intraday(self, metric, dates=None, resolution='minute'):
+        """
+        Intraday data of a metric
+        :param metric: name in INTRADAY_METRICS, e.g. 'steps' or 'heart'
+        :param dates: (first, last) day, see date_range
+        :param resolution: 'minute', 'hour' or 'day'
+        :return: dataframe with a row per minute, hour or day, the index is the start time
+        """
+        tablename, column, combine, _ = INTRADAY_METRICS[metric]
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Resolution must be one of " + ', '.join(RESOLUTIONS))
+        value = quote(column)
+        if resolution == 'minute':
+            sql = "SELECT Date, Time, {value} FROM {table} WHERE Date BETWEEN ? AND ? ORDER BY Date, Time"
+        elif column in dict(TABLES['Aggregate_Hour']['columns']):
+            tablename = 'Aggregate_Hour'
+            if resolution == 'hour':
+                sql = "SELECT Date, Hour, {value} FROM {table} WHERE Date BETWEEN ? AND ? ORDER BY Date, Hour"
+            elif combine == 'avg':
+                sql = "SELECT Date, sum({value} * \"Heart Rate Minutes\") / sum(\"Heart Rate Minutes\") AS {value} " \
+                      "FROM {table} WHERE Date BETWEEN ? AND ? GROUP BY Date ORDER BY Date"
+            else:
+                sql = "SELECT Date, sum({value}) AS {value} FROM {table} WHERE Date BETWEEN ? AND ? " \
+                      "GROUP BY Date ORDER BY Date"
+        elif resolution == 'hour':
+            sql = "SELECT Date, {hour} AS Hour, {combine}({value}) AS {value} FROM {table} " \
+                  "WHERE Date BETWEEN ? AND ? GROUP BY Date, Hour ORDER BY Date, Hour"
+        else:
+            sql = "SELECT Date, {combine}({value}) AS {value} FROM {table} " \
+                  "WHERE Date BETWEEN ? AND ? GROUP BY Date ORDER BY Date"
+        frame = self.query(sql.format(value=value, table=quote(tablename), hour=HOUR, combine=combine),
+                           date_range(dates), tablename)
+        start = frame['Date']
+        if resolution == 'minute':
+            start = start + pd.to_timedelta(frame.pop('Time'))
+        elif resolution == 'hour':
+            start = start + pd.to_timedelta(frame.pop('Hour').astype('int64'), unit='h')
+        frame.index = pd.DatetimeIndex(start, name='DateTime')
+        return frame
+
+    def intraday_blocks(self, metric, dates=None, block_days=31):
+        """
+        Intraday data of a metric in blocks of days, read when the next block is needed.
+        The results are not kept on disk.
+        :param metric: name in INTRADAY_METRICS, e.g. 'steps' or 'heart'
+        :param dates: (first, last) day, see date_range
+        :param block_days: number of days per block
+        :return: generator of dataframes with the columns Minute (int32, see epoch_minute)
+                 and the value column (int16 or float32), minutes without a value are left out
+        """
+        tablename, column, _, dtype = INTRADAY_METRICS[metric]
+        if not table_exists(self.connection, tablename):
+            return
+        first, last = date_range(dates)
+        present = self.connection.execute("SELECT min(Date), max(Date) FROM {} WHERE Date BETWEEN ? AND ?".format(
+            quote(tablename)), (first, last)).fetchone()
+        if present[0] is None:
+            return
+        sql = "SELECT {minute}, {value} FROM {table} WHERE Date BETWEEN ? AND ? AND {value} IS NOT NULL " \
+              "ORDER BY Date, Time".format(minute=EPOCH_MINUTE, value=quote(column), table=quote(tablename))
+        day = datetime.datetime.strptime(present[0], "%Y-%m-%d").date()
+        last_day = datetime.datetime.strptime(present[1], "%Y-%m-%d").date()
+        while day <= last_day:
+            block_end = min(day + datetime.timedelta(days=block_days - 1), last_day)
+            rows = np.array(self.connection.execute(sql, (str(day), str(block_end))).fetchall(),
+                            dtype=[('Minute', np.int32), (column, dtype)])
+            if len(rows):
+                yield pd.DataFrame({'Minute': rows['Minute'], column: rows[column]})
+            day = block_end + datetime.timedelta(days=1)
+
+    def sleep_sessions(self, dates=None):
+        """
+        Sleep logs, with the start and end as timestamps
+        :param dates: (first, last) day of sleep, see date_range
+        :return: dataframe with a row per sleep log
+        """
+        frame = self.query("SELECT * FROM Sleep WHERE Date BETWEEN ? AND ? ORDER BY Date, \"Log Count\"",
+                           date_range(dates), 'Sleep')
+        for column in ['Start Time', 'End Time']:
+            frame[column] = pd.to_datetime(frame[column])
+        return frame
+
+    def close(self):
+        self.connection.close()
+
+
+class StreamingAggregate(object):
+    """
+    Count, sum, mean, minimum and maximum of a value per key, e.g. per day,
+    updated with blocks of minutes, see FitbitStore.intraday_blocks. Only the
+    statistics per key are kept, not the minutes.
+    """
+
+    def __init__(self, key='day'):
+        """
+        Create without data
+        :param key: 'hour', 'day', 'hour_of_day' or 'weekday' (0 is Monday)
+        """
+        if key not in STREAM_KEYS:
+            raise ValueError("Key must be one of " + ', '.join(STREAM_KEYS))
+        self.key = key
+        self.stats = None
+
+    def add(self, block, column):
+        """
+        Add the values of a block
+        :param block: dataframe with the columns Minute and the value column
+        :param column: name of the value column
+        :return:
+        """
+        keys = STREAM_KEYS[self.key](block['Minute'].to_numpy(dtype=np.int64))
+        stats = pd.Series(block[column].to_numpy(dtype=np.float64)).groupby(keys).agg(
+            ['count', 'sum', 'min', 'max'])
+        if self.stats is None:
+            self.stats = stats
+        else:
+            current = self.stats.reindex(self.stats.index.union(stats.index))
+            stats = stats.reindex(current.index)
+            current[['count', 'sum']] = current[['count', 'sum']].fillna(0) + stats[['count', 'sum']].fillna(0)
+            current['min'] = np.fmin(current['min'], stats['min'])
+            current['max'] = np.fmax(current['max'], stats['max'])
+            self.stats = current
+
+    def result(self):
+        """
+        Statistics per key
+        :return: dataframe with the columns count, sum, mean, min and max, indexed by the key
+                 (start time for hour and day)
+        """
+        if self.stats is None:
+            stats = pd.DataFrame(columns=['count', 'sum', 'min', 'max'], dtype=np.float64)
+        else:
+            stats = self.stats.copy()
+        stats['count'] = stats['count'].astype(np.int64)
+        stats.insert(2, 'mean', stats['sum'] / stats['count'])
+        if self.key in ('hour', 'day'):
+            unit = 'h' if self.key == 'hour' else 'D'
+            stats.index = pd.DatetimeIndex(pd.to_datetime(stats.index.to_numpy(dtype=np.int64), unit=unit),
+                                           name='DateTime')
+        else:
+            stats.index.name = self.key
+        return stats
@@ -0,0 +1,21 @@
+import os
+import sys
+
+# Modules of the application are in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+from fitbit_frames import dataset_to_frame
+
+
+@pytest.fixture
+def steps():
+    """
+    Factory of Steps_1m dataframes, a value per minute from midnight
+    """
+    def make(values, day='2019-01-02'):
+        return dataset_to_frame([{'time': '00:0{}:00'.format(j), 'value': v} for j, v in enumerate(values)],
+                                day, 'Steps', np.int32)
+    return make
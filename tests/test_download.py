@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+import download
+from fitbit_cache import FileCache, MemoryCache
+from fitbit_db import Manifest, StorageSession
+from fitbit_sinks import RecordBuffer
+
+DAY = datetime.date(2019, 6, 10)
+
+
+def sleep_log(log_id, minutes):
+    return {'dateOfSleep': '2019-06-10', 'startTime': '2019-06-10T01:00:00.000', 'endTime': '2019-06-10T07:00:00.000',
+            'timeInBed': 360, 'awakeCount': 1, 'awakeDuration': 5, 'awakeningsCount': 1, 'duration': 21600000,
+            'efficiency': 95, 'isMainSleep': log_id == 1, 'logId': log_id, 'minutesAfterWakeup': 0,
+            'minutesAsleep': 340, 'minutesAwake': 20, 'minutesToFallAsleep': 0, 'restlessCount': 2,
+            'restlessDuration': 10,
+            'minuteData': [{'dateTime': '01:0{}:00'.format(j), 'value': '1'} for j in range(minutes)]}
+
+
+class SleepClient(object):
+    def __init__(self, logs):
+        self.logs = logs
+
+    def get_sleep(self, day):
+        return {'sleep': self.logs, 'summary': {'totalMinutesAsleep': 340, 'totalSleepRecords': len(self.logs),
+                                                'totalTimeInBed': 360}}
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    records = RecordBuffer([], update=True)
+    storage = StorageSession(str(tmp_path / 'fitbit.db'), records=records)
+    monkeypatch.setattr(download, 'cache', MemoryCache(FileCache(str(tmp_path / 'Cache'))))
+    monkeypatch.setattr(download, 'downloaded_entries', set())
+    monkeypatch.setattr(download, 'manifest', Manifest(storage.connection))
+    monkeypatch.setattr(download, 'sinks', [])
+    monkeypatch.setattr(download, 'records', records)
+    monkeypatch.setattr(download, 'update_stored', True)
+    yield storage
+    storage.close()
+
+
+def save_day(storage, client):
+    storage.begin_day()
+    download.save_fitbit_data(client, storage.connection, DAY, {'sleep'})
+    storage.end_day()
+
+
+def test_refetched_day_with_fewer_records_replaces_the_stored_rows(storage):
+    client = SleepClient([sleep_log(1, 3), sleep_log(2, 2)])
+    save_day(storage, client)
+    cnx = storage.connection
+    assert cnx.execute('SELECT count(*) FROM Sleep').fetchone()[0] == 2
+    assert cnx.execute('SELECT count(*) FROM Sleep_1m').fetchone()[0] == 5
+    # The second sleep log was removed on the device after the first download
+    client.logs = [sleep_log(1, 3)]
+    assert download.refetch_responses(client, {DAY: {'sleep'}}) == (1, 1)
+    assert download.manifest.outdated('2019-06-10') == {'sleep'}
+    save_day(storage, client)
+    assert cnx.execute('SELECT "Log ID" FROM Sleep').fetchall() == [(1,)]
+    assert cnx.execute('SELECT DISTINCT LogID FROM Sleep_1m').fetchall() == [(1,)]
+    assert cnx.execute('SELECT "Sleep Records" FROM Sleep_Summary').fetchall() == [(1,)]
+    assert download.manifest.outdated('2019-06-10') == set()
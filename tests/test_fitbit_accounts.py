@@ -0,0 +1,80 @@
+import os
+import json
+
+import pytest
+
+from fitbit_accounts import read_accounts, needs_authorization, option_value, without_option, run_accounts
+
+SCRIPT = """
+import os, sys
+print(' '.join([os.path.basename(os.getcwd())] + sys.argv[1:] + [os.environ.get('FITBIT_CLIENT_SECRET', '-')]))
+sys.exit(1 if '--fail' in sys.argv else 0)
+"""
+
+
+def write_config(tmp_path, config):
+    filename = str(tmp_path / 'accounts.json')
+    with open(filename, 'w') as f:
+        json.dump(config, f)
+    return filename
+
+
+def test_read_accounts(tmp_path):
+    filename = write_config(tmp_path, {'id': 'app', 'secret': 's', 'accounts': [
+        {'name': 'alice', 'first': '2018-03-01'},
+        {'name': 'bob', 'id': 'other', 'arguments': ['--workers', 2]}]})
+    alice, bob = read_accounts(filename)
+    assert alice['directory'] == str(tmp_path / 'Accounts' / 'alice')
+    assert alice['arguments'] == ['--id', 'app', '--first', '2018-03-01']
+    assert bob['arguments'] == ['--id', 'other', '--workers', '2']
+    assert alice['secret'] == bob['secret'] == 's'
+
+
+@pytest.mark.parametrize('names', [['../alice'], ['alice', 'alice'], ['']])
+def test_read_accounts_refuses_names(tmp_path, names):
+    filename = write_config(tmp_path, {'accounts': [{'name': name} for name in names]})
+    with pytest.raises(ValueError):
+        read_accounts(filename)
+
+
+def test_needs_authorization(tmp_path):
+    account = {'name': 'alice', 'directory': str(tmp_path), 'secret': None, 'arguments': []}
+    assert needs_authorization(account, ['sync'])
+    assert not needs_authorization(account, ['download', '--offline'])
+    (tmp_path / 'token.json').write_text('{}')
+    assert not needs_authorization(account, ['sync'])
+    assert needs_authorization(account, ['sync', '--authorize'])
+
+
+def test_needs_authorization_uses_token_file_of_the_process(tmp_path):
+    account = {'name': 'alice', 'directory': str(tmp_path), 'secret': None, 'arguments': ['--token-file', 'a.json']}
+    (tmp_path / 'token.json').write_text('{}')
+    assert needs_authorization(account, ['sync'])
+    (tmp_path / 'a.json').write_text('{}')
+    assert not needs_authorization(account, ['sync'])
+    account['arguments'] = []
+    assert needs_authorization(account, ['sync', '--token-file=b.json'])
+    assert not needs_authorization(account, ['sync', '--token-file', str(tmp_path / 'a.json')])
+
+
+def test_option_value():
+    assert option_value(['sync', '--secret', 'a', '--secret=b'], '--secret') == 'b'
+    assert option_value(['sync', '--secret'], '--secret') is None
+
+
+def test_without_option():
+    assert without_option(['sync', '--accounts', 'a.json', '--workers', '2'], '--accounts') == \
+        ['sync', '--workers', '2']
+    assert without_option(['--accounts=a.json', 'sync'], '--accounts') == ['sync']
+
+
+def test_run_accounts_in_own_directories(tmp_path, capsys):
+    script = tmp_path / 'script.py'
+    script.write_text(SCRIPT)
+    filename = write_config(tmp_path, {'accounts': [{'name': 'alice'},
+                                                    {'name': 'bob', 'secret': 'b', 'arguments': ['--fail']}]})
+    assert run_accounts(filename, ['download', '--offline', '--secret', 'a'], script=str(script)) == \
+        {'alice': 0, 'bob': 1}
+    lines = sorted(capsys.readouterr().out.splitlines())
+    assert lines == ['[alice] alice download --offline a', '[bob] bob download --offline --fail b']
+    assert os.path.isdir(str(tmp_path / 'Accounts' / 'bob'))
@@ -0,0 +1,56 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from fitbit_aggregates import Aggregates, refresh
+from fitbit_db import upsert_df, read_table
+from fitbit_frames import dataset_to_frame
+
+
+def intraday(day, column, values, dtype=np.int32):
+    return dataset_to_frame([{'time': time, 'value': v} for time, v in values], day, column, dtype)
+
+
+def store_day(cnx, day, steps, heart, daily_steps):
+    upsert_df(intraday(day, 'Steps', steps), 'Steps_1m', cnx, ['Date', 'Time'], update=True)
+    upsert_df(intraday(day, 'Heart Rate', heart), 'Heartrate', cnx, ['Date', 'Time'], update=True)
+    upsert_df(pd.DataFrame({'Date': [day], 'Steps': [daily_steps], 'Minutes Asleep': [420],
+                            'Fairly Active Minutes': [10], 'Very Active Minutes': [5]}),
+              'Daily_Summary', cnx, ['Date'], update=True)
+
+
+def test_refresh_hours_days_and_periods():
+    cnx = sqlite3.connect(':memory:')
+    # Sunday and Monday, two weeks of one month
+    store_day(cnx, '2019-06-09', [('08:00:00', 10), ('08:01:00', 20), ('09:30:00', 5)],
+              [('08:00:00', 60), ('08:01:00', 80)], 1000)
+    store_day(cnx, '2019-06-10', [('12:00:00', 7)], [('12:00:00', 70)], 2000)
+    refresh(cnx, ['2019-06-09', '2019-06-10'])
+    hours = read_table(cnx, 'Aggregate_Hour')
+    assert hours[['Date', 'Hour', 'Steps']].values.tolist() == \
+        [['2019-06-09', 8, 30], ['2019-06-09', 9, 5], ['2019-06-10', 12, 7]]
+    assert hours['Heart Rate'].tolist()[:1] == [70.0]
+    assert cnx.execute('SELECT Date, Week, Month, Weekday, "Active Minutes", "Heart Rate" '
+                       'FROM Aggregate_Day').fetchall() == \
+        [('2019-06-09', '2019-06-03', '2019-06', 6, 15, 70.0), ('2019-06-10', '2019-06-10', '2019-06', 0, 15, 70.0)]
+    assert cnx.execute('SELECT Week, Days, Steps FROM Aggregate_Week').fetchall() == \
+        [('2019-06-03', 1, 1000), ('2019-06-10', 1, 2000)]
+    assert cnx.execute('SELECT Month, Days, Steps, "Steps Mean" FROM Aggregate_Month').fetchall() == \
+        [('2019-06', 2, 3000, 1500.0)]
+
+
+def test_aggregates_update_only_affected_buckets():
+    cnx = sqlite3.connect(':memory:')
+    store_day(cnx, '2019-06-09', [('08:00:00', 10)], [('08:00:00', 60)], 1000)
+    store_day(cnx, '2019-06-10', [('12:00:00', 7)], [('12:00:00', 70)], 2000)
+    aggregates = Aggregates()
+    aggregates.add_days(['2019-06-09', '2019-06-10'])
+    aggregates.flush(cnx)
+    store_day(cnx, '2019-06-11', [('13:00:00', 3)], [('13:00:00', 90)], 500)
+    aggregates.add_days(['2019-06-11'])
+    aggregates.flush(cnx)
+    assert aggregates.dates == set()
+    assert cnx.execute('SELECT Week, Days, Steps, "Heart Rate" FROM Aggregate_Week').fetchall() == \
+        [('2019-06-03', 1, 1000, 60.0), ('2019-06-10', 2, 2500, 80.0)]
+    assert cnx.execute('SELECT Month, Days, Steps FROM Aggregate_Month').fetchall() == [('2019-06', 3, 3500)]
@@ -0,0 +1,320 @@
+import os
+import datetime
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import fitbit
+import pytest
+from fitbit.exceptions import HTTPUnauthorized
+
+from fitbit_api import RateLimiter, DownloadStopped, serialize_token_refresh, retry_unauthorized, TokenFile, \
+    group_ranges, fetch_bodyweight_range, fetch_training_range, configure_session, JitteredRetry, HTTP_BACKOFF_MAX
+
+
+def timed_acquires(limiter, count):
+    start = time.monotonic()
+    for _ in range(count):
+        limiter.acquire()
+    return time.monotonic() - start
+
+
+def test_bucket_starts_full():
+    limiter = RateLimiter(quota=5, period=100)
+    assert timed_acquires(limiter, 5) < 0.1
+
+
+def test_bucket_refills_evenly():
+    # 3 tokens per 0.3 seconds: two extra tokens take about 0.2 seconds
+    limiter = RateLimiter(quota=3, period=0.3)
+    elapsed = timed_acquires(limiter, 5)
+    assert 0.15 < elapsed < 0.5
+
+
+def test_stop_releases_waiting_worker():
+    limiter = RateLimiter(quota=1, period=3600)
+    limiter.acquire()
+    errors = []
+
+    def worker():
+        try:
+            limiter.acquire()
+        except DownloadStopped:
+            errors.append('stopped')
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    time.sleep(0.05)
+    limiter.stop()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert errors == ['stopped']
+    with pytest.raises(DownloadStopped):
+        limiter.acquire()
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.token = {'access_token': 'old'}
+        self.refreshes = 0
+
+    def refresh_token(self, url, auth=None):
+        # Refresh by the session, before a request with an expired token
+        self.refreshes += 1
+        time.sleep(0.05)
+        self.token = {'access_token': 'auto%d' % self.refreshes}
+        return self.token
+
+
+class FakeOauthClient(object):
+    def __init__(self):
+        self.session = FakeSession()
+        self.refreshes = 0
+        self.requests = []
+
+    def refresh_token(self):
+        self.refreshes += 1
+        time.sleep(0.05)
+        self.session.token = {'access_token': 'new%d' % self.refreshes}
+        return self.session.token
+
+    def make_request(self, url):
+        self.requests.append((url, self.session.token['access_token']))
+        if self.session.token['access_token'] == 'old':
+            raise HTTPUnauthorized(None)
+        return {'url': url}
+
+
+class FakeFitbit(object):
+    def __init__(self):
+        self.client = FakeOauthClient()
+
+
+def test_parallel_token_refresh_uses_refresh_token_once():
+    fb_client = FakeFitbit()
+    oauth_client = fb_client.client
+    serialize_token_refresh(fb_client)
+    threads = [threading.Thread(target=oauth_client.refresh_token) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert oauth_client.refreshes == 1
+    assert oauth_client.session.token == {'access_token': 'new1'}
+
+
+def test_parallel_session_refresh_uses_refresh_token_once():
+    fb_client = FakeFitbit()
+    session = fb_client.client.session
+    serialize_token_refresh(fb_client)
+    threads = [threading.Thread(target=session.refresh_token, args=('url',)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.refreshes == 1
+    # A refresh of the client shortly after reuses the token too
+    assert fb_client.client.refresh_token() == {'access_token': 'auto1'}
+    assert fb_client.client.refreshes == 0
+
+
+def test_unauthorized_request_is_retried_with_refreshed_token():
+    fb_client = FakeFitbit()
+    serialize_token_refresh(fb_client)
+    retry_unauthorized(fb_client, lambda: {'access_token': 'old', 'refresh_token': 'r'})
+    assert fb_client.client.make_request('sleep') == {'url': 'sleep'}
+    assert fb_client.client.requests == [('sleep', 'old'), ('sleep', 'new1')]
+
+
+def test_unauthorized_request_uses_token_stored_by_other_run():
+    fb_client = FakeFitbit()
+    retry_unauthorized(fb_client, lambda: {'access_token': 'stored', 'refresh_token': 'r'})
+    assert fb_client.client.make_request('sleep') == {'url': 'sleep'}
+    assert fb_client.client.requests[-1] == ('sleep', 'stored')
+    assert fb_client.client.refreshes == 0
+
+
+def test_token_file(tmp_path):
+    tokens = TokenFile(str(tmp_path / 'tokens' / 'token.json'))
+    assert tokens.load() is None
+    token = {'access_token': 'a', 'refresh_token': 'r', 'expires_at': 1600000000.5}
+    assert tokens.save(token)
+    assert not tokens.save(dict(token))
+    assert TokenFile(tokens.filename).load() == token
+    assert os.stat(tokens.filename).st_mode & 0o777 == 0o600
+    with open(tokens.filename, 'w') as f:
+        f.write('{"access_token": "a"')
+    assert tokens.load() is None
+
+
+def test_update_switches_to_reported_window():
+    limiter = RateLimiter(quota=150, period=3600)
+    limiter.acquire()
+    limiter.update(150, 2, 0.2)
+    limiter.release()
+    # Two requests left, the third waits for the reset of the window
+    elapsed = timed_acquires(limiter, 3)
+    assert 0.15 < elapsed < 0.5
+
+
+def test_update_subtracts_requests_in_flight():
+    limiter = RateLimiter(quota=150, period=3600)
+    for _ in range(3):
+        limiter.acquire()
+    # First response arrives while two other requests are still in flight
+    limiter.update(150, 10, 100)
+    assert limiter.tokens == 8
+
+
+def test_update_never_raises_budget_within_window():
+    limiter = RateLimiter(quota=150, period=3600)
+    limiter.acquire()
+    limiter.update(150, 5, 100)
+    limiter.release()
+    # Late response of an earlier request reports more remaining requests
+    limiter.acquire()
+    limiter.update(150, 20, 100)
+    limiter.release()
+    assert limiter.tokens == 4
+
+
+def test_exhausted_waits_for_retry_after():
+    limiter = RateLimiter(quota=150, period=3600)
+    limiter.exhausted(0.2)
+    elapsed = timed_acquires(limiter, 1)
+    assert 0.15 < elapsed < 0.5
+
+
+def date(day_str):
+    return datetime.datetime.strptime(day_str, "%Y-%m-%d").date()
+
+
+def days_from(first_day_str, count):
+    return [date(first_day_str) + datetime.timedelta(days=j) for j in range(count)]
+
+
+def test_group_ranges_splits_at_gap():
+    days = days_from("2019-01-01", 3) + days_from("2019-01-10", 2)
+    assert group_ranges(days, 31) == [(date("2019-01-01"), date("2019-01-03")),
+                                      (date("2019-01-10"), date("2019-01-11"))]
+
+
+def test_group_ranges_splits_at_maximum_length():
+    days = days_from("2019-01-01", 65)
+    assert group_ranges(days, 31) == [(date("2019-01-01"), date("2019-01-31")),
+                                      (date("2019-02-01"), date("2019-03-03")),
+                                      (date("2019-03-04"), date("2019-03-06"))]
+    assert len(group_ranges(days, 30)) == 3
+
+
+def test_group_ranges_accepts_unsorted_days():
+    days = list(reversed(days_from("2019-01-01", 3)))
+    assert group_ranges(days, 31) == [(date("2019-01-01"), date("2019-01-03"))]
+
+
+def test_bodyweight_range_split_per_day():
+    def make_request(url):
+        assert url.endswith("/body/log/weight/date/2019-01-01/2019-01-03.json")
+        return {'weight': [{'date': '2019-01-02', 'weight': 80.0}, {'date': '2019-01-02', 'weight': 81.0}]}
+
+    result = fetch_bodyweight_range(make_request, date("2019-01-01"), date("2019-01-03"))
+    assert result == {'2019-01-01': {'weight': []},
+                      '2019-01-02': {'weight': [{'date': '2019-01-02', 'weight': 80.0},
+                                                {'date': '2019-01-02', 'weight': 81.0}]},
+                      '2019-01-03': {'weight': []}}
+
+
+def activity_log(first_day_str, days, per_day):
+    """ Activities of a period, newest first, like the Fitbit activity log list """
+    activities = []
+    for day in reversed(days_from(first_day_str, days)):
+        for minute in reversed(range(per_day)):
+            activities.append({'startTime': '{}T{:02d}:{:02d}:00.000+01:00'.format(day, minute // 60, minute % 60)})
+    return activities
+
+
+def fake_activity_list(activities):
+    requests = []
+
+    def make_request(url):
+        requests.append(url)
+        before = url.split('beforeDate=')[1].split('&')[0]
+        limit = int(url.split('limit=')[1])
+        return {'activities': [act for act in activities if act['startTime'][:len(before)] < before][:limit]}
+
+    return make_request, requests
+
+
+def test_training_range_single_page():
+    make_request, requests = fake_activity_list(activity_log("2018-12-01", 60, 1))
+    result = fetch_training_range(make_request, date("2019-01-01"), date("2019-01-10"))
+    assert len(requests) == 1
+    assert sorted(result) == [str(day) for day in days_from("2019-01-01", 10)]
+    assert all(len(data['activities']) == 1 for data in result.values())
+
+
+def test_training_range_paginates_busy_days():
+    # More activities on the last day than fit in a single page
+    make_request, requests = fake_activity_list(activity_log("2019-01-01", 3, 150))
+    result = fetch_training_range(make_request, date("2019-01-02"), date("2019-01-03"))
+    assert len(requests) == 4
+    assert len(result['2019-01-02']['activities']) == 150
+    assert len(result['2019-01-03']['activities']) == 150
+
+
+def test_configure_session_pool_retries_and_timeouts():
+    client = fitbit.Fitbit('id', 'secret', oauth2=True, access_token='a', refresh_token='r')
+    configure_session(client, workers=4, timeout=(5, 30), retries=3)
+    adapter = client.client.session.get_adapter('https://api.fitbit.com/1/user/-/sleep.json')
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 3
+    assert 503 in adapter.max_retries.status_forcelist
+    assert not adapter.max_retries.is_retry('POST', 503)
+    assert client.client.session.headers['Accept-Encoding'] == 'gzip, deflate'
+    assert client.client.timeout == (5, 30)
+
+
+def test_configure_session_leaves_too_many_requests_to_the_rate_limiter(monkeypatch):
+    # The local server is plain HTTP
+    monkeypatch.setenv('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    requests_made = []
+
+    class TooManyRequests(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_made.append(self.path)
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), TooManyRequests)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        client = fitbit.Fitbit('id', 'secret', oauth2=True, access_token='a', refresh_token='r')
+        configure_session(client, retries=3)
+        session = client.client.session
+        session.mount('http://', session.get_adapter('https://api.fitbit.com/'))
+        response = session.get('http://127.0.0.1:{}/1/user/-/sleep.json'.format(server.server_port), timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert response.status_code == 429
+    assert requests_made == ['/1/user/-/sleep.json']
+
+
+def test_jittered_backoff_stays_below_exponential_backoff():
+    retry = JitteredRetry(total=10, backoff_factor=1.0)
+    for _ in range(4):
+        retry = retry.increment(method='GET', url='/')
+    # Exponential backoff after 4 errors: 1.0 * 2 ** 3 seconds
+    backoffs = [retry.get_backoff_time() for _ in range(100)]
+    assert all(0 <= b <= 8 for b in backoffs)
+    assert len(set(backoffs)) > 1
+    for _ in range(6):
+        retry = retry.increment(method='GET', url='/')
+    assert retry.get_backoff_time() <= HTTP_BACKOFF_MAX
@@ -0,0 +1,24 @@
+import datetime
+
+from fitbit_benchmark import synthetic_day, generate_cache, read_cache, upsert_steps
+from fitbit_frames import dataset_to_frame
+
+
+def test_synthetic_day_is_repeatable_and_complete():
+    day = datetime.date(2019, 3, 6)
+    responses = synthetic_day(day)
+    assert responses == synthetic_day(day)
+    assert len(responses['activities_steps']['activities-steps-intraday']['dataset']) == 1440
+    assert responses['sleep']['sleep'][0]['isMainSleep']
+    assert len(responses['heart_1m']['activities-heart'][0]['value']['heartRateZones']) == 4
+    frame = dataset_to_frame(responses['sleep']['sleep'][0]['minuteData'], str(day), 'Value', time_key='dateTime')
+    assert len(frame) == responses['sleep']['sleep'][0]['timeInBed']
+    assert all(activity['startTime'][:10] <= str(day) for activity in responses['training']['activities'])
+
+
+def test_generate_and_read_cache(tmp_path):
+    entries = generate_cache(str(tmp_path / 'Cache'), 2, backend='sqlite')
+    assert entries == 2 * len(synthetic_day(datetime.date(2019, 12, 31)))
+    assert read_cache(str(tmp_path / 'Cache'), 'sqlite') == entries
+    insert, present = upsert_steps(str(tmp_path / 'Cache'), 'sqlite', 2)
+    assert insert > 0 and present > 0
@@ -0,0 +1,131 @@
+import os
+
+import pytest
+
+from fitbit_cache import FileCache, SQLiteCache, LazyEntry, MemoryCache, open_cache, migrate_cache, pack, unpack, \
+    content_hash
+
+SLEEP = {'sleep': [{'dateOfSleep': '2020-01-02', 'minuteData': [{'dateTime': '00:01:00', 'value': '1'}]}],
+         'summary': {'totalMinutesAsleep': 400}}
+
+
+@pytest.fixture(params=[("files", False), ("files", True), ("sqlite", False)])
+def cache(request, tmp_path):
+    cache = open_cache(request.param[0], str(tmp_path / "Cache"), request.param[1])
+    yield cache
+    cache.close()
+
+
+def test_roundtrip(cache):
+    assert not cache.contains("sleep", "2020-01-02")
+    assert cache.read("sleep", "2020-01-02") is None
+    cache.write("sleep", "2020-01-02", SLEEP)
+    assert cache.contains("sleep", "2020-01-02")
+    assert cache.read("sleep", "2020-01-02") == SLEEP
+
+
+def test_write_replaces_entry(cache):
+    cache.write("weight", "2020-01-02", {'weight': []})
+    cache.write("weight", "2020-01-02", {'weight': [{'weight': 80.0}]})
+    assert cache.read("weight", "2020-01-02") == {'weight': [{'weight': 80.0}]}
+
+
+def test_entries(cache):
+    cache.write("sleep", "2020-01-02", SLEEP)
+    cache.write("activities_steps", "2019-12-31", {})
+    assert sorted(cache.entries()) == [("activities_steps", "2019-12-31"), ("sleep", "2020-01-02")]
+
+
+def test_file_layout(tmp_path):
+    cache = FileCache(str(tmp_path / "Cache"))
+    cache.write("heart_1m", "2021-03-04", {})
+    assert os.path.isfile(str(tmp_path / "Cache" / "2021" / "2021-03-04_heart_1m.json"))
+
+
+def test_migrate_files_to_sqlite(tmp_path):
+    source = FileCache(str(tmp_path / "Cache"))
+    source.write("sleep", "2020-01-02", SLEEP)
+    source.write("weight", "2020-01-03", {'weight': []})
+    target = SQLiteCache(str(tmp_path / "Cache" / "cache.db"))
+    assert migrate_cache(source, target) == 2
+    assert migrate_cache(source, target) == 0
+    assert target.read("sleep", "2020-01-02") == SLEEP
+    assert sorted(target.entries()) == sorted(source.entries())
+    target.close()
+
+
+def test_pack_decodes_keys_on_use():
+    data = {'activities-heart': [{'value': 60}],
+            'activities-heart-intraday': {'dataset': [{'time': '00:00:00', 'value': 70}] * 1440}}
+    entry = unpack(pack(data))
+    assert isinstance(entry, LazyEntry)
+    assert sorted(entry) == sorted(data)
+    assert entry['activities-heart'] == [{'value': 60}]
+    assert list(entry.values) == ['activities-heart']
+    assert entry == data
+
+
+def test_compressed_file_replaces_plain_file(tmp_path):
+    FileCache(str(tmp_path / "Cache")).write("sleep", "2020-01-02", SLEEP)
+    cache = FileCache(str(tmp_path / "Cache"), compress=True)
+    assert migrate_cache(cache, cache, overwrite=True) == 1
+    assert not os.path.isfile(cache.filename("sleep", "2020-01-02"))
+    assert os.path.isfile(cache.filename("sleep", "2020-01-02", ".fbz"))
+    assert cache.entries() == [("sleep", "2020-01-02")]
+    assert cache.read("sleep", "2020-01-02") == SLEEP
+
+
+def test_legacy_sqlite_entry_is_read(tmp_path):
+    import json
+    import zlib
+    cache = SQLiteCache(str(tmp_path / "cache.db"))
+    cache.conn.execute("INSERT INTO cache VALUES (?, ?, ?)",
+                       ("sleep", "2020-01-02", zlib.compress(json.dumps(SLEEP).encode('utf8'))))
+    assert cache.read("sleep", "2020-01-02") == SLEEP
+    cache.close()
+
+
+class CountingCache(FileCache):
+    def __init__(self, directory):
+        FileCache.__init__(self, directory)
+        self.loads = 0
+
+    def load(self, name, date):
+        self.loads += 1
+        return FileCache.load(self, name, date)
+
+
+def test_memory_cache_returns_same_dict(tmp_path):
+    backend = CountingCache(str(tmp_path / "Cache"))
+    cache = MemoryCache(backend)
+    cache.write("sleep", "2020-01-02", SLEEP)
+    first = cache.read("sleep", "2020-01-02")
+    assert first is SLEEP
+    assert cache.read("sleep", "2020-01-02") is first
+    assert backend.loads == 0
+
+
+def test_memory_cache_evicts_least_recently_used(tmp_path):
+    backend = CountingCache(str(tmp_path / "Cache"))
+    size = backend.write("sleep", "2020-01-01", SLEEP)
+    backend.write("sleep", "2020-01-02", SLEEP)
+    backend.write("sleep", "2020-01-03", SLEEP)
+    cache = MemoryCache(backend, max_entries=2)
+    assert cache.load("sleep", "2020-01-01") == (SLEEP, size)
+    cache.read("sleep", "2020-01-02")
+    # Kept in memory, nothing is read from the backend
+    assert cache.load("sleep", "2020-01-01") == (SLEEP, 0)
+    cache.read("sleep", "2020-01-03")
+    assert backend.loads == 3
+    assert len(cache.entries_in_memory) == 2
+    # 2020-01-02 was least recently used and is read from the backend again
+    cache.read("sleep", "2020-01-01")
+    cache.read("sleep", "2020-01-02")
+    assert backend.loads == 4
+
+
+def test_content_hash_of_cached_entry(cache):
+    cache.write("sleep", "2020-01-02", SLEEP)
+    reordered = {'summary': {'totalMinutesAsleep': 400}, 'sleep': SLEEP['sleep']}
+    assert content_hash(cache.read("sleep", "2020-01-02")) == content_hash(reordered)
+    assert content_hash(SLEEP) != content_hash(dict(SLEEP, summary={'totalMinutesAsleep': 401}))
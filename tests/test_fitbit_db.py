@@ -0,0 +1,142 @@
+import datetime
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from fitbit_db import upsert_df, read_table, present_dates, present_minute_dates, delete_day, TableBatches, \
+    Manifest, StorageSession
+from fitbit_frames import epoch_minute
+
+
+def test_upsert_skips_existing_rows(steps):
+    cnx = sqlite3.connect(':memory:')
+    upsert_df(steps([1, 2]), 'Steps_1m', cnx, ['Date', 'Time'])
+    upsert_df(steps([5, 6, 7]), 'Steps_1m', cnx, ['Date', 'Time'])
+    table = read_table(cnx, 'Steps_1m')
+    assert table['Time'].tolist() == ['00:00:00', '00:01:00', '00:02:00']
+    assert table['Steps'].tolist() == [1, 2, 7]
+
+
+def test_upsert_update_replaces_values(steps):
+    cnx = sqlite3.connect(':memory:')
+    upsert_df(steps([1, 2]), 'Steps_1m', cnx, ['Date', 'Time'])
+    upsert_df(steps([5]), 'Steps_1m', cnx, ['Date', 'Time'], update=True)
+    assert read_table(cnx, 'Steps_1m')['Steps'].tolist() == [5, 2]
+
+
+def test_upsert_deduplicates_existing_table():
+    cnx = sqlite3.connect(':memory:')
+    old = pd.DataFrame({'Date': ['2019-01-02', '2019-01-02', '2019-01-03'], 'Weight': [80.0, 81.0, 82.0]})
+    old.to_sql(name='Weight_Log', con=cnx, index=False)
+    upsert_df(pd.DataFrame({'Date': ['2019-01-02'], 'Weight': [90.0]}), 'Weight_Log', cnx, ['Date'])
+    table = read_table(cnx, 'Weight_Log')
+    assert table['Date'].tolist() == ['2019-01-02', '2019-01-03']
+    assert table['Weight'].tolist() == [81.0, 82.0]
+
+
+def test_upsert_stores_missing_values_as_null():
+    cnx = sqlite3.connect(':memory:')
+    frame = pd.DataFrame({'Minute': [1, 2], 'Steps': [3.0, np.nan], 'Date': pd.Categorical(['a', 'a'])})
+    assert upsert_df(frame, 'Minute', cnx, ['Minute']) == 2
+    assert cnx.execute('SELECT Minute, Steps, Date FROM Minute').fetchall() == [(1, 3, 'a'), (2, None, 'a')]
+
+
+def test_upsert_converts_old_table_of_schema():
+    cnx = sqlite3.connect(':memory:')
+    pd.DataFrame({'Date': ['2019-01-02', '2019-01-02'], 'Steps': ['10', '12']}).to_sql(
+        name='Steps_Summary', con=cnx, index=False)
+    upsert_df(pd.DataFrame({'Date': ['2019-01-03'], 'Steps': [5]}), 'Steps_Summary', cnx, ['Date'])
+    assert cnx.execute('SELECT Date, Steps FROM Steps_Summary ORDER BY Date').fetchall() == \
+        [('2019-01-02', 12), ('2019-01-03', 5)]
+
+
+def test_storage_session_commits_batches_and_keeps_days_before_error(tmp_path, steps):
+    filename = str(tmp_path / 'fitbit.db')
+    storage = StorageSession(filename, commit_days=2)
+    assert storage.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    for day in ['2019-01-01', '2019-01-02', '2019-01-03']:
+        storage.begin_day()
+        upsert_df(steps([1], day), 'Steps_1m', storage.connection, ['Date', 'Time'])
+        storage.end_day()
+    # Two days committed, the third is pending
+    other = sqlite3.connect(filename)
+    assert other.execute('SELECT count(*) FROM Steps_1m').fetchone()[0] == 2
+    storage.begin_day()
+    upsert_df(steps([1], '2019-01-04'), 'Steps_1m', storage.connection, ['Date', 'Time'])
+    storage.abort_day()
+    storage.close()
+    assert other.execute('SELECT Date FROM Steps_1m').fetchall() == \
+        [('2019-01-01',), ('2019-01-02',), ('2019-01-03',)]
+
+
+def test_present_dates(steps):
+    cnx = sqlite3.connect(':memory:')
+    assert present_dates(cnx, 'Steps_1m') == set()
+    upsert_df(steps([1, 2], '2019-01-02'), 'Steps_1m', cnx, ['Date', 'Time'])
+    upsert_df(steps([1], '2019-01-04'), 'Steps_1m', cnx, ['Date', 'Time'])
+    assert present_dates(cnx, 'Steps_1m') == {'2019-01-02', '2019-01-04'}
+
+
+def test_delete_day(steps):
+    cnx = sqlite3.connect(':memory:')
+    delete_day(cnx, 'Steps_1m', datetime.date(2019, 1, 2))
+    upsert_df(steps([1, 2], '2019-01-02'), 'Steps_1m', cnx, ['Date', 'Time'])
+    upsert_df(steps([1], '2019-01-04'), 'Steps_1m', cnx, ['Date', 'Time'])
+    delete_day(cnx, 'Steps_1m', datetime.date(2019, 1, 2))
+    assert present_dates(cnx, 'Steps_1m') == {'2019-01-04'}
+    first = epoch_minute(datetime.date(2019, 1, 2))
+    upsert_df(pd.DataFrame({'Minute': [first - 1, first, first + 1439, first + 1440]}), 'Minute', cnx, ['Minute'])
+    delete_day(cnx, 'Minute', datetime.date(2019, 1, 2))
+    assert present_minute_dates(cnx) == {'2019-01-01', '2019-01-03'}
+
+
+def test_manifest_records_fetched_and_stored():
+    cnx = sqlite3.connect(':memory:')
+    manifest = Manifest(cnx)
+    manifest.mark_fetched([('sleep', '2019-01-02'), ('heart_1m', '2019-01-02')])
+    manifest.mark_stored([('sleep', '2019-01-02')])
+    manifest.mark_fetched([('sleep', '2019-01-02')])
+    assert manifest.stored() == {('sleep', '2019-01-02')}
+    assert cnx.execute('SELECT Endpoint, Status FROM Manifest ORDER BY Endpoint').fetchall() == \
+        [('heart_1m', 'fetched'), ('sleep', 'stored')]
+
+
+def test_manifest_hashes_and_watermarks():
+    cnx = sqlite3.connect(':memory:')
+    manifest = Manifest(cnx)
+    manifest.mark_stored([('sleep', '2019-01-02'), ('sleep', '2019-01-03')])
+    manifest.mark_hashes([('sleep', '2019-01-03', 'abc')])
+    assert manifest.hashes('2019-01-01', '2019-01-31') == {('sleep', '2019-01-03'): 'abc'}
+    manifest.mark_outdated([('sleep', '2019-01-03')])
+    assert manifest.stored() == {('sleep', '2019-01-02')}
+    manifest.mark_fetched([('heart_1m', '2019-01-03')])
+    assert manifest.outdated('2019-01-03') == {'sleep'}
+    assert manifest.watermarks() == {}
+    manifest.set_watermarks({'sleep': '2019-01-02'})
+    manifest.set_watermarks({'sleep': '2019-01-03'})
+    assert manifest.watermarks() == {'sleep': '2019-01-03'}
+
+
+def test_present_minute_dates():
+    cnx = sqlite3.connect(':memory:')
+    assert present_minute_dates(cnx) == set()
+    frame = pd.DataFrame({'Minute': [17898 * 1440, 17898 * 1440 + 1439, 17899 * 1440]})
+    upsert_df(frame, 'Minute', cnx, ['Minute'])
+    assert present_minute_dates(cnx) == {'2019-01-02', '2019-01-03'}
+
+
+def test_table_batches_write_combined_rows(steps):
+    batches = TableBatches()
+    batches.add(steps([1, 2], '2019-01-02'), 'Steps_1m', ['Date', 'Time'])
+    batches.add(steps([3], '2019-01-03'), 'Steps_1m', ['Date', 'Time'])
+    batches.mark_stored([('steps_1m', '2019-01-02'), ('steps_1m', '2019-01-03')])
+    batches.combine()
+    assert len(batches.frames['Steps_1m'][1]) == 1
+    cnx = sqlite3.connect(':memory:')
+    upsert_df(steps([9], '2019-01-03'), 'Steps_1m', cnx, ['Date', 'Time'])
+    manifest = Manifest(cnx)
+    assert batches.write(cnx, manifest, update=True) == 3
+    assert cnx.execute('SELECT Date, Steps FROM Steps_1m ORDER BY Date, Time').fetchall() == \
+        [('2019-01-02', 1), ('2019-01-02', 2), ('2019-01-03', 3)]
+    assert manifest.stored() == {('steps_1m', '2019-01-02'), ('steps_1m', '2019-01-03')}
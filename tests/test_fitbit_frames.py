@@ -0,0 +1,58 @@
+import datetime
+
+import numpy as np
+
+from fitbit_frames import minute_of_day, dataset_to_frame, combine_minutes, epoch_minute
+
+
+def test_minute_of_day():
+    assert minute_of_day(['00:00:00', '00:01:00', '13:45:00', '23:59']).tolist() == [0, 1, 825, 1439]
+    assert minute_of_day([]).tolist() == []
+
+
+def test_dataset_to_frame():
+    dataset = [{'time': '00:00:00', 'value': 3}, {'time': '00:01:00', 'value': 0}, {'time': '10:30:00', 'value': 12}]
+    frame = dataset_to_frame(dataset, '2019-01-02', 'Steps', np.int32)
+    assert list(frame.columns) == ['Date', 'Time', 'Steps']
+    assert frame['Date'].tolist() == ['2019-01-02'] * 3
+    assert str(frame['Date'].dtype) == 'category'
+    assert frame['Time'].tolist() == ['00:00:00', '00:01:00', '10:30:00']
+    assert frame['Steps'].dtype == np.int32
+    assert frame['Steps'].tolist() == [3, 0, 12]
+    assert frame.index.tolist() == [0, 1, 630]
+
+
+def test_dataset_to_frame_keeps_values_and_time_key():
+    dataset = [{'dateTime': '23:10:00', 'value': '2'}]
+    frame = dataset_to_frame(dataset, '2019-01-02', 'Value', time_key='dateTime')
+    assert frame['Value'].tolist() == ['2']
+    assert frame.index.tolist() == [1390]
+
+
+def test_empty_dataset():
+    frame = dataset_to_frame([], '2019-01-02', 'Heart Rate', np.int32)
+    assert list(frame.columns) == ['Date', 'Time', 'Heart Rate']
+    assert len(frame) == 0
+
+
+def test_combine_minutes():
+    day = datetime.date(2019, 1, 2)
+    steps = dataset_to_frame([{'time': '00:00:00', 'value': 3}, {'time': '00:01:00', 'value': 4}],
+                             '2019-01-02', 'Steps', np.int32)
+    heart = dataset_to_frame([{'time': '00:01:00', 'value': 61}, {'time': '00:02:00', 'value': 62}],
+                             '2019-01-02', 'Heart Rate', np.int32)
+    combined = combine_minutes({'Steps': steps, 'Heart Rate': heart}, day, ['Steps', 'Heart Rate', 'Floors'])
+    assert list(combined.columns) == ['Minute', 'Steps', 'Heart Rate', 'Floors']
+    first = epoch_minute(day)
+    assert first == 17898 * 1440
+    assert combined['Minute'].tolist() == [first, first + 1, first + 2]
+    assert combined['Steps'].tolist()[:2] == [3, 4]
+    assert np.isnan(combined['Steps'].iloc[2])
+    assert combined['Heart Rate'].tolist()[1:] == [61, 62]
+    assert combined['Floors'].isna().all()
+
+
+def test_combine_minutes_without_data():
+    combined = combine_minutes({}, datetime.date(2019, 1, 2), ['Steps'])
+    assert list(combined.columns) == ['Minute', 'Steps']
+    assert len(combined) == 0
@@ -0,0 +1,41 @@
+import json
+
+from fitbit_profile import Profiler, profiler, profiled
+
+
+@profiled('double')
+def double(value):
+    return 2 * value
+
+
+def test_profiled_counts_only_when_enabled():
+    profiler.take()
+    assert double(2) == 4
+    assert profiler.stages == {}
+    profiler.enable()
+    try:
+        double(1)
+        double(2)
+        profiler.add_bytes('double', 10)
+        assert profiler.summary()[0]['stage'] == 'double'
+        assert profiler.summary()[0]['calls'] == 2
+        assert profiler.summary()[0]['bytes'] == 10
+    finally:
+        profiler.enabled = False
+        profiler.take()
+
+
+def test_merge_and_trace(tmp_path):
+    worker = Profiler()
+    worker.enable(trace=True)
+    worker.call('parse', sum, [1, 2])
+    main = Profiler()
+    main.enable(trace=True)
+    main.call('parse', sum, [3])
+    main.merge(worker.take())
+    assert worker.stages == {}
+    assert main.stages['parse'][0] == 2
+    main.write_trace(str(tmp_path / 'trace.json'))
+    trace = json.load(open(str(tmp_path / 'trace.json')))
+    assert [event['name'] for event in trace['traceEvents']] == ['parse', 'parse']
+    assert trace['otherData']['stages'][0]['calls'] == 2
@@ -0,0 +1,43 @@
+import sqlite3
+
+import pandas as pd
+
+from fitbit_schema import TABLES, SCHEMA_VERSION, migrate, table_columns
+
+
+def test_migrate_creates_all_tables():
+    cnx = sqlite3.connect(':memory:')
+    assert migrate(cnx) == 0
+    assert cnx.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    for tablename, table in TABLES.items():
+        assert table_columns(cnx, tablename) == [column for column, kind in table['columns']]
+    assert migrate(cnx) == SCHEMA_VERSION
+
+
+def test_migrate_converts_tables_of_to_sql():
+    cnx = sqlite3.connect(':memory:')
+    pd.DataFrame({'Date': ['2019-01-02', '2019-01-02', '2019-01-03'],
+                  'Time': ['00:00:00', '00:00:00', '00:00:00'],
+                  'Steps': [1, 2, 3]}).to_sql(name='Steps_1m', con=cnx, index=False)
+    pd.DataFrame({'Date': ['2019-01-02'], 'Steps': ['1234']}).to_sql(name='Steps_Summary', con=cnx, index=False)
+    pd.DataFrame({'Date': ['2019-01-02'], 'LogID': [7], 'Time': ['23:00:00'], 'Value': ['2'],
+                  'interpreted': ['restless']}).to_sql(name='Sleep_1m', con=cnx, index=False)
+    cnx.commit()
+    migrate(cnx)
+    assert cnx.execute('SELECT * FROM Steps_1m ORDER BY Date').fetchall() == \
+        [('2019-01-02', '00:00:00', 2), ('2019-01-03', '00:00:00', 3)]
+    assert cnx.execute('SELECT Steps, typeof(Steps) FROM Steps_Summary').fetchall() == [(1234, 'integer')]
+    assert cnx.execute('SELECT Value, interpreted FROM Sleep_1m').fetchall() == [(2, 'restless')]
+    assert not cnx.execute("SELECT name FROM sqlite_master WHERE name LIKE '%_old'").fetchall()
+    plan = cnx.execute("EXPLAIN QUERY PLAN SELECT * FROM Steps_1m WHERE Date = '2019-01-02'").fetchall()
+    assert 'SCAN' not in str(plan)
+
+
+def test_migrations_do_not_follow_tables(monkeypatch):
+    monkeypatch.setitem(TABLES, 'Steps_Summary', {
+        'columns': [('Date', 'TEXT'), ('Steps', 'INTEGER'), ('Added Later', 'TEXT')],
+        'key': ['Date'], 'indexes': [], 'without_rowid': False})
+    cnx = sqlite3.connect(':memory:')
+    migrate(cnx)
+    assert table_columns(cnx, 'Steps_Summary') == ['Date', 'Steps']
+    assert table_columns(cnx, 'Manifest')[-1] == 'Hash'
@@ -0,0 +1,103 @@
+import datetime
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fitbit_frames import epoch_minute
+import fitbit_sinks
+from fitbit_db import StorageSession
+from fitbit_sinks import CSVSink, ParquetSink, RecordBuffer, typed_frame, frame_months
+
+
+def test_csv_sink(tmp_path, steps):
+    sink = CSVSink()
+    sink.write(steps([1, 2], '2019-01-02'), '2019-01-02', str(tmp_path / 'steps_'), 'Steps_1m', ['Date', 'Time'])
+    sink.write(steps([1, 2], '2019-01-02'), '2019-01-02', None, 'Steps_1m', ['Date', 'Time'])
+    assert [p.name for p in tmp_path.iterdir()] == ['steps_20190102.csv']
+    assert pd.read_csv(tmp_path / 'steps_20190102.csv')['Steps'].tolist() == [1, 2]
+
+
+def test_typed_frame():
+    frame = pd.DataFrame({'Date': ['2019-01-02'], 'Steps': ['1234'], 'Extra': [1.5]})
+    typed = typed_frame(frame, 'Steps_Summary')
+    assert str(typed['Date'].dtype) == 'string'
+    assert str(typed['Steps'].dtype) == 'Int64'
+    assert typed['Steps'].tolist() == [1234]
+    assert typed['Extra'].dtype == np.float64
+
+
+def test_frame_months():
+    assert frame_months(pd.DataFrame({'Date': ['2019-01-31', '2019-02-01']})).tolist() == ['2019-01', '2019-02']
+    minutes = [epoch_minute(datetime.date(2019, 1, 31)) + 1439, epoch_minute(datetime.date(2019, 2, 1))]
+    assert frame_months(pd.DataFrame({'Minute': minutes})).tolist() == ['2019-01', '2019-02']
+
+
+def test_parquet_sink_partitions_and_replaces_rows(tmp_path, steps):
+    pytest.importorskip('pyarrow')
+    sink = ParquetSink(str(tmp_path))
+    sink.write(steps([1, 2], '2019-01-31'), '2019-01-31', None, 'Steps_1m', ['Date', 'Time'])
+    sink.write(steps([3], '2019-02-01'), '2019-02-01', None, 'Steps_1m', ['Date', 'Time'])
+    sink.close()
+    sink.write(steps([5], '2019-01-31'), '2019-01-31', None, 'Steps_1m', ['Date', 'Time'])
+    sink.close()
+    january = pd.read_parquet(tmp_path / 'Steps_1m' / 'year=2019' / 'month=01' / 'data.parquet')
+    assert january['Steps'].tolist() == [5, 2]
+    february = pd.read_parquet(tmp_path / 'Steps_1m' / 'year=2019' / 'month=02' / 'data.parquet')
+    assert february['Steps'].tolist() == [3]
+
+
+def test_parquet_sink_written_with_commits_and_rolled_back_with_days(tmp_path, monkeypatch, steps):
+    # The buffering does not need pyarrow, the partitions are recorded instead of written
+    monkeypatch.setattr(fitbit_sinks, 'pyarrow', object())
+    sink = ParquetSink(str(tmp_path))
+    written = []
+    sink.write_partition = lambda tablename, month, dup_cols, frame: written.append(
+        (tablename, month, frame['Steps'].tolist()))
+    storage = StorageSession(str(tmp_path / 'fitbit.db'), commit_days=2, sinks=[sink])
+    for day, values in [('2019-01-31', [1, 2]), ('2019-01-30', [3])]:
+        storage.begin_day()
+        sink.write(steps(values, day), day, None, 'Steps_1m', ['Date', 'Time'])
+        storage.end_day()
+    assert written == [('Steps_1m', '2019-01', [1, 2, 3])]
+    storage.begin_day()
+    sink.write(steps([4], '2019-01-29'), '2019-01-29', None, 'Steps_1m', ['Date', 'Time'])
+    storage.end_day()
+    storage.begin_day()
+    sink.write(steps([5], '2019-01-28'), '2019-01-28', None, 'Steps_1m', ['Date', 'Time'])
+    sink.write(steps([6], '2019-02-01'), '2019-02-01', None, 'Steps_1m', ['Date', 'Time'])
+    storage.abort_day()
+    storage.close()
+    assert written == [('Steps_1m', '2019-01', [1, 2, 3]), ('Steps_1m', '2019-01', [4])]
+    assert sink.buffers == {}
+
+
+def test_record_buffer_writes_rows_per_table_and_day(tmp_path):
+    records = RecordBuffer([CSVSink()])
+    prefix = str(tmp_path / 'summary_')
+    records.append('Steps_Summary', {'Date': '2019-01-02', 'Steps': 10}, '2019-01-02', prefix, ['Date'])
+    records.checkpoint()
+    records.append('Steps_Summary', {'Date': '2019-01-03', 'Steps': 12}, '2019-01-03', prefix, ['Date'])
+    records.append('Distance', ('2019-01-03', 'total', 1.5), '2019-01-03', None, ['Date', 'Activity'],
+                   columns=['Date', 'Activity', 'Distance'])
+    records.rollback()
+    records.append('Steps_Summary', {'Date': '2019-01-04', 'Steps': 14}, '2019-01-04', prefix, ['Date'])
+    cnx = sqlite3.connect(':memory:')
+    records.flush(cnx)
+    assert cnx.execute('SELECT Date, Steps FROM Steps_Summary ORDER BY Date').fetchall() == \
+        [('2019-01-02', 10), ('2019-01-04', 14)]
+    assert cnx.execute("SELECT count(*) FROM sqlite_master WHERE name = 'Distance'").fetchone()[0] == 0
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['summary_20190102.csv', 'summary_20190104.csv']
+    assert records.tables == {}
+
+
+def test_record_buffer_updates_stored_rows():
+    cnx = sqlite3.connect(':memory:')
+    for update, steps in [(False, 10), (False, 11), (True, 12)]:
+        records = RecordBuffer(update=update)
+        records.append('Steps_Summary', {'Date': '2019-01-02', 'Steps': steps}, '2019-01-02', None, ['Date'])
+        records.flush(cnx)
+        if not update:
+            assert cnx.execute('SELECT Steps FROM Steps_Summary').fetchall() == [(10,)]
+    assert cnx.execute('SELECT Steps FROM Steps_Summary').fetchall() == [(12,)]
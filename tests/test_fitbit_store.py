@@ -0,0 +1,128 @@
+import datetime
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fitbit_aggregates import refresh
+from fitbit_db import upsert_df, Manifest, StorageSession
+from fitbit_frames import dataset_to_frame, epoch_minute
+from fitbit_schema import migrate
+from fitbit_store import FitbitStore, StreamingAggregate, date_range
+
+
+def intraday(day, column, values):
+    return dataset_to_frame([{'time': time, 'value': v} for time, v in values], day, column, np.int32)
+
+
+@pytest.fixture
+def database(tmp_path):
+    filename = str(tmp_path / 'fitbit.db')
+    cnx = sqlite3.connect(filename)
+    migrate(cnx)
+    for day, steps in [('2019-06-09', 1000), ('2019-06-10', 2000), ('2019-06-11', 3000)]:
+        upsert_df(intraday(day, 'Steps', [('08:00:00', 10), ('08:01:00', 20), ('09:00:00', 5)]),
+                  'Steps_1m', cnx, ['Date', 'Time'])
+        upsert_df(intraday(day, 'Heart Rate', [('08:00:00', 60), ('09:00:00', 80)]), 'Heartrate', cnx, ['Date', 'Time'])
+        upsert_df(pd.DataFrame({'Date': [day], 'Steps': [steps]}), 'Daily_Summary', cnx, ['Date'])
+        upsert_df(pd.DataFrame({'Date': [day], 'Log Count': [0], 'Start Time': [day + 'T23:00:00.000'],
+                                'End Time': [day + 'T23:30:00.000']}), 'Sleep', cnx, ['Date', 'Log Count'])
+    refresh(cnx, ['2019-06-09', '2019-06-10', '2019-06-11'])
+    Manifest(cnx).mark_stored([('steps_1m', '2019-06-09')])
+    cnx.commit()
+    yield filename, cnx
+    cnx.close()
+
+
+def test_date_range():
+    assert date_range(None) == ('0000-01-01', '9999-12-31')
+    assert date_range((pd.Timestamp('2019-06-10').date(), None)) == ('2019-06-10', '9999-12-31')
+
+
+def test_daily_filters_and_types(database, tmp_path):
+    store = FitbitStore(database[0], memo_directory=str(tmp_path / 'memo'))
+    days = store.daily(('2019-06-10', '2019-06-11'), columns=['Steps'])
+    assert days['Steps'].tolist() == [2000, 3000]
+    assert str(days['Steps'].dtype) == 'Int64'
+    assert days['Date'].dtype.kind == 'M'
+
+
+def test_intraday_resolutions(database, tmp_path):
+    store = FitbitStore(database[0], memo=False)
+    minutes = store.intraday('steps', ('2019-06-10', '2019-06-10'))
+    assert minutes['Steps'].tolist() == [10, 20, 5]
+    assert minutes.index[1] == pd.Timestamp('2019-06-10 08:01')
+    hours = store.intraday('steps', ('2019-06-10', '2019-06-10'), resolution='hour')
+    assert hours['Steps'].tolist() == [30, 5]
+    assert hours.index[1] == pd.Timestamp('2019-06-10 09:00')
+    assert store.intraday('heart', (None, '2019-06-09'), resolution='day')['Heart Rate'].tolist() == [70.0]
+    assert store.intraday('elevation', resolution='hour').empty
+    with pytest.raises(ValueError):
+        store.intraday('steps', resolution='week')
+
+
+def test_sleep_sessions(database, tmp_path):
+    store = FitbitStore(database[0], memo=False)
+    sleep = store.sleep_sessions(('2019-06-11', None))
+    assert sleep['Start Time'].tolist() == [pd.Timestamp('2019-06-11 23:00')]
+
+
+def test_results_kept_until_data_changes(database, tmp_path):
+    filename, cnx = database
+    store = FitbitStore(filename, memo_directory=str(tmp_path / 'memo'))
+    assert store.daily()['Steps'].tolist() == [1000, 2000, 3000]
+    cnx.execute("UPDATE Daily_Summary SET Steps = 5 WHERE Date = '2019-06-09'")
+    cnx.commit()
+    # Not stored by a download, the kept result is used
+    assert store.daily()['Steps'].tolist() == [1000, 2000, 3000]
+    Manifest(cnx).mark_stored([('steps_1m', '2019-06-10')])
+    cnx.commit()
+    assert store.daily()['Steps'].tolist() == [5, 2000, 3000]
+    assert len(list((tmp_path / 'memo').iterdir())) == 1
+
+
+def test_results_follow_every_commit(database, tmp_path):
+    filename, cnx = database
+    store = FitbitStore(filename, memo_directory=str(tmp_path / 'memo'))
+    assert store.daily()['Steps'].tolist() == [1000, 2000, 3000]
+    # A day stored again within the same second leaves the Manifest as it was
+    storage = StorageSession(filename)
+    storage.begin_day()
+    storage.connection.execute("UPDATE Daily_Summary SET Steps = 5 WHERE Date = '2019-06-09'")
+    Manifest(storage.connection).mark_stored([('steps_1m', '2019-06-09')])
+    storage.end_day()
+    assert store.daily()['Steps'].tolist() == [5, 2000, 3000]
+    storage.close()
+    assert store.daily()['Steps'].tolist() == [5, 2000, 3000]
+    assert len(list((tmp_path / 'memo').iterdir())) == 1
+
+
+def test_intraday_blocks(database):
+    store = FitbitStore(database[0], memo=False)
+    blocks = list(store.intraday_blocks('steps', ('2019-06-10', None), block_days=1))
+    assert len(blocks) == 2
+    assert blocks[0]['Minute'].dtype == np.int32
+    assert blocks[0]['Steps'].dtype == np.int16
+    assert blocks[0]['Minute'].tolist()[:2] == [epoch_minute(datetime.date(2019, 6, 10)) + 480,
+                                                epoch_minute(datetime.date(2019, 6, 10)) + 481]
+    assert list(store.intraday_blocks('steps', ('2020-01-01', None))) == []
+    assert list(store.intraday_blocks('elevation')) == []
+
+
+def test_streaming_aggregate_over_blocks(database):
+    store = FitbitStore(database[0], memo=False)
+    daily = StreamingAggregate('day')
+    hourly = StreamingAggregate('hour_of_day')
+    for block in store.intraday_blocks('steps', block_days=2):
+        daily.add(block, 'Steps')
+        hourly.add(block, 'Steps')
+    days = daily.result()
+    assert days.index[0] == pd.Timestamp('2019-06-09')
+    assert days['sum'].tolist() == [35.0, 35.0, 35.0]
+    hours = hourly.result()
+    assert hours.index.tolist() == [8, 9]
+    assert hours['count'].tolist() == [6, 3]
+    assert hours['mean'].tolist() == [15.0, 5.0]
+    assert hours['max'].tolist() == [20.0, 5.0]
+    assert StreamingAggregate('weekday').result().empty